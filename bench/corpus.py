@@ -0,0 +1,91 @@
+"""Synthetic, reproducible PDF corpora for the benchmarks."""
+import random
+from dataclasses import dataclass
+from typing import Iterator, List
+
+
+# Topic words give documents distinct vocabularies, so searches have clear best matches
+TOPICS = [
+    "oncology tumor chemotherapy biopsy metastasis radiotherapy carcinoma remission",
+    "cardiology artery stent arrhythmia hypertension ventricle cholesterol infarction",
+    "neurology neuron synapse cortex dementia seizure dopamine plasticity",
+    "genomics sequencing allele mutation genome transcript variant expression",
+    "immunology antibody antigen vaccine cytokine lymphocyte inflammation tolerance",
+    "epidemiology cohort incidence prevalence exposure outbreak mortality surveillance",
+    "pharmacology dosage receptor toxicity metabolism clearance inhibitor agonist",
+    "statistics regression variance confidence bayesian estimator likelihood bootstrap",
+]
+COMMON = (
+    "the of and to in a is that for on with as by this we study results patients data "
+    "analysis were method model effect group significant observed compared clinical trial"
+).split()
+LINES_PER_PAGE = 45
+WORDS_PER_LINE = 12
+
+
+@dataclass
+class SyntheticPDF:
+    filename: str
+    topic: str
+    content: bytes
+
+
+def escape_text(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def make_pdf(pages: List[List[str]]) -> bytes:
+    """A minimal PDF with one Helvetica text line per entry of each page"""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(f"{3 + 2 * i} 0 R" for i in range(len(pages)))
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {len(pages)} >>".encode())
+    font = 3 + 2 * len(pages)
+    for i, lines in enumerate(pages):
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 {font} 0 R >> >> /Contents {4 + 2 * i} 0 R >>".encode()
+        )
+        text = " T* ".join(f"({escape_text(line)}) Tj" for line in lines)
+        stream = f"BT /F1 10 Tf 12 TL 50 750 Td {text} ET".encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += b"".join(f"{offset:010d} 00000 n \n".encode() for offset in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return bytes(out)
+
+
+def make_page(rng: random.Random, topic: List[str], page_num: int) -> List[str]:
+    lines = [f"Section {page_num}: {' '.join(rng.sample(topic, 3))}"]
+    for _ in range(LINES_PER_PAGE - 1):
+        # About one word in four is on topic
+        words = [rng.choice(topic) if rng.random() < 0.25 else rng.choice(COMMON) for _ in range(WORDS_PER_LINE)]
+        lines.append(" ".join(words))
+    return lines
+
+
+def generate_corpus(docs: int, pages: int, seed: int = 0) -> Iterator[SyntheticPDF]:
+    """Yield docs PDFs of the given page count, the same ones for the same seed"""
+    rng = random.Random(seed)
+    for i in range(docs):
+        topic = TOPICS[i % len(TOPICS)]
+        words = topic.split()
+        content = make_pdf([make_page(rng, words, page_num) for page_num in range(1, pages + 1)])
+        yield SyntheticPDF(f"bench-{seed}-{i:05d}.pdf", words[0], content)
+
+
+def generate_queries(count: int, seed: int = 0) -> List[str]:
+    """Distinct search queries, so the search cache does not answer them"""
+    rng = random.Random(seed + 1)
+    queries = []
+    for i in range(count):
+        words = TOPICS[i % len(TOPICS)].split()
+        queries.append(f"{' '.join(rng.sample(words, 3))} {rng.choice(COMMON)} #{i}")
+    return queries
@@ -0,0 +1,242 @@
+"""Deterministic stand-in for the OpenAI embeddings and chat completions APIs.
+
+    python fake_openai.py --port 8090 --latency-ms 50 --rpm 3000
+
+Embeddings hash the words of each input into a unit vector, so texts sharing words are close
+and search results are meaningful. Completions echo words of the prompt. Latency and OpenAI
+style rate limits (429 with retry-after headers) are configurable.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import re
+import time
+from array import array
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple, Union
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+WORD = re.compile(r"\w+")
+
+
+class Settings:
+    dimension = 1536
+    # Fixed latency of every request plus a share per input token
+    latency_ms = 0.0
+    latency_per_1k_tokens_ms = 0.0
+    # Delay between streamed completion tokens
+    token_latency_ms = 0.0
+    completion_words = 120
+    # Requests and tokens allowed per minute, 0 for unlimited
+    rpm = 0
+    tpm = 0
+
+
+settings = Settings()
+app = FastAPI()
+
+
+class RateLimiter:
+    """Sliding one-minute window over requests and tokens, like OpenAI's per-model limits"""
+
+    def __init__(self):
+        self.requests: Deque[Tuple[float, int]] = deque()
+        self.tokens = 0
+
+    def acquire(self, tokens: int) -> Optional[float]:
+        """Record the request, or return seconds until it would fit in the window"""
+        now = time.monotonic()
+        while self.requests and self.requests[0][0] <= now - 60:
+            self.tokens -= self.requests.popleft()[1]
+
+        over_requests = settings.rpm and len(self.requests) + 1 > settings.rpm
+        over_tokens = settings.tpm and self.tokens + tokens > settings.tpm
+        if over_requests or over_tokens:
+            return max(0.05, self.requests[0][0] + 60 - now) if self.requests else 1.0
+        self.requests.append((now, tokens))
+        self.tokens += tokens
+        return None
+
+
+limiters: Dict[str, RateLimiter] = {}
+
+
+def count_tokens(text: str) -> int:
+    # Close enough to tiktoken for English text
+    return max(1, len(text) // 4)
+
+
+def embed(text: str) -> List[float]:
+    """Signed feature hashing of the words of text, normalized to unit length"""
+    vector = [0.0] * settings.dimension
+    for word in WORD.findall(text.lower()):
+        digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+        index = int.from_bytes(digest[:4], "little") % settings.dimension
+        vector[index] += 1.0 if digest[4] & 1 else -1.0
+    norm = sum(x * x for x in vector) ** 0.5
+    if norm == 0:
+        # Texts without words still get a stable vector
+        vector[int(hashlib.sha256(text.encode("utf-8")).hexdigest(), 16) % settings.dimension] = 1.0
+        return vector
+    return [x / norm for x in vector]
+
+
+def decode_tokens(tokens: List[int]) -> str:
+    # LangChain embeds queries as cl100k_base token ids
+    import tiktoken
+
+    return tiktoken.get_encoding("cl100k_base").decode(tokens)
+
+
+def error(status: int, message: str, kind: str, headers: Optional[Dict[str, str]] = None) -> JSONResponse:
+    return JSONResponse(
+        {"error": {"message": message, "type": kind, "param": None, "code": kind}},
+        status_code=status,
+        headers=headers,
+    )
+
+
+async def admit(model: str, tokens: int) -> Optional[JSONResponse]:
+    """Apply the rate limit and the simulated latency; a 429 response if over the limit"""
+    limiter = limiters.setdefault(model, RateLimiter())
+    retry_after = limiter.acquire(tokens)
+    if retry_after is not None:
+        return error(
+            429,
+            f"Rate limit reached for {model}. Please try again in {retry_after:.3f}s.",
+            "rate_limit_exceeded",
+            headers={
+                "retry-after": str(max(1, round(retry_after))),
+                "retry-after-ms": str(int(retry_after * 1000)),
+                "x-ratelimit-limit-requests": str(settings.rpm),
+                "x-ratelimit-limit-tokens": str(settings.tpm),
+            },
+        )
+
+    delay = settings.latency_ms + settings.latency_per_1k_tokens_ms * tokens / 1000
+    if delay:
+        await asyncio.sleep(delay / 1000)
+    return None
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    body = await request.json()
+    inputs: Union[str, List[Any]] = body["input"]
+    if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+        inputs = [inputs]
+    texts = [decode_tokens(item) if isinstance(item, list) else item for item in inputs]
+    tokens = sum(count_tokens(text) for text in texts)
+
+    rejected = await admit(body["model"], tokens)
+    if rejected is not None:
+        return rejected
+
+    data = []
+    for i, text in enumerate(texts):
+        vector = embed(text)
+        if body.get("encoding_format") == "base64":
+            vector = base64.b64encode(array("f", vector).tobytes()).decode("ascii")
+        data.append({"object": "embedding", "index": i, "embedding": vector})
+    return {
+        "object": "list",
+        "data": data,
+        "model": body["model"],
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+    }
+
+
+def completion_text(messages: List[Dict[str, Any]]) -> str:
+    """A deterministic answer made of the prompt's own words, keeping page references"""
+    prompt = messages[-1]["content"]
+    pages = re.findall(r"\[Page \d+\]", prompt)
+    words = WORD.findall(prompt)[: settings.completion_words]
+    return " ".join(pages[:5] + words)
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    prompt_tokens = sum(count_tokens(message["content"]) for message in body["messages"])
+
+    rejected = await admit(body["model"], prompt_tokens)
+    if rejected is not None:
+        return rejected
+
+    text = completion_text(body["messages"])
+    completion_id = f"chatcmpl-{hashlib.sha256(text.encode('utf-8')).hexdigest()[:24]}"
+    created = int(time.time())
+    if not body.get("stream"):
+        completion_tokens = count_tokens(text)
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": body["model"],
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": text},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    async def stream():
+        pieces = [word + " " for word in text.split(" ")]
+        pieces[-1] = pieces[-1].rstrip()
+        for i, piece in enumerate(pieces):
+            if settings.token_latency_ms:
+                await asyncio.sleep(settings.token_latency_ms / 1000)
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"role": "assistant", "content": piece} if i == 0 else {"content": piece},
+                        "finish_reason": None,
+                    }
+                ],
+            }
+            yield f"data: {json.dumps(chunk)}\n\n"
+        chunk["choices"] = [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+        yield f"data: {json.dumps(chunk)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--dimension", type=int, default=settings.dimension)
+    parser.add_argument("--latency-ms", type=float, default=settings.latency_ms)
+    parser.add_argument("--latency-per-1k-tokens-ms", type=float, default=settings.latency_per_1k_tokens_ms)
+    parser.add_argument("--token-latency-ms", type=float, default=settings.token_latency_ms)
+    parser.add_argument("--completion-words", type=int, default=settings.completion_words)
+    parser.add_argument("--rpm", type=int, default=settings.rpm, help="Requests per minute per model, 0 for unlimited")
+    parser.add_argument("--tpm", type=int, default=settings.tpm, help="Tokens per minute per model, 0 for unlimited")
+    args = parser.parse_args()
+    for name, value in vars(args).items():
+        if name != "port":
+            setattr(settings, name, value)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
@@ -0,0 +1,153 @@
+"""In-memory stand-in for the S3 object API used by the services, addressed path style.
+
+    python fake_s3.py --port 8091
+
+Supports put, multipart upload, get (with ranges), head and delete of objects. Buckets are
+created on first write and requests are not authenticated.
+"""
+import argparse
+import hashlib
+import re
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from typing import Dict, Optional, Tuple
+from xml.sax.saxutils import escape
+
+import uvicorn
+from fastapi import FastAPI, Request, Response
+
+
+@dataclass
+class StoredObject:
+    data: bytes
+    etag: str
+    last_modified: datetime
+
+
+app = FastAPI()
+objects: Dict[Tuple[str, str], StoredObject] = {}
+# Parts of multipart uploads in progress, by upload id
+uploads: Dict[str, Dict[int, bytes]] = {}
+
+
+def xml_response(body: str, status_code: int = 200) -> Response:
+    return Response(
+        f'<?xml version="1.0" encoding="UTF-8"?>\n{body}',
+        status_code=status_code,
+        media_type="application/xml",
+    )
+
+
+def no_such_key(key: str) -> Response:
+    return xml_response(
+        f"<Error><Code>NoSuchKey</Code><Message>The specified key does not exist.</Message>"
+        f"<Key>{escape(key)}</Key></Error>",
+        status_code=404,
+    )
+
+
+def object_headers(stored: StoredObject) -> Dict[str, str]:
+    return {
+        "ETag": f'"{stored.etag}"',
+        "Last-Modified": format_datetime(stored.last_modified, usegmt=True),
+        "Accept-Ranges": "bytes",
+    }
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Inclusive byte range of a "bytes=start-end" header"""
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", header or "")
+    if not match:
+        return None
+    start, end = match.groups()
+    if not start:
+        return max(0, size - int(end)), size - 1
+    return int(start), min(int(end), size - 1) if end else size - 1
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+
+@app.put("/{bucket}/{key:path}")
+async def put_object(bucket: str, key: str, request: Request):
+    data = await request.body()
+    upload_id = request.query_params.get("uploadId")
+    if upload_id is not None:
+        if upload_id not in uploads:
+            return xml_response("<Error><Code>NoSuchUpload</Code></Error>", status_code=404)
+        uploads[upload_id][int(request.query_params["partNumber"])] = data
+        return Response(headers={"ETag": f'"{hashlib.md5(data).hexdigest()}"'})
+
+    stored = StoredObject(data, hashlib.md5(data).hexdigest(), datetime.now(timezone.utc))
+    objects[bucket, key] = stored
+    return Response(headers={"ETag": f'"{stored.etag}"'})
+
+
+@app.post("/{bucket}/{key:path}")
+async def post_object(bucket: str, key: str, request: Request):
+    if "uploads" in request.query_params:
+        upload_id = uuid.uuid4().hex
+        uploads[upload_id] = {}
+        return xml_response(
+            f"<InitiateMultipartUploadResult><Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key>"
+            f"<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>"
+        )
+
+    parts = uploads.pop(request.query_params["uploadId"])
+    ordered = [parts[number] for number in sorted(parts)]
+    # Same form as S3's multipart ETags: md5 of the part md5s, then the part count
+    digest = hashlib.md5(b"".join(hashlib.md5(part).digest() for part in ordered)).hexdigest()
+    stored = StoredObject(b"".join(ordered), f"{digest}-{len(ordered)}", datetime.now(timezone.utc))
+    objects[bucket, key] = stored
+    return xml_response(
+        f"<CompleteMultipartUploadResult><Bucket>{escape(bucket)}</Bucket><Key>{escape(key)}</Key>"
+        f'<ETag>"{stored.etag}"</ETag></CompleteMultipartUploadResult>'
+    )
+
+
+@app.get("/{bucket}/{key:path}")
+async def get_object(bucket: str, key: str, request: Request):
+    stored = objects.get((bucket, key))
+    if stored is None:
+        return no_such_key(key)
+
+    headers = object_headers(stored)
+    byte_range = parse_range(request.headers.get("range"), len(stored.data))
+    if byte_range is None:
+        return Response(stored.data, headers=headers, media_type="application/octet-stream")
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{len(stored.data)}"
+    return Response(
+        stored.data[start:end + 1], status_code=206, headers=headers, media_type="application/octet-stream"
+    )
+
+
+@app.head("/{bucket}/{key:path}")
+async def head_object(bucket: str, key: str):
+    stored = objects.get((bucket, key))
+    if stored is None:
+        return Response(status_code=404)
+    headers = object_headers(stored)
+    headers["Content-Length"] = str(len(stored.data))
+    return Response(headers=headers, media_type="application/octet-stream")
+
+
+@app.delete("/{bucket}/{key:path}")
+async def delete_object(bucket: str, key: str, request: Request):
+    upload_id = request.query_params.get("uploadId")
+    if upload_id is not None:
+        uploads.pop(upload_id, None)
+    else:
+        objects.pop((bucket, key), None)
+    return Response(status_code=204)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--port", type=int, default=8091)
+    args = parser.parse_args()
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
@@ -0,0 +1,385 @@
+"""Offline end-to-end benchmark of PDF indexing, search and summaries.
+
+    python run.py --docs 50 --pages 20
+    python run.py --save-baseline
+
+Runs service1 on SQLite and service2 on the in-process NumPy vector store, against the local
+OpenAI and S3 stand-ins in this directory, so no network access is needed. A synthetic corpus
+is uploaded and indexed, then searched and summarized. Results are compared with the stored
+baseline and the exit status is 1 if any metric regressed by more than the tolerance.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from corpus import generate_corpus, generate_queries
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+BASELINE_PATH = os.path.join(BENCH_DIR, "baseline.json")
+STARTUP_TIMEOUT = 60
+JOB_POLL_INTERVAL = 0.2
+WARMUP_QUERIES = 10
+
+# Metrics where a larger value is an improvement; for all others smaller is better
+HIGHER_IS_BETTER = {"upload_docs_per_sec", "index_docs_per_sec"}
+
+UPLOAD_MUTATION = "mutation($files: [Upload!]!) { uploadPdfs(files: $files) { id } }"
+INDEX_MUTATION = "mutation($pdfId: Int!) { indexPdf(pdfId: $pdfId) }"
+JOB_QUERY = "query($id: String!) { job(id: $id) { status error createdAt finishedAt } }"
+SEARCH_QUERY = "query($query: String!, $topK: Int!) { searchPdfs(query: $query, topK: $topK) { id score } }"
+SUMMARY_MUTATION = "mutation($pdfId: Int!) { generateSummary(pdfId: $pdfId) }"
+
+
+class Process:
+    """A benchmarked server running in a subprocess, logging to a file in the work directory"""
+
+    def __init__(self, name: str, args: List[str], cwd: str, env: Dict[str, str], work_dir: str):
+        self.name = name
+        self.log_path = os.path.join(work_dir, f"{name}.log")
+        self._log = open(self.log_path, "w")
+        self.popen = subprocess.Popen(args, cwd=cwd, env=env, stdout=self._log, stderr=subprocess.STDOUT)
+
+    async def wait_ready(self, url: str):
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        async with httpx.AsyncClient() as client:
+            while time.monotonic() < deadline:
+                if self.popen.poll() is not None:
+                    raise Exception(f"{self.name} exited during startup:\n{self.log_tail()}")
+                try:
+                    if (await client.get(url)).status_code < 500:
+                        return
+                except httpx.TransportError:
+                    pass
+                await asyncio.sleep(0.2)
+        raise Exception(f"{self.name} did not start within {STARTUP_TIMEOUT}s:\n{self.log_tail()}")
+
+    def peak_rss_mb(self) -> float:
+        """High water mark of resident memory, summed over the process and its children"""
+        return sum(read_peak_rss(pid) for pid in [self.popen.pid, *descendants(self.popen.pid)]) / 1024
+
+    def log_tail(self, lines: int = 30) -> str:
+        self._log.flush()
+        with open(self.log_path) as f:
+            return "".join(f.readlines()[-lines:])
+
+    def stop(self):
+        if self.popen.poll() is None:
+            self.popen.terminate()
+            try:
+                self.popen.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                self.popen.kill()
+                self.popen.wait()
+        self._log.close()
+
+
+def read_peak_rss(pid: int) -> int:
+    """VmHWM of a process in KiB, 0 if it is gone"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except FileNotFoundError:
+        pass
+    return 0
+
+
+def descendants(pid: int) -> List[int]:
+    children = []
+    try:
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                children.extend(int(child) for child in f.read().split())
+    except FileNotFoundError:
+        return []
+    return children + [grandchild for child in children for grandchild in descendants(child)]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(p / 100 * len(ordered)) - 1))]
+
+
+def check_tokenizer():
+    """service2 counts tokens with tiktoken, whose encoding files are downloaded on first use"""
+    import tiktoken
+
+    try:
+        tiktoken.encoding_for_model("gpt-4")
+    except Exception as e:
+        raise SystemExit(
+            f"Cannot load the tiktoken encoding offline ({e}). Run once with network access, or point "
+            "TIKTOKEN_CACHE_DIR at a directory holding the cl100k_base file."
+        )
+
+
+async def graphql(client: httpx.AsyncClient, url: str, query: str, variables: Dict[str, Any]) -> Dict[str, Any]:
+    response = await client.post(url, json={"query": query, "variables": variables})
+    response.raise_for_status()
+    result = response.json()
+    if result.get("errors"):
+        raise Exception(f"GraphQL error: {result['errors']}")
+    return result["data"]
+
+
+async def upload(client: httpx.AsyncClient, url: str, pdfs: List[Any]) -> List[int]:
+    """Upload PDFs in one uploadPdfs request, as a GraphQL multipart request"""
+    operations = {"query": UPLOAD_MUTATION, "variables": {"files": [None] * len(pdfs)}}
+    files_map = {str(i): [f"variables.files.{i}"] for i in range(len(pdfs))}
+    response = await client.post(
+        url,
+        data={"operations": json.dumps(operations), "map": json.dumps(files_map)},
+        files={str(i): (pdf.filename, pdf.content, "application/pdf") for i, pdf in enumerate(pdfs)},
+    )
+    response.raise_for_status()
+    result = response.json()
+    if result.get("errors"):
+        raise Exception(f"Upload failed: {result['errors']}")
+    return [int(pdf["id"]) for pdf in result["data"]["uploadPdfs"]]
+
+
+async def wait_for_jobs(client: httpx.AsyncClient, url: str, job_ids: List[str]) -> List[Dict[str, Any]]:
+    pending = set(job_ids)
+    finished = []
+    while pending:
+        ids = list(pending)
+        jobs = await asyncio.gather(*(graphql(client, url, JOB_QUERY, {"id": id}) for id in ids))
+        for id, data in zip(ids, jobs):
+            job = data["job"]
+            if job["status"] in ("succeeded", "failed"):
+                pending.discard(id)
+                finished.append(job)
+        if pending:
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+    return finished
+
+
+async def run_workload(args, service1_url: str, service2_url: str) -> Dict[str, float]:
+    metrics: Dict[str, float] = {}
+    async with httpx.AsyncClient(timeout=600) as client:
+        corpus = list(generate_corpus(args.docs, args.pages, args.seed))
+
+        started = time.perf_counter()
+        pdf_ids = []
+        for i in range(0, len(corpus), args.upload_batch):
+            pdf_ids.extend(await upload(client, service1_url, corpus[i:i + args.upload_batch]))
+        metrics["upload_docs_per_sec"] = len(pdf_ids) / (time.perf_counter() - started)
+        print(f"Uploaded {len(pdf_ids)} PDFs")
+
+        job_ids = [
+            data["indexPdf"]
+            for data in await asyncio.gather(
+                *(graphql(client, service2_url, INDEX_MUTATION, {"pdfId": id}) for id in pdf_ids)
+            )
+        ]
+        jobs = await wait_for_jobs(client, service2_url, job_ids)
+        failed = [job for job in jobs if job["status"] == "failed"]
+        if failed:
+            raise Exception(f"{len(failed)} index jobs failed, e.g.: {failed[0]['error']}")
+        # Job timestamps are recorded by service2, so polling delay does not count
+        first_created = min(datetime.fromisoformat(job["createdAt"]) for job in jobs)
+        last_finished = max(datetime.fromisoformat(job["finishedAt"]) for job in jobs)
+        metrics["index_docs_per_sec"] = len(jobs) / (last_finished - first_created).total_seconds()
+        print(f"Indexed {len(jobs)} PDFs")
+
+        queries = generate_queries(WARMUP_QUERIES + args.queries, args.seed)
+        for query in queries[:WARMUP_QUERIES]:
+            await graphql(client, service2_url, SEARCH_QUERY, {"query": query, "topK": args.top_k})
+
+        semaphore = asyncio.Semaphore(args.search_concurrency)
+        latencies: List[float] = []
+
+        async def search(query: str):
+            async with semaphore:
+                started = time.perf_counter()
+                await graphql(client, service2_url, SEARCH_QUERY, {"query": query, "topK": args.top_k})
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        await asyncio.gather(*(search(query) for query in queries[WARMUP_QUERIES:]))
+        metrics["search_p50_ms"] = percentile(latencies, 50)
+        metrics["search_p99_ms"] = percentile(latencies, 99)
+        print(f"Ran {len(latencies)} searches")
+
+        latencies = []
+        for pdf_id in pdf_ids[:args.summaries]:
+            started = time.perf_counter()
+            await graphql(client, service2_url, SUMMARY_MUTATION, {"pdfId": pdf_id})
+            latencies.append((time.perf_counter() - started) * 1000)
+        if latencies:
+            metrics["summary_p50_ms"] = percentile(latencies, 50)
+            metrics["summary_max_ms"] = max(latencies)
+            print(f"Generated {len(latencies)} summaries")
+    return metrics
+
+
+async def benchmark(args, work_dir: str) -> Dict[str, float]:
+    openai_port, s3_port, service1_port, service2_port = (free_port() for _ in range(4))
+    openai_url = f"http://127.0.0.1:{openai_port}"
+    s3_url = f"http://127.0.0.1:{s3_port}"
+    service1_url = f"http://127.0.0.1:{service1_port}/graphql"
+    service2_url = f"http://127.0.0.1:{service2_port}/graphql"
+
+    env = {
+        **os.environ,
+        "AWS_ACCESS_KEY_ID": "bench",
+        "AWS_SECRET_ACCESS_KEY": "bench",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "BUCKET_NAME": "bench",
+        "S3_ENDPOINT_URL": s3_url,
+    }
+    # Spans would only be exported to an unreachable collector
+    env.pop("OTEL_EXPORTER_OTLP_ENDPOINT", None)
+    service1_env = {**env, "DATABASE_URL": f"sqlite+aiosqlite:///{work_dir}/service1.db"}
+    service1_env.pop("DATABASE_READ_URL", None)
+    service2_env = {
+        **env,
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": f"{openai_url}/v1",
+        "SERVICE1_GRAPHQL_URL": service1_url,
+        "VECTOR_STORE": "numpy",
+        "VECTOR_STORE_PATH": os.path.join(work_dir, "vector_store"),
+        "JOBS_DATABASE_URL": f"sqlite+aiosqlite:///{work_dir}/jobs.db",
+        # A model that accepts the dimensions parameter, so any --dimension is valid
+        "EMBEDDING_MODEL": "text-embedding-3-small",
+        "EMBEDDING_DIMENSION": str(args.dimension),
+    }
+    # Embeddings must come from the stand-in, not a cache of an earlier run
+    service2_env.pop("EMBEDDING_CACHE_PATH", None)
+
+    def uvicorn(port: int) -> List[str]:
+        return [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"]
+
+    openai_args = [
+        sys.executable, "fake_openai.py", "--port", str(openai_port),
+        "--dimension", str(args.dimension),
+        "--latency-ms", str(args.openai_latency_ms),
+        "--token-latency-ms", str(args.openai_token_latency_ms),
+        "--rpm", str(args.openai_rpm),
+        "--tpm", str(args.openai_tpm),
+    ]
+    processes: List[Process] = []
+    try:
+        processes.append(Process("fake_openai", openai_args, BENCH_DIR, env, work_dir))
+        processes.append(Process("fake_s3", [sys.executable, "fake_s3.py", "--port", str(s3_port)], BENCH_DIR, env, work_dir))
+        service1 = Process("service1", uvicorn(service1_port), os.path.join(ROOT_DIR, "service1"), service1_env, work_dir)
+        processes.append(service1)
+        service2 = Process("service2", uvicorn(service2_port), os.path.join(ROOT_DIR, "service2"), service2_env, work_dir)
+        processes.append(service2)
+        await asyncio.gather(
+            processes[0].wait_ready(f"{openai_url}/health"),
+            processes[1].wait_ready(f"{s3_url}/health"),
+            service1.wait_ready(f"http://127.0.0.1:{service1_port}/metrics"),
+            service2.wait_ready(f"http://127.0.0.1:{service2_port}/metrics"),
+        )
+
+        try:
+            metrics = await run_workload(args, service1_url, service2_url)
+        except Exception:
+            for process in processes:
+                print(f"--- {process.name} log ---\n{process.log_tail()}", file=sys.stderr)
+            raise
+        metrics["service1_peak_rss_mb"] = service1.peak_rss_mb()
+        metrics["service2_peak_rss_mb"] = service2.peak_rss_mb()
+        return metrics
+    finally:
+        for process in reversed(processes):
+            process.stop()
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> bool:
+    """Print each metric next to the baseline; False if any regressed beyond the tolerance"""
+    ok = True
+    print(f"\n{'metric':<24}{'value':>12}{'baseline':>12}{'change':>10}")
+    for name, value in results["metrics"].items():
+        base = baseline.get("metrics", {}).get(name)
+        if not base:
+            print(f"{name:<24}{value:>12.2f}{'-':>12}")
+            continue
+        change = (value - base) / base
+        regressed = -change > tolerance if name in HIGHER_IS_BETTER else change > tolerance
+        ok = ok and not regressed
+        print(f"{name:<24}{value:>12.2f}{base:>12.2f}{change:>+10.1%}{'  REGRESSED' if regressed else ''}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--docs", type=int, default=50, help="PDFs in the corpus")
+    parser.add_argument("--pages", type=int, default=20, help="Pages per PDF")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--upload-batch", type=int, default=10, help="PDFs per uploadPdfs request")
+    parser.add_argument("--queries", type=int, default=200, help="Timed searchPdfs requests")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--search-concurrency", type=int, default=4)
+    parser.add_argument("--summaries", type=int, default=5, help="PDFs summarized one after another")
+    parser.add_argument("--dimension", type=int, default=1536, help="Embedding dimension")
+    parser.add_argument("--openai-latency-ms", type=float, default=50)
+    parser.add_argument("--openai-token-latency-ms", type=float, default=0)
+    parser.add_argument("--openai-rpm", type=int, default=0, help="0 for unlimited")
+    parser.add_argument("--openai-tpm", type=int, default=0, help="0 for unlimited")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression per metric")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    parser.add_argument("--keep-work-dir", action="store_true", help="Keep databases, vectors and logs")
+    args = parser.parse_args()
+
+    check_tokenizer()
+    work_dir = tempfile.mkdtemp(prefix="pdf-bench-")
+    try:
+        metrics = asyncio.run(benchmark(args, work_dir))
+    finally:
+        if args.keep_work_dir:
+            print(f"Work directory: {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    config = {
+        name: value
+        for name, value in vars(args).items()
+        if name not in ("baseline", "save_baseline", "tolerance", "output", "keep_work_dir")
+    }
+    results = {"config": config, "metrics": metrics}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    baseline: Optional[Dict[str, Any]] = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    if baseline is not None and baseline.get("config") != config:
+        print("Warning: the baseline was recorded with different settings, not comparing")
+        baseline = None
+
+    ok = compare(results, baseline or {}, args.tolerance)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,96 @@
 import os
+import time
 from sqlmodel import SQLModel
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 from contextlib import asynccontextmanager
 
+from metrics import DB_POOL_CHECKED_OUT, DB_POOL_CHECKOUT_SECONDS, DB_QUERY_SECONDS, get_tracer
+
 
 DATABASE_URL = os.getenv('DATABASE_URL')
-engine = create_async_engine(DATABASE_URL, echo=True)
+# Optional read replica for read-only resolvers
+DATABASE_READ_URL = os.getenv('DATABASE_READ_URL')
+DB_ECHO = os.getenv('DB_ECHO', 'false').lower() == 'true'
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '20'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+# Prepared statements asyncpg keeps per connection
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', '500'))
+
+def create_engine(url: str, role: str) -> AsyncEngine:
+    options = {'echo': DB_ECHO, 'pool_pre_ping': True}
+    if not url.startswith('sqlite'):
+        # SQLite uses a NullPool/StaticPool that takes no sizing options
+        options.update(
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+        )
+    if url.startswith('postgresql+asyncpg'):
+        options['connect_args'] = {'prepared_statement_cache_size': DB_STATEMENT_CACHE_SIZE}
+
+    engine = create_async_engine(url, **options)
+    instrument_engine(engine, role)
+    return engine
+
+def statement_verb(statement: str) -> str:
+    return statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'OTHER'
+
+def instrument_engine(engine: AsyncEngine, role: str):
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._query_started = time.perf_counter()
+        tracer = get_tracer()
+        context._query_span = tracer.start_span(
+            f'db.{statement_verb(statement)}', attributes={'db.role': role, 'db.statement': statement}
+        ) if tracer else None
+
+    @event.listens_for(sync_engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        DB_QUERY_SECONDS.labels(role, statement_verb(statement)).observe(
+            time.perf_counter() - context._query_started
+        )
+        if context._query_span is not None:
+            context._query_span.end()
+
+    if hasattr(sync_engine.pool, 'checkedout'):
+        DB_POOL_CHECKED_OUT.labels(role).set_function(sync_engine.pool.checkedout)
+
+engine = create_engine(DATABASE_URL, 'primary')
+read_engine = create_engine(DATABASE_READ_URL, 'replica') if DATABASE_READ_URL else engine
+
+async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+read_session = sessionmaker(read_engine, class_=AsyncSession, expire_on_commit=False)
+
+def has_read_replica() -> bool:
+    return read_engine is not engine
 
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(SQLModel.metadata.create_all)
+        if conn.dialect.name == "postgresql":
+            # create_all doesn't add columns to existing tables
+            await conn.execute(text("ALTER TABLE pdf ADD COLUMN IF NOT EXISTS summary_key VARCHAR"))
+        # Matches the (upload_date, id) keyset used to page through Query.pdfs
+        await conn.execute(
+            text("CREATE INDEX IF NOT EXISTS ix_pdf_upload_date_id ON pdf (upload_date DESC, id DESC)")
+        )
 
 @asynccontextmanager
-async def get_session():
-    async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
-    async with async_session() as session:
-        yield session
\ No newline at end of file
+async def get_session(readonly: bool = False):
+    """Session on the primary, or on the read replica (if configured) for readonly work"""
+    session_factory = read_session if readonly else async_session
+    async with session_factory() as session:
+        # Check out the connection up front so pool wait time can be measured
+        started = time.perf_counter()
+        await session.connection()
+        DB_POOL_CHECKOUT_SECONDS.labels('replica' if readonly and DATABASE_READ_URL else 'primary').observe(
+            time.perf_counter() - started
+        )
+        yield session
@@ -1,9 +1,13 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from strawberry.fastapi import GraphQLRouter
 
-from schema import schema
+from schema import create_pdf_loader, schema
 from database import init_db
+from metrics import server_span, setup_tracing
+
+setup_tracing()
 
 app = FastAPI()
 
@@ -16,11 +20,24 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    # Continues traces started in service2, which forwards its traceparent header
+    with server_span(f"{request.method} {request.url.path}", request.headers):
+        return await call_next(request)
+
 @app.on_event("startup")
 async def startup_event():
     await init_db()
 
-graphql_app = GraphQLRouter(schema)
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+async def get_context():
+    return {"pdf_loader": create_pdf_loader()}
+
+graphql_app = GraphQLRouter(schema, context_getter=get_context)
 app.include_router(graphql_app, prefix="/graphql")
 
 if __name__ == "__main__":
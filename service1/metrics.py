@@ -0,0 +1,114 @@
+import os
+import time
+from contextlib import contextmanager
+from inspect import isawaitable
+from typing import Iterator, Mapping
+
+from prometheus_client import Gauge, Histogram
+from strawberry.extensions import Extension
+
+try:
+    from opentelemetry import trace
+    from opentelemetry.propagate import extract
+except ImportError:  # Tracing is optional
+    trace = None
+
+# Spans are recorded when OpenTelemetry is installed and an OTLP endpoint is configured
+TRACING_ENABLED = trace is not None and bool(os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT"))
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "service1")
+
+
+DB_POOL_CHECKOUT_SECONDS = Histogram(
+    "db_pool_checkout_seconds",
+    "Time spent waiting for a database connection from the pool",
+    ["role"],
+)
+DB_QUERY_SECONDS = Histogram(
+    "db_query_seconds",
+    "Database statement execution time",
+    ["role", "statement"],
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out_connections",
+    "Database connections currently checked out of the pool",
+    ["role"],
+)
+S3_SECONDS = Histogram("s3_request_seconds", "S3 request time", ["operation"])
+GRAPHQL_SECONDS = Histogram(
+    "graphql_resolver_seconds", "Time of top-level GraphQL fields", ["field"]
+)
+
+
+def setup_tracing():
+    """Export spans over OTLP when tracing is enabled; the SDK and exporter packages are optional"""
+    if not TRACING_ENABLED:
+        return
+    from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+    provider = TracerProvider(resource=Resource.create({"service.name": SERVICE_NAME}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+
+
+def get_tracer():
+    return trace.get_tracer(SERVICE_NAME) if TRACING_ENABLED else None
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[None]:
+    if not TRACING_ENABLED:
+        yield
+        return
+    with get_tracer().start_as_current_span(name, attributes=attributes):
+        yield
+
+
+@contextmanager
+def server_span(name: str, headers: Mapping[str, str]) -> Iterator[None]:
+    """Span for an incoming request, continuing the caller's trace from its traceparent header"""
+    if not TRACING_ENABLED:
+        yield
+        return
+    with get_tracer().start_as_current_span(
+        name, context=extract(headers), kind=trace.SpanKind.SERVER
+    ):
+        yield
+
+
+@contextmanager
+def timed(name: str, histogram: Histogram, *labels: str, **attributes) -> Iterator[None]:
+    """Observe the block's duration in histogram, inside a span when tracing is enabled"""
+    with span(name, **attributes):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            metric = histogram.labels(*labels) if labels else histogram
+            metric.observe(time.perf_counter() - started)
+
+
+class MetricsExtension(Extension):
+    """Times top-level GraphQL fields"""
+
+    def resolve(self, _next, root, info, *args, **kwargs):
+        if info.path.prev is not None:
+            return _next(root, info, *args, **kwargs)
+
+        field = info.field_name
+        started = time.perf_counter()
+        result = _next(root, info, *args, **kwargs)
+        if not isawaitable(result):
+            GRAPHQL_SECONDS.labels(field).observe(time.perf_counter() - started)
+            return result
+
+        async def timed_result():
+            with span(f"graphql.{field}"):
+                try:
+                    return await result
+                finally:
+                    GRAPHQL_SECONDS.labels(field).observe(time.perf_counter() - started)
+
+        return timed_result()
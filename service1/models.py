@@ -8,5 +8,7 @@ class PDF(SQLModel, table=True):
     filename: str
     s3_url: str
     summary: Optional[str] = Field(default=None)
+    # Identifies the PDF content and summarization config the summary was generated from
+    summary_key: Optional[str] = Field(default=None)
     upload_date: datetime = Field(default_factory=datetime.utcnow)
     
\ No newline at end of file
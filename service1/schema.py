@@ -1,74 +1,208 @@
+import asyncio
+import base64
 import strawberry
+from strawberry.dataloader import DataLoader
 from strawberry.file_uploads import Upload
-from typing import Optional
+from strawberry.types import Info
+from strawberry.types.nodes import SelectedField, Selection
+from typing import Dict, List, Optional, Set, Tuple
 from datetime import datetime
-import boto3
-import os
+from sqlalchemy import func, tuple_
+from sqlalchemy.orm import defer
 from sqlmodel import select, update
 
 from models import PDF
-from database import get_session
+from database import get_session, has_read_replica
+from storage import s3_storage
+from metrics import MetricsExtension
 
 
-BUCKET_NAME = os.getenv('BUCKET_NAME')
+PDFS_PAGE_SIZE = 50
+PDFS_MAX_PAGE_SIZE = 200
 
-@strawberry.type
+@strawberry.federation.type(keys=["id"])
 class PDFType:
     id: int
     filename: str
     s3_url: str
     summary: Optional[str]
+    summary_key: Optional[str]
     upload_date: datetime
 
-def convert_to_strawberry_type(pdf: PDF) -> PDFType:
+    @classmethod
+    async def resolve_reference(cls, info: Info, id: strawberry.ID) -> Optional["PDFType"]:
+        return await info.context["pdf_loader"].load(int(id))
+
+@strawberry.type
+class PDFPage:
+    items: List[PDFType]
+    next_cursor: Optional[str]
+    has_next_page: bool
+
+def convert_to_strawberry_type(pdf: PDF, include_summary: bool = True) -> PDFType:
     return PDFType(
         id=pdf.id,
         filename=pdf.filename,
         s3_url=pdf.s3_url,
-        summary=pdf.summary,
+        # A deferred summary must not be touched, it would trigger a lazy load
+        summary=pdf.summary if include_summary else None,
+        summary_key=pdf.summary_key,
         upload_date=pdf.upload_date
     )
 
+def encode_cursor(pdf: PDF) -> str:
+    return base64.urlsafe_b64encode(f"{pdf.upload_date.isoformat()}|{pdf.id}".encode()).decode()
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        upload_date, pdf_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(upload_date), int(pdf_id)
+    except ValueError:  # Bad base64, text or cursor fields; binascii.Error is a ValueError too
+        raise Exception(f"Invalid cursor: {cursor}") from None
+
+def selected_field_names(selections: List[Selection]) -> Set[str]:
+    """Names of the fields selected at this level, looking through fragments"""
+    names = set()
+    for selection in selections:
+        if isinstance(selection, SelectedField):
+            names.add(selection.name)
+        else:
+            names |= selected_field_names(selection.selections)
+    return names
+
+def selected_subfields(selections: List[Selection], name: str) -> List[Selection]:
+    subfields = []
+    for selection in selections:
+        if isinstance(selection, SelectedField):
+            if selection.name == name:
+                subfields.extend(selection.selections)
+        else:
+            subfields.extend(selected_subfields(selection.selections, name))
+    return subfields
+
+async def load_pdfs(pdf_ids: List[int]) -> List[Optional[PDFType]]:
+    """Batch load function: one WHERE id IN (...) query for all keys of a tick.
+
+    Reads from the replica, then looks up ids it doesn't have on the primary: service2 fetches
+    a PDF right after it is uploaded, before replication may have caught up.
+    """
+    async with get_session(readonly=True) as session:
+        result = await session.execute(select(PDF).where(PDF.id.in_(set(pdf_ids))))
+        pdfs: Dict[int, PDF] = {pdf.id: pdf for pdf in result.scalars().all()}
+    missing = set(pdf_ids) - pdfs.keys()
+    if missing and has_read_replica():
+        async with get_session() as session:
+            result = await session.execute(select(PDF).where(PDF.id.in_(missing)))
+            pdfs.update((pdf.id, pdf) for pdf in result.scalars().all())
+    return [convert_to_strawberry_type(pdfs[pdf_id]) if pdf_id in pdfs else None for pdf_id in pdf_ids]
+
+def create_pdf_loader() -> DataLoader:
+    """One loader per request, so its cache never outlives the request"""
+    return DataLoader(load_fn=load_pdfs)
+
+async def upload_files(files: List[Upload]) -> List[PDFType]:
+    keys = [s3_storage.new_key(file.filename) for file in files]
+    # Upload to S3 concurrently without blocking the event loop
+    results = await asyncio.gather(
+        *(s3_storage.upload(file.file, key) for file, key in zip(files, keys)),
+        return_exceptions=True,
+    )
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        await delete_uploads([key for key, result in zip(keys, results) if not isinstance(result, Exception)])
+        raise errors[0]
+
+    try:
+        async with get_session() as session:
+            # Create all PDF records in one transaction
+            pdfs = [PDF(filename=file.filename, s3_url=s3_url) for file, s3_url in zip(files, results)]
+            session.add_all(pdfs)
+            await session.commit()
+    except Exception:
+        await delete_uploads(keys)
+        raise
+
+    return [convert_to_strawberry_type(pdf) for pdf in pdfs]
+
+async def delete_uploads(keys: List[str]):
+    """Don't leave objects behind that no PDF record points to; the keys are this request's own"""
+    await asyncio.gather(*(s3_storage.delete(key) for key in keys), return_exceptions=True)
+
 @strawberry.type
 class Query:
     @strawberry.field
-    async def pdfs(self) -> list[PDFType]:
-        async with get_session() as session:
-            statement = select(PDF).order_by(PDF.upload_date.desc())
+    async def pdfs(
+        self,
+        info: Info,
+        first: int = PDFS_PAGE_SIZE,
+        after: Optional[str] = None,
+        filename: Optional[str] = None,
+        uploaded_after: Optional[datetime] = None,
+        uploaded_before: Optional[datetime] = None,
+    ) -> PDFPage:
+        first = max(1, min(first, PDFS_MAX_PAGE_SIZE))
+
+        # Newest first; id breaks ties so the (upload_date, id) keyset is unique
+        statement = (
+            select(PDF)
+            .order_by(PDF.upload_date.desc(), PDF.id.desc())
+            .limit(first + 1)
+        )
+        if after:
+            statement = statement.where(tuple_(PDF.upload_date, PDF.id) < decode_cursor(after))
+        if filename:
+            statement = statement.where(
+                func.lower(PDF.filename).contains(filename.lower(), autoescape=True)
+            )
+        if uploaded_after:
+            statement = statement.where(PDF.upload_date >= uploaded_after)
+        if uploaded_before:
+            statement = statement.where(PDF.upload_date < uploaded_before)
+
+        # Only load the potentially large summary text when the client asked for it
+        # info.selected_fields holds the pdfs field itself, so items is among its selections
+        page_fields = [selection for field in info.selected_fields for selection in field.selections]
+        item_fields = selected_field_names(selected_subfields(page_fields, "items"))
+        include_summary = "summary" in item_fields
+        if not include_summary:
+            statement = statement.options(defer(PDF.summary))
+
+        async with get_session(readonly=True) as session:
             result = await session.execute(statement)
             pdfs = result.scalars().all()
-            return [convert_to_strawberry_type(pdf) for pdf in pdfs]
+
+        has_next_page = len(pdfs) > first
+        pdfs = pdfs[:first]
+        return PDFPage(
+            items=[convert_to_strawberry_type(pdf, include_summary) for pdf in pdfs],
+            next_cursor=encode_cursor(pdfs[-1]) if has_next_page else None,
+            has_next_page=has_next_page,
+        )
 
     @strawberry.field
-    async def pdf(self, pdf_id: int) -> Optional[PDFType]:
-        async with get_session() as session:
-            statement = select(PDF).where(PDF.id == pdf_id)
-            result = await session.execute(statement)
-            pdf = result.scalar_one_or_none()
-            return convert_to_strawberry_type(pdf) if pdf else None
+    async def pdf(self, info: Info, pdf_id: int) -> Optional[PDFType]:
+        return await info.context["pdf_loader"].load(pdf_id)
+
+    @strawberry.field
+    async def pdfs_by_ids(self, info: Info, pdf_ids: List[int]) -> List[Optional[PDFType]]:
+        """Bulk lookup in request order, null for ids that don't exist"""
+        return await info.context["pdf_loader"].load_many(pdf_ids)
 
 @strawberry.type
 class Mutation:
     @strawberry.mutation
     async def upload_pdf(self, file: Upload) -> PDFType:
-        s3 = boto3.client("s3")
+        [pdf] = await upload_files([file])
+        return pdf
 
-        # Upload to S3
-        filename = file.filename
-        s3.upload_fileobj(file.file, BUCKET_NAME, filename)
-        s3_url = f"s3://{BUCKET_NAME}/{filename}"
-
-        async with get_session() as session:
-            # Create PDF record
-            pdf = PDF(filename=filename, s3_url=s3_url)
-            session.add(pdf)
-            await session.commit()
-            await session.refresh(pdf)
-
-        return convert_to_strawberry_type(pdf)
+    @strawberry.mutation
+    async def upload_pdfs(self, files: List[Upload]) -> List[PDFType]:
+        return await upload_files(files)
 
     @strawberry.mutation
-    async def update_pdf_summary(self, pdf_id: int, summary: str) -> Optional[PDFType]:
+    async def update_pdf_summary(
+        self, pdf_id: int, summary: str, summary_key: Optional[str] = None
+    ) -> Optional[PDFType]:
         async with get_session() as session:
             # Find the PDF
             statement = select(PDF).where(PDF.id == pdf_id)
@@ -80,6 +214,7 @@ class Mutation:
 
             # Update the summary
             pdf.summary = summary
+            pdf.summary_key = summary_key
             await session.commit()
             await session.refresh(pdf)
 
@@ -94,8 +229,7 @@ class Mutation:
 
             if pdf:
                 # Delete from S3
-                s3 = boto3.client("s3")
-                s3.delete_object(Bucket=BUCKET_NAME, Key=pdf.filename)
+                await s3_storage.delete(s3_storage.key_from_url(pdf.s3_url))
 
                 # Delete from database
                 await session.delete(pdf)
@@ -103,4 +237,4 @@ class Mutation:
                 return True
             return False
 
-schema = strawberry.federation.Schema(query=Query, mutation=Mutation)
+schema = strawberry.federation.Schema(query=Query, mutation=Mutation, extensions=[MetricsExtension])
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.client import Config
+
+from metrics import S3_SECONDS, timed
+
+
+BUCKET_NAME = os.getenv('BUCKET_NAME')
+# Files uploaded at once by a batch upload
+S3_UPLOAD_CONCURRENCY = int(os.getenv('S3_UPLOAD_CONCURRENCY', '8'))
+# Parts uploaded in parallel for a single multipart upload
+S3_PART_CONCURRENCY = int(os.getenv('S3_PART_CONCURRENCY', '4'))
+S3_MULTIPART_CHUNKSIZE = int(os.getenv('S3_MULTIPART_CHUNKSIZE', str(8 * 1024 * 1024)))
+# S3 compatible endpoint (e.g. MinIO or the benchmark stand-in), addressed path style
+S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL')
+
+
+class S3Storage:
+    """Shared S3 client whose blocking transfers run on a dedicated thread pool"""
+
+    def __init__(self, bucket_name: str = BUCKET_NAME):
+        self.bucket_name = bucket_name
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=S3_ENDPOINT_URL,
+            config=Config(
+                # Room for every part of every concurrent upload
+                max_pool_connections=S3_UPLOAD_CONCURRENCY * S3_PART_CONCURRENCY,
+                tcp_keepalive=True,
+                s3={"addressing_style": "path"} if S3_ENDPOINT_URL else None,
+            ),
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=S3_MULTIPART_CHUNKSIZE,
+            multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+            max_concurrency=S3_PART_CONCURRENCY,
+        )
+        # The pool size is what bounds the number of files uploading at once
+        self._executor = ThreadPoolExecutor(
+            max_workers=S3_UPLOAD_CONCURRENCY, thread_name_prefix="s3"
+        )
+
+    async def _run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: fn(*args, **kwargs))
+
+    def new_key(self, filename: str) -> str:
+        """A key of its own per upload, so PDFs with the same filename never share an object"""
+        return f"{uuid.uuid4().hex}/{filename}"
+
+    def key_from_url(self, s3_url: str) -> str:
+        """Object key of an s3://bucket/key URL; PDFs uploaded before new_key used the filename"""
+        return s3_url.split("/", 3)[3]
+
+    async def upload(self, fileobj: BinaryIO, key: str) -> str:
+        """Stream a file to S3, as a multipart upload if it is large, and return its URL"""
+        with timed('s3.upload', S3_SECONDS, 'upload', key=key):
+            await self._run(
+                self.client.upload_fileobj,
+                fileobj,
+                self.bucket_name,
+                key,
+                Config=self.transfer_config,
+            )
+        return f"s3://{self.bucket_name}/{key}"
+
+    async def delete(self, key: str):
+        with timed('s3.delete', S3_SECONDS, 'delete', key=key):
+            await self._run(self.client.delete_object, Bucket=self.bucket_name, Key=key)
+
+
+s3_storage = S3Storage()
@@ -0,0 +1,142 @@
+"""Run with: python -m unittest test_schema (from service1, with aiosqlite installed)"""
+import os
+import tempfile
+import unittest
+
+# database reads DATABASE_URL at import time
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/test.db"
+
+from unittest import mock
+
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlmodel import SQLModel
+
+import database
+from database import engine, get_session, init_db
+from models import PDF
+from schema import create_pdf_loader, schema, upload_files
+from storage import s3_storage
+
+
+PDFS_QUERY = """
+query($after: String) {
+    pdfs(first: 2, after: $after) { items { id filename summary } nextCursor hasNextPage }
+}
+"""
+
+
+class PDFsQueryTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await init_db()
+        async with get_session() as session:
+            session.add_all(
+                [PDF(filename=f"paper_{i}.pdf", s3_url=f"s3://bucket/paper_{i}.pdf", summary=f"Summary {i}") for i in range(3)]
+            )
+            await session.commit()
+
+    async def asyncTearDown(self):
+        await engine.dispose()
+
+    async def test_selected_summary_is_returned(self):
+        result = await schema.execute(PDFS_QUERY, variable_values={"after": None})
+        self.assertIsNone(result.errors)
+        items = result.data["pdfs"]["items"]
+        self.assertEqual(len(items), 2)
+        for item in items:
+            self.assertEqual(item["summary"], f"Summary {item['filename'][6:-4]}")
+
+    async def test_summary_selected_through_fragment(self):
+        query = """
+        query { pdfs(first: 1) { ...Page } }
+        fragment Page on PDFPage { items { ... on PDFType { summary } } }
+        """
+        result = await schema.execute(query)
+        self.assertIsNone(result.errors)
+        self.assertIsNotNone(result.data["pdfs"]["items"][0]["summary"])
+
+    async def test_invalid_cursor(self):
+        for cursor in ["not base64!", "bm90IGEgY3Vyc29y", "//79"]:
+            result = await schema.execute(PDFS_QUERY, variable_values={"after": cursor})
+            self.assertEqual(len(result.errors), 1)
+            self.assertTrue(result.errors[0].message.startswith("Invalid cursor"))
+
+
+class PDFLookupTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await init_db()
+        async with get_session() as session:
+            self.pdf = PDF(filename="new.pdf", s3_url="s3://bucket/new.pdf")
+            session.add(self.pdf)
+            await session.commit()
+
+        # A replica that hasn't replicated the new row yet
+        self.replica = create_async_engine(f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/replica.db")
+        async with self.replica.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+        replica_session = sessionmaker(self.replica, class_=AsyncSession, expire_on_commit=False)
+        self.patches = [
+            mock.patch.object(database, "read_engine", self.replica),
+            mock.patch.object(database, "read_session", replica_session),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    async def asyncTearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        await self.replica.dispose()
+        await engine.dispose()
+
+    async def test_lagging_replica_falls_back_to_primary(self):
+        query = "query($ids: [Int!]!) { pdfsByIds(pdfIds: $ids) { id filename } }"
+        result = await schema.execute(
+            query, variable_values={"ids": [self.pdf.id, 999999]}, context_value={"pdf_loader": create_pdf_loader()}
+        )
+        self.assertIsNone(result.errors)
+        self.assertEqual(result.data["pdfsByIds"], [{"id": self.pdf.id, "filename": "new.pdf"}, None])
+
+
+class UploadTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await init_db()
+        self.objects = {}
+
+        async def upload(fileobj, key):
+            self.objects[key] = fileobj
+            return f"s3://bucket/{key}"
+
+        async def delete(key):
+            self.objects.pop(key, None)
+
+        self.patches = [
+            mock.patch.object(s3_storage, "upload", upload),
+            mock.patch.object(s3_storage, "delete", delete),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    async def asyncTearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        await engine.dispose()
+
+    def upload(self, filename):
+        return mock.Mock(file=object(), filename=filename)
+
+    async def test_same_filename_gets_its_own_object(self):
+        [first] = await upload_files([self.upload("paper.pdf")])
+        [second] = await upload_files([self.upload("paper.pdf")])
+        self.assertNotEqual(first.s3_url, second.s3_url)
+        self.assertEqual(len(self.objects), 2)
+
+    async def test_failed_commit_deletes_only_this_requests_objects(self):
+        [existing] = await upload_files([self.upload("paper.pdf")])
+        with mock.patch.object(AsyncSession, "commit", side_effect=Exception("commit failed")):
+            with self.assertRaises(Exception):
+                await upload_files([self.upload("paper.pdf"), self.upload("other.pdf")])
+        self.assertEqual([f"s3://bucket/{key}" for key in self.objects], [existing.s3_url])
+
+
+if __name__ == "__main__":
+    unittest.main()
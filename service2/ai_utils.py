@@ -1,81 +1,304 @@
-import io
+import asyncio
+import hashlib
 import os
 from dataclasses import dataclass
-from typing import List, Tuple, Union
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Tuple, Union
 import tiktoken
 
 from langchain.schema import Document as LangchainDocument
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_openai import OpenAIEmbeddings
 from openai import AsyncOpenAI
-from pypdf import PdfReader
+
+from embedding_cache import EmbeddingCache, embedding_cache_key
+from index_profiles import EMBEDDING_DIMENSION
+from metrics import (
+    EMBEDDING_BATCH_SECONDS,
+    EMBEDDING_CACHE_LOOKUPS,
+    EMBEDDING_TOKENS,
+    LLM_SECONDS,
+    LLM_TOKENS,
+    PDF_EXTRACTION_SECONDS,
+    PDF_PAGES,
+    StreamTimer,
+    timed,
+)
+from openai_scheduler import (
+    PRIORITY_BULK,
+    PRIORITY_INTERACTIVE,
+    OpenAIScheduler,
+    get_openai_scheduler,
+)
+from pdf_extraction import PDFExtractor, get_pdf_extractor
 
 
 TOKEN_SIZE = 4000
 TOKEN_OVERLAP = 200
 
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-ada-002")
+# Models that can't shorten their embeddings, with the only dimension they produce; other
+# models are asked for EMBEDDING_DIMENSION through the dimensions parameter
+FIXED_EMBEDDING_DIMENSIONS = {"text-embedding-ada-002": 1536}
+# Upper bounds for a single embeddings request (number of inputs and total tokens)
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+EMBEDDING_BATCH_TOKENS = int(os.getenv("EMBEDDING_BATCH_TOKENS", "100000"))
+# Number of embedding requests allowed in flight at once per create_embeddings call
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+# Starting per-minute request and token budgets, until OpenAI's rate limit headers report the real ones
+EMBEDDING_RPM = int(os.getenv("EMBEDDING_RPM", "3000"))
+EMBEDDING_TPM = int(os.getenv("EMBEDDING_TPM", "1000000"))
+
+SUMMARY_MODEL = "gpt-4o-mini"
+# Number of chat completions allowed in flight at once per create_summary call
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "8"))
+# Bound on intermediate reduce rounds before the final summary is forced
+SUMMARY_MAX_REDUCE_LEVELS = 5
+SUMMARY_RPM = int(os.getenv("SUMMARY_RPM", "500"))
+SUMMARY_TPM = int(os.getenv("SUMMARY_TPM", "200000"))
+# Completion tokens reserved per chat call; corrected from the reported usage afterwards
+SUMMARY_COMPLETION_TOKENS = int(os.getenv("SUMMARY_COMPLETION_TOKENS", "1000"))
+
+SUMMARY_SYSTEM_PROMPT = "You are a helpful assistant that creates comprehensive yet concise summaries. Organize the summary with bullet points for key topics and insights. When referencing content, include the page number in brackets [Page X]."
+SUMMARY_USER_PROMPT = "Please provide a comprehensive summary of the following text, focusing on the main points and key takeaways. Include page references when noting key points:\n\n{text}"
+CHUNK_SUMMARY_SYSTEM_PROMPT = "You are a helpful assistant that creates concise summaries of text segments. Include page references [Page X] when noting key points."
+CHUNK_SUMMARY_USER_PROMPT = "Please summarize this text segment, focusing on the main points:\n\n{text}"
+REDUCE_SUMMARY_SYSTEM_PROMPT = "You are a helpful assistant that condenses summaries. Keep the key points and maintain page references [Page X]."
+REDUCE_SUMMARY_USER_PROMPT = "Please combine these section summaries into a single concise summary of the sections, preserving page references:\n\n{text}"
+FINAL_SUMMARY_SYSTEM_PROMPT = "You are a helpful assistant that creates coherent summaries. Organize the final summary with bullet points for key topics and insights. Maintain page references [Page X] for key points."
+FINAL_SUMMARY_USER_PROMPT = "Please provide a coherent, comprehensive summary combining these section summaries, maintaining a clear flow between topics and preserving page references:\n\n{text}"
+
+
+def summary_cache_key(content_hash: str) -> str:
+    """Key a stored summary by the PDF content and everything that shapes the summary"""
+    config = "\0".join(
+        [
+            content_hash,
+            SUMMARY_MODEL,
+            str(TOKEN_SIZE),
+            str(TOKEN_OVERLAP),
+            SUMMARY_SYSTEM_PROMPT,
+            SUMMARY_USER_PROMPT,
+            CHUNK_SUMMARY_SYSTEM_PROMPT,
+            CHUNK_SUMMARY_USER_PROMPT,
+            REDUCE_SUMMARY_SYSTEM_PROMPT,
+            REDUCE_SUMMARY_USER_PROMPT,
+            FINAL_SUMMARY_SYSTEM_PROMPT,
+            FINAL_SUMMARY_USER_PROMPT,
+        ]
+    )
+    return hashlib.sha256(config.encode("utf-8")).hexdigest()
+
+
+def index_cache_key(content_hash: str) -> str:
+    """Key indexed chunks by the PDF content and everything that shapes chunks and embeddings"""
+    config = "\0".join([content_hash, EMBEDDING_MODEL, str(EMBEDDING_DIMENSION), str(TOKEN_SIZE), str(TOKEN_OVERLAP)])
+    return hashlib.sha256(config.encode("utf-8")).hexdigest()
+
+
+def page_content_hash(page: "PageChunk") -> str:
+    """Hash of one page's text and number under the current chunking and embedding settings"""
+    config = "\0".join(
+        [EMBEDDING_MODEL, str(EMBEDDING_DIMENSION), str(TOKEN_SIZE), str(TOKEN_OVERLAP), str(page.page_num), page.content]
+    )
+    return hashlib.sha256(config.encode("utf-8")).hexdigest()
+
 
 @dataclass
 class PageChunk:
     content: str
     page_num: int
+    # Position of a split chunk within its page, and the hash of the page it came from
+    chunk_index: int = 0
+    page_hash: Optional[str] = None
+
+
+@dataclass
+class SummaryEvent:
+    """Progress of a map/reduce stage, or a piece of the summary text as the model produces it"""
+
+    kind: str  # "progress", "token" or "done"
+    stage: str  # "map", "reduce", "summary" or "final"
+    text: str = ""
+    completed: int = 0
+    total: int = 0
+
+
+SummaryCallback = Callable[[SummaryEvent], None]
 
 
 class AIUtils:
-    def __init__(self):
-        self.embeddings = OpenAIEmbeddings()
-        self.client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    def __init__(
+        self,
+        pdf_extractor: Optional[PDFExtractor] = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        scheduler: Optional[OpenAIScheduler] = None,
+    ):
+        # Retries go through the scheduler, so they respect the shared rate limit budget
+        self.client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
         self.text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=TOKEN_SIZE, chunk_overlap=TOKEN_OVERLAP
         )
         # Initialize tokenizer for GPT-4
         self.tokenizer = tiktoken.encoding_for_model("gpt-4")
         self.max_tokens = TOKEN_SIZE  # Conservative limit for GPT-4 input
+        fixed_dimension = FIXED_EMBEDDING_DIMENSIONS.get(EMBEDDING_MODEL)
+        if fixed_dimension is not None and fixed_dimension != EMBEDDING_DIMENSION:
+            raise Exception(
+                f"{EMBEDDING_MODEL} produces {fixed_dimension}-dimensional embeddings, "
+                f"but EMBEDDING_DIMENSION is {EMBEDDING_DIMENSION}"
+            )
+        self.pdf_extractor = pdf_extractor or get_pdf_extractor()
+        self.embedding_cache = embedding_cache or EmbeddingCache()
+        self.scheduler = scheduler or get_openai_scheduler()
+        self.scheduler.configure(EMBEDDING_MODEL, EMBEDDING_RPM, EMBEDDING_TPM)
+        self.scheduler.configure(SUMMARY_MODEL, SUMMARY_RPM, SUMMARY_TPM)
 
-    async def extract_text_from_pdf(self, pdf_content: bytes) -> List[PageChunk]:
-        pdf_file = io.BytesIO(pdf_content)
-        pdf_reader = PdfReader(pdf_file)
-        page_chunks = []
-
-        for page_num, page in enumerate(pdf_reader.pages, 1):  # Start page numbers at 1
-            text = page.extract_text()
-            if text.strip():  # Only add non-empty pages
-                page_chunks.append(PageChunk(content=text, page_num=page_num))
+    async def close(self):
+        await self.client.close()
+        self.pdf_extractor.shutdown()
+        self.embedding_cache.close()
 
-        return page_chunks
+    async def extract_text_from_pdf(self, pdf_path: str) -> List[PageChunk]:
+        with timed("pdf.extract", PDF_EXTRACTION_SECONDS, size=os.path.getsize(pdf_path)):
+            return [page_chunk async for page_chunk in self.iter_pdf_pages(pdf_path)]
 
+    async def iter_pdf_pages(self, pdf_path: str) -> AsyncIterator[PageChunk]:
+        """Yield non-empty pages in page order, extracted only a few page ranges ahead"""
+        async for page_num, text in self.pdf_extractor.iter_pages(pdf_path):
+            if text.strip():  # Only add non-empty pages
+                PDF_PAGES.inc()
+                yield PageChunk(content=text, page_num=page_num)
 
     async def create_embeddings(self, text_or_chunks: Union[str, List[PageChunk]]) -> Tuple[List[List[float]], List[PageChunk]]:
         if isinstance(text_or_chunks, str):
             # For search queries, return single embedding with dummy page chunk
-            if len(self.tokenizer.encode(text_or_chunks)) < TOKEN_SIZE:
-                embedding = await self.embeddings.aembed_query(text_or_chunks)
-                return [embedding], [PageChunk(content=text_or_chunks, page_num=0)]
+            num_tokens = self.count_tokens(text_or_chunks)
+            if num_tokens < TOKEN_SIZE:
+                # Someone is waiting on the search, so it goes ahead of ingestion batches
+                embeddings = await self._request_embeddings([text_or_chunks], num_tokens, PRIORITY_INTERACTIVE)
+                return embeddings, [PageChunk(content=text_or_chunks, page_num=0)]
 
         # For PDF content, we have a list of PageChunks
-        all_chunks = []
-        all_embeddings = []
-
-        # Process each page's content
         page_chunks = text_or_chunks if isinstance(text_or_chunks, list) else [PageChunk(text_or_chunks, 0)]
+        all_chunks = self.split_pages(page_chunks)
+
+        all_embeddings = await self.embed_texts([chunk.content for chunk in all_chunks])
+        return all_embeddings, all_chunks
+
+    async def create_query_embeddings(self, queries: List[str]) -> List[List[float]]:
+        """Embed search queries together, usually in a single request, ahead of ingestion batches"""
+        # Like create_embeddings, an over-long query is represented by its first chunk
+        texts = [
+            query if self.count_tokens(query) < TOKEN_SIZE else self.split_pages([PageChunk(query, 0)])[0].content
+            for query in queries
+        ]
+        batch_results = await asyncio.gather(
+            *(
+                self._request_embeddings(batch, num_tokens, PRIORITY_INTERACTIVE)
+                for batch, num_tokens in self._batch_texts(texts)
+            )
+        )
+        return [embedding for batch in batch_results for embedding in batch]
 
+    def split_pages(self, page_chunks: List[PageChunk]) -> List[PageChunk]:
+        """Split each page into smaller chunks while maintaining page number and hash"""
+        all_chunks = []
         for page_chunk in page_chunks:
-            # Split the page content into smaller chunks
             chunks = self.text_splitter.create_documents([page_chunk.content])
-
-            # Create embeddings for each chunk while maintaining page number
-            for chunk in chunks:
-                chunk_embedding = await self.embeddings.aembed_query(chunk.page_content)
-                all_embeddings.append(chunk_embedding)
-                all_chunks.append(PageChunk(
+            all_chunks.extend(
+                PageChunk(
                     content=chunk.page_content,
-                    page_num=page_chunk.page_num
-                ))
+                    page_num=page_chunk.page_num,
+                    chunk_index=i,
+                    page_hash=page_chunk.page_hash,
+                )
+                for i, chunk in enumerate(chunks)
+            )
+        return all_chunks
 
-        return all_embeddings, all_chunks
+    async def embed_texts(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts through the cache, batching the misses, preserving input order"""
+        if not texts:
+            return []
+
+        keys = [embedding_cache_key(EMBEDDING_MODEL, EMBEDDING_DIMENSION, text) for text in texts]
+        cached = await asyncio.to_thread(self.embedding_cache.get_many, keys)
+        EMBEDDING_CACHE_LOOKUPS.labels("hit").inc(len(cached))
+        EMBEDDING_CACHE_LOOKUPS.labels("miss").inc(len(set(keys)) - len(cached))
+
+        # Repeated text within the request is embedded only once
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+
+        if missing:
+            embeddings = await self._embed_uncached(list(missing.values()))
+            computed = dict(zip(missing.keys(), embeddings))
+            await asyncio.to_thread(self.embedding_cache.put_many, computed)
+            cached.update(computed)
+
+        return [cached[key] for key in keys]
+
+    async def _embed_uncached(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts in batches, several batches at a time, preserving input order"""
+        semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
 
+        async def embed_batch(batch: List[str], num_tokens: int) -> List[List[float]]:
+            async with semaphore:
+                return await self._request_embeddings(batch, num_tokens, PRIORITY_BULK)
 
-    async def create_summary(self, page_chunks: List[PageChunk]) -> str:
+        batch_results = await asyncio.gather(
+            *(embed_batch(batch, num_tokens) for batch, num_tokens in self._batch_texts(texts))
+        )
+        # Batches are contiguous slices of texts, so flattening restores the input order
+        return [embedding for batch in batch_results for embedding in batch]
+
+    async def _request_embeddings(self, batch: List[str], num_tokens: int, priority: int) -> List[List[float]]:
+        """One embeddings request through the scheduler, num_tokens being the batch's estimated cost"""
+        options = {} if EMBEDDING_MODEL in FIXED_EMBEDDING_DIMENSIONS else {"dimensions": EMBEDDING_DIMENSION}
+        with timed("openai.embeddings", EMBEDDING_BATCH_SECONDS, EMBEDDING_MODEL, inputs=len(batch)):
+            response = await self.scheduler.call(
+                EMBEDDING_MODEL,
+                num_tokens,
+                lambda: self.client.embeddings.with_raw_response.create(
+                    model=EMBEDDING_MODEL, input=batch, **options
+                ),
+                priority,
+            )
+        if response.usage is not None:
+            EMBEDDING_TOKENS.labels(EMBEDDING_MODEL).inc(response.usage.total_tokens)
+        embeddings = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        if any(len(embedding) != EMBEDDING_DIMENSION for embedding in embeddings):
+            raise Exception(f"{EMBEDDING_MODEL} returned embeddings not of EMBEDDING_DIMENSION {EMBEDDING_DIMENSION}")
+        return embeddings
+
+    def _batch_texts(self, texts: List[str]) -> List[Tuple[List[str], int]]:
+        """Pack texts into consecutive batches bounded by count and token budget, with their token counts"""
+        batches = []
+        batch = []
+        batch_tokens = 0
+
+        for text in texts:
+            num_tokens = self.count_tokens(text)
+            if batch and (
+                len(batch) >= EMBEDDING_BATCH_SIZE
+                or batch_tokens + num_tokens > EMBEDDING_BATCH_TOKENS
+            ):
+                batches.append((batch, batch_tokens))
+                batch = []
+                batch_tokens = 0
+            batch.append(text)
+            batch_tokens += num_tokens
+
+        if batch:
+            batches.append((batch, batch_tokens))
+        return batches
+
+
+    async def create_summary(
+        self, page_chunks: List[PageChunk], on_event: Optional[SummaryCallback] = None
+    ) -> str:
+        """Summarize the pages; with on_event, report stage progress and stream the final text"""
         # Combine all page contents with page numbers
         formatted_text = "\n\n".join(
             f"[Page {chunk.page_num}]\n{chunk.content}"
@@ -83,67 +306,211 @@ class AIUtils:
         )
 
         # Check text length in tokens
-        num_tokens = len(self.tokenizer.encode(formatted_text))
+        num_tokens = self.count_tokens(formatted_text)
 
         if num_tokens <= self.max_tokens:
             # If text is within token limit, summarize directly
-            response = await self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "You are a helpful assistant that creates comprehensive yet concise summaries. Organize the summary with bullet points for key topics and insights. When referencing content, include the page number in brackets [Page X].",
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Please provide a comprehensive summary of the following text, focusing on the main points and key takeaways. Include page references when noting key points:\n\n{formatted_text}",
-                    },
-                ],
-                temperature=0,
-            )
-            return response.choices[0].message.content
+            return await self._final(SUMMARY_SYSTEM_PROMPT, SUMMARY_USER_PROMPT, formatted_text, "summary", on_event)
 
-        # If text is too long, fall back to chunked summarization
+        # If text is too long, fall back to map-reduce summarization
+        semaphore = asyncio.Semaphore(SUMMARY_CONCURRENCY)
         chunks = await self.split_text(formatted_text)
 
-        # Summarize each chunk
-        chunk_summaries = []
-        for chunk in chunks:
-            response = await self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "You are a helpful assistant that creates concise summaries of text segments. Include page references [Page X] when noting key points.",
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Please summarize this text segment, focusing on the main points:\n\n{chunk.page_content}",
-                    },
-                ],
-                temperature=0,
-            )
-            chunk_summaries.append(response.choices[0].message.content)
+        # Map: summarize all chunks concurrently
+        summaries = await self._gather_with_progress(
+            "map",
+            [
+                self._complete(
+                    CHUNK_SUMMARY_SYSTEM_PROMPT, CHUNK_SUMMARY_USER_PROMPT, chunk.page_content, semaphore, "map"
+                )
+                for chunk in chunks
+            ],
+            on_event,
+        )
+
+        # Reduce: condense groups of summaries level by level until they fit in a single call
+        summaries = await self._reduce_summaries(summaries, semaphore, on_event)
 
         # Create final summary from chunk summaries
-        combined_summary = "\n\n".join(chunk_summaries)
-
-        final_response = await self.client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a helpful assistant that creates coherent summaries. Organize the final summary with bullet points for key topics and insights. Maintain page references [Page X] for key points.",
-                },
-                {
-                    "role": "user",
-                    "content": f"Please provide a coherent, comprehensive summary combining these section summaries, maintaining a clear flow between topics and preserving page references:\n\n{combined_summary}",
-                },
-            ],
-            temperature=0,
+        return await self._final(
+            FINAL_SUMMARY_SYSTEM_PROMPT, FINAL_SUMMARY_USER_PROMPT, "\n\n".join(summaries), "final", on_event
         )
 
-        return final_response.choices[0].message.content
+    async def stream_summary(self, page_chunks: List[PageChunk]) -> AsyncIterator[SummaryEvent]:
+        """Yield create_summary's events as they happen, then a "done" event with the whole summary"""
+        events: "asyncio.Queue[SummaryEvent]" = asyncio.Queue()
+        summary_task = asyncio.create_task(self.create_summary(page_chunks, events.put_nowait))
+        try:
+            while not summary_task.done():
+                next_event = asyncio.ensure_future(events.get())
+                await asyncio.wait({next_event, summary_task}, return_when=asyncio.FIRST_COMPLETED)
+                if next_event.done():
+                    yield next_event.result()
+                else:
+                    next_event.cancel()
+
+            while not events.empty():
+                yield events.get_nowait()
+            yield SummaryEvent(kind="done", stage="final", text=summary_task.result())
+        finally:
+            # The consumer went away (e.g. the subscription was closed) before the summary finished
+            summary_task.cancel()
+
+    async def _gather_with_progress(
+        self, stage: str, calls: List[Awaitable[str]], on_event: Optional[SummaryCallback]
+    ) -> List[str]:
+        completed = 0
+
+        async def track(call: Awaitable[str]) -> str:
+            nonlocal completed
+            result = await call
+            completed += 1
+            if on_event:
+                on_event(SummaryEvent(kind="progress", stage=stage, completed=completed, total=len(calls)))
+            return result
+
+        if on_event:
+            on_event(SummaryEvent(kind="progress", stage=stage, completed=0, total=len(calls)))
+        return list(await asyncio.gather(*(track(call) for call in calls)))
+
+    async def _reduce_summaries(
+        self,
+        summaries: List[str],
+        semaphore: asyncio.Semaphore,
+        on_event: Optional[SummaryCallback] = None,
+    ) -> List[str]:
+        for _ in range(SUMMARY_MAX_REDUCE_LEVELS):
+            if len(summaries) <= 1 or self.count_tokens("\n\n".join(summaries)) <= self.max_tokens:
+                break
+
+            groups = self._group_summaries(summaries)
+            summaries = await self._gather_with_progress(
+                "reduce",
+                [
+                    self._complete(
+                        REDUCE_SUMMARY_SYSTEM_PROMPT,
+                        REDUCE_SUMMARY_USER_PROMPT,
+                        "\n\n".join(group),
+                        semaphore,
+                        "reduce",
+                    )
+                    for group in groups
+                ],
+                on_event,
+            )
+        return summaries
+
+    def _group_summaries(self, summaries: List[str]) -> List[List[str]]:
+        """Pack consecutive summaries into groups that fit the token budget, at least two per group"""
+        groups = []
+        group = []
+        group_tokens = 0
+
+        for summary in summaries:
+            num_tokens = self.count_tokens(summary)
+            if len(group) >= 2 and group_tokens + num_tokens > self.max_tokens:
+                groups.append(group)
+                group = []
+                group_tokens = 0
+            group.append(summary)
+            group_tokens += num_tokens
+
+        if group:
+            groups.append(group)
+        return groups
+
+    async def _complete(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        text: str,
+        semaphore: Optional[asyncio.Semaphore] = None,
+        stage: str = "summary",
+    ) -> str:
+        if semaphore is not None:
+            async with semaphore:
+                return await self._complete(system_prompt, user_prompt, text, stage=stage)
+
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt.format(text=text)},
+        ]
+        with timed("openai.chat", LLM_SECONDS, SUMMARY_MODEL, stage):
+            response = await self.scheduler.call(
+                SUMMARY_MODEL,
+                self._chat_tokens(messages),
+                lambda: self.client.chat.completions.with_raw_response.create(
+                    model=SUMMARY_MODEL, messages=messages, temperature=0
+                ),
+                PRIORITY_INTERACTIVE,
+            )
+        if response.usage is not None:
+            LLM_TOKENS.labels(SUMMARY_MODEL, "prompt").inc(response.usage.prompt_tokens)
+            LLM_TOKENS.labels(SUMMARY_MODEL, "completion").inc(response.usage.completion_tokens)
+        return response.choices[0].message.content
+
+    async def _final(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        text: str,
+        stage: str,
+        on_event: Optional[SummaryCallback],
+    ) -> str:
+        """Run the call producing the summary, streaming its tokens when someone is listening"""
+        if on_event is None:
+            return await self._complete(system_prompt, user_prompt, text, stage=stage)
+
+        parts = []
+        async for delta in self._stream_complete(system_prompt, user_prompt, text, stage):
+            parts.append(delta)
+            on_event(SummaryEvent(kind="token", stage=stage, text=delta))
+        return "".join(parts)
+
+    async def _stream_complete(
+        self, system_prompt: str, user_prompt: str, text: str, stage: str
+    ) -> AsyncIterator[str]:
+        user_content = user_prompt.format(text=text)
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_content},
+        ]
+        completion_tokens = 0
+        timer = StreamTimer("openai.chat", LLM_SECONDS, SUMMARY_MODEL, stage, stream=True)
+        try:
+            with timer.measure():
+                # The scheduler slot is freed once the stream starts; an interrupted stream isn't retried
+                stream = await self.scheduler.call(
+                    SUMMARY_MODEL,
+                    self._chat_tokens(messages),
+                    lambda: self.client.chat.completions.with_raw_response.create(
+                        model=SUMMARY_MODEL, messages=messages, temperature=0, stream=True
+                    ),
+                    PRIORITY_INTERACTIVE,
+                )
+            chunks = stream.__aiter__()
+            while True:
+                with timer.measure():
+                    try:
+                        chunk = await chunks.__anext__()
+                    except StopAsyncIteration:
+                        break
+                if chunk.choices and chunk.choices[0].delta.content:
+                    completion_tokens += self.count_tokens(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+        finally:
+            timer.finish()
+
+        # Streamed responses carry no usage, so count with the tokenizer
+        LLM_TOKENS.labels(SUMMARY_MODEL, "prompt").inc(self.count_tokens(system_prompt + user_content))
+        LLM_TOKENS.labels(SUMMARY_MODEL, "completion").inc(completion_tokens)
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer.encode(text))
+
+    def _chat_tokens(self, messages: List[dict]) -> int:
+        """Rate limit cost of a chat call: its prompt plus the completion tokens reserved for it"""
+        return sum(self.count_tokens(message["content"]) for message in messages) + SUMMARY_COMPLETION_TOKENS
 
     async def split_text(self, text: str) -> List[LangchainDocument]:
         return self.text_splitter.create_documents([text])
@@ -0,0 +1,61 @@
+import os
+from dataclasses import dataclass
+
+import httpx
+from strawberry.dataloader import DataLoader
+
+from ai_utils import AIUtils
+from s3_utils import S3Client
+from search_cache import SearchCache
+from service1_api import fetch_pdfs_metadata
+from vector_store import VectorStore, create_vector_store
+
+
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))
+
+
+@dataclass
+class ServiceClients:
+    """Clients shared by all requests of the process, created at startup"""
+
+    ai_utils: AIUtils
+    vector_store: VectorStore
+    s3: S3Client
+    http: httpx.AsyncClient
+    search_cache: SearchCache
+    # Coalesces concurrent metadata lookups into one pdfsByIds request to service1
+    pdf_metadata: DataLoader
+
+    @classmethod
+    async def create(cls) -> "ServiceClients":
+        search_cache = SearchCache()
+        vector_store = create_vector_store()
+        vector_store.add_change_listener(search_cache.invalidate)
+        await vector_store.ensure_index()
+        http = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            timeout=HTTP_TIMEOUT,
+        )
+        return cls(
+            ai_utils=AIUtils(),
+            vector_store=vector_store,
+            s3=S3Client(),
+            http=http,
+            search_cache=search_cache,
+            pdf_metadata=DataLoader(
+                load_fn=lambda pdf_ids: fetch_pdfs_metadata(http, pdf_ids), cache=False
+            ),
+        )
+
+    async def close(self):
+        await self.http.aclose()
+        await self.ai_utils.close()
+        await self.vector_store.close()
+        self.s3.close()
@@ -0,0 +1,139 @@
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+
+EMBEDDING_DIMENSION = int(os.getenv("EMBEDDING_DIMENSION", "1536"))
+# Profile used for newly created indexes and as the default target of reindex.py
+INDEX_PROFILE = os.getenv("OPENSEARCH_INDEX_PROFILE", "nmslib_hnsw")
+INDEX_SHARDS = int(os.getenv("OPENSEARCH_SHARDS", "1"))
+INDEX_REPLICAS = int(os.getenv("OPENSEARCH_REPLICAS", "0"))
+# HNSW graph parameters: m links per node, ef_* candidate list sizes. nmslib reads ef_search
+# from the index settings and faiss from the method; lucene ignores it and searches with ef = k
+KNN_M = int(os.getenv("KNN_M", "16"))
+KNN_EF_CONSTRUCTION = int(os.getenv("KNN_EF_CONSTRUCTION", "512"))
+KNN_EF_SEARCH = int(os.getenv("KNN_EF_SEARCH", "100"))
+# IVF/PQ: nlist clusters, nprobes searched per query, PQ_M sub-vectors of PQ_CODE_SIZE bits
+IVF_NLIST = int(os.getenv("KNN_IVF_NLIST", "1024"))
+IVF_NPROBES = int(os.getenv("KNN_IVF_NPROBES", "16"))
+PQ_M = int(os.getenv("KNN_PQ_M", "64"))
+PQ_CODE_SIZE = int(os.getenv("KNN_PQ_CODE_SIZE", "8"))
+# Embedding components beyond +/- this value are clipped when quantizing to bytes
+BYTE_CLIP = float(os.getenv("KNN_BYTE_CLIP", "0.25"))
+
+
+@dataclass
+class IndexProfile:
+    """How embeddings are stored and searched in a physical OpenSearch index"""
+
+    name: str
+    engine: str
+    space_type: str
+    algorithm: str = "hnsw"
+    # faiss scalar quantizer type, e.g. "fp16"
+    sq_type: Optional[str] = None
+    # "byte" stores vectors quantized client side to int8
+    data_type: Optional[str] = None
+
+    @property
+    def requires_training(self) -> bool:
+        """IVF indexes are built from a model trained on existing vectors"""
+        return self.algorithm == "ivf"
+
+    @property
+    def scale(self) -> float:
+        """Factor between a stored component and the original float"""
+        return 127 / BYTE_CLIP if self.data_type == "byte" else 1.0
+
+    def method(self) -> Dict[str, Any]:
+        if self.algorithm == "ivf":
+            parameters = {
+                "nlist": IVF_NLIST,
+                "nprobes": IVF_NPROBES,
+                "encoder": {"name": "pq", "parameters": {"m": PQ_M, "code_size": PQ_CODE_SIZE}},
+            }
+        else:
+            parameters = {"m": KNN_M, "ef_construction": KNN_EF_CONSTRUCTION}
+            if self.engine == "faiss":
+                parameters["ef_search"] = KNN_EF_SEARCH
+            if self.sq_type:
+                parameters["encoder"] = {"name": "sq", "parameters": {"type": self.sq_type}}
+        return {
+            "name": self.algorithm,
+            "engine": self.engine,
+            "space_type": self.space_type,
+            "parameters": parameters,
+        }
+
+    def field_mapping(self, model_id: Optional[str] = None) -> Dict[str, Any]:
+        if self.requires_training:
+            if not model_id:
+                raise Exception(f"Index profile {self.name} requires a trained model")
+            return {"type": "knn_vector", "model_id": model_id}
+
+        field = {"type": "knn_vector", "dimension": EMBEDDING_DIMENSION, "method": self.method()}
+        if self.data_type:
+            field["data_type"] = self.data_type
+        return field
+
+    def encode(self, vector: List[float]) -> List[float]:
+        """Convert an embedding to the representation stored in and queried against the index"""
+        if self.data_type != "byte":
+            return vector
+        return [max(-128, min(127, round(x * self.scale))) for x in vector]
+
+
+INDEX_PROFILES: Dict[str, IndexProfile] = {
+    profile.name: profile
+    for profile in [
+        # The original mapping: float32 vectors in an nmslib graph
+        IndexProfile("nmslib_hnsw", engine="nmslib", space_type="cosinesimil"),
+        # Half precision vectors, ~2x smaller; embeddings are unit length so inner product ranks like cosine
+        IndexProfile("faiss_hnsw_fp16", engine="faiss", space_type="innerproduct", sq_type="fp16"),
+        # int8 vectors, ~4x smaller
+        IndexProfile("lucene_hnsw_byte", engine="lucene", space_type="cosinesimil", data_type="byte"),
+        # Product quantized clusters for large corpora, far smaller than any graph
+        IndexProfile("faiss_ivfpq", engine="faiss", space_type="innerproduct", algorithm="ivf"),
+    ]
+}
+
+
+def get_index_profile(name: str = INDEX_PROFILE) -> IndexProfile:
+    if name not in INDEX_PROFILES:
+        raise Exception(f"Unknown index profile {name}, expected one of {', '.join(INDEX_PROFILES)}")
+    return INDEX_PROFILES[name]
+
+
+def physical_index_name(alias: str, profile: IndexProfile) -> str:
+    """Concrete index behind the alias, unique per profile and creation time"""
+    return f"{alias}-{profile.name.replace('_', '-')}-{int(time.time())}"
+
+
+def build_index_body(profile: IndexProfile, model_id: Optional[str] = None) -> Dict[str, Any]:
+    return {
+        "mappings": {
+            # Lets clients tell how vectors in an existing index are encoded
+            "_meta": {"profile": profile.name, "model_id": model_id},
+            "properties": {
+                "pdf_id": {"type": "keyword"},
+                "content": {"type": "text"},
+                "page_number": {"type": "integer"},  # Add page number field
+                "chunk_index": {"type": "integer"},
+                # Hash of the page text the chunk was split from
+                "page_hash": {"type": "keyword"},
+                "embedding": profile.field_mapping(model_id),
+                "created_at": {"type": "date"},
+                "metadata": {"type": "object", "enabled": True},
+            },
+        },
+        "settings": {
+            "index": {
+                "knn": True,
+                # Only nmslib graphs read this, see KNN_EF_SEARCH
+                "knn.algo_param.ef_search": KNN_EF_SEARCH,
+                "number_of_shards": INDEX_SHARDS,
+                "number_of_replicas": INDEX_REPLICAS,
+            }
+        },
+    }
@@ -0,0 +1,357 @@
+import asyncio
+import os
+import socket
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import (
+    JSON,
+    Column,
+    DateTime,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    Text,
+    or_,
+    select,
+    update,
+)
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from clients import ServiceClients
+from pdf_extraction import PDF_EXTRACTION_WORKERS
+from pipeline import INDEX_STAGES, INDEX_STEPS, IndexTask, Stage, run_stage
+from s3_utils import remove_stale_downloads
+from scheduler import PipelineScheduler, StageSpec
+
+
+# Postgres in deployments, a local SQLite file otherwise
+JOBS_DATABASE_URL = os.getenv("JOBS_DATABASE_URL", "sqlite+aiosqlite:///./jobs.db")
+# Documents each ingestion stage works on at once
+STAGE_CONCURRENCY = {
+    "metadata": int(os.getenv("INGEST_METADATA_CONCURRENCY", "8")),
+    "check": int(os.getenv("INGEST_CHECK_CONCURRENCY", "8")),
+    "download": int(os.getenv("INGEST_DOWNLOAD_CONCURRENCY", "8")),
+    # Documents streamed through extraction, embedding and writing at once
+    "index": int(os.getenv("INGEST_INDEX_CONCURRENCY", "8")),
+    # Steps inside the index stage: documents extracting, and batches embedding or writing, at once
+    "extract": int(os.getenv("INGEST_EXTRACT_CONCURRENCY", str(PDF_EXTRACTION_WORKERS))),
+    "embed": int(os.getenv("INGEST_EMBED_CONCURRENCY", "4")),
+    "write": int(os.getenv("INGEST_WRITE_CONCURRENCY", "4")),
+}
+# Documents allowed to wait in front of each stage before the previous stage blocks
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "4"))
+# Jobs interrupted this many times (e.g. by crashes) are failed instead of retried
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# A worker renews the lease on its running jobs every JOB_HEARTBEAT_SECONDS; jobs whose lease
+# wasn't renewed for JOB_LEASE_SECONDS belong to a dead worker and are requeued
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", "15"))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+
+metadata = MetaData()
+
+jobs_table = Table(
+    "ingestion_jobs",
+    metadata,
+    Column("id", String(36), primary_key=True),
+    Column("kind", String(32), nullable=False),
+    Column("pdf_id", Integer, nullable=False, index=True),
+    Column("status", String(16), nullable=False, index=True),
+    Column("stage", String(32)),
+    # Per-stage status, timings and item counts keyed by stage name
+    Column("stages", JSON, nullable=False),
+    Column("error", Text),
+    Column("attempts", Integer, nullable=False, default=0),
+    Column("created_at", DateTime, nullable=False),
+    Column("started_at", DateTime),
+    Column("finished_at", DateTime),
+    # Worker running the job and the last renewal of its lease
+    Column("owner", String(128)),
+    Column("heartbeat_at", DateTime, index=True),
+)
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    pdf_id: int
+    status: str
+    stage: Optional[str]
+    stages: Dict[str, Dict[str, Any]]
+    error: Optional[str]
+    attempts: int
+    created_at: datetime
+    started_at: Optional[datetime]
+    finished_at: Optional[datetime]
+    owner: Optional[str] = None
+    heartbeat_at: Optional[datetime] = None
+
+
+class JobStore:
+    """Durable job records in Postgres or SQLite"""
+
+    def __init__(self, database_url: str = JOBS_DATABASE_URL):
+        self.engine = create_async_engine(database_url)
+
+    async def init(self):
+        async with self.engine.begin() as conn:
+            await conn.run_sync(metadata.create_all)
+
+    async def close(self):
+        await self.engine.dispose()
+
+    async def create(self, kind: str, pdf_ids: List[int]) -> List[Job]:
+        """Create one queued job per PDF in a single transaction"""
+        created_at = datetime.utcnow()
+        rows = [
+            {
+                "id": str(uuid.uuid4()),
+                "kind": kind,
+                "pdf_id": pdf_id,
+                "status": JOB_QUEUED,
+                "stage": None,
+                "stages": {},
+                "error": None,
+                "attempts": 0,
+                "created_at": created_at,
+                "started_at": None,
+                "finished_at": None,
+            }
+            for pdf_id in pdf_ids
+        ]
+        if rows:
+            async with self.engine.begin() as conn:
+                await conn.execute(jobs_table.insert(), rows)
+        return [Job(**row) for row in rows]
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        async with self.engine.connect() as conn:
+            result = await conn.execute(select(jobs_table).where(jobs_table.c.id == job_id))
+            row = result.first()
+        return Job(**row._mapping) if row else None
+
+    async def claim(self, job_id: str, owner: str) -> bool:
+        """Mark a queued job as running under owner's lease; False if another worker got there first"""
+        now = datetime.utcnow()
+        async with self.engine.begin() as conn:
+            result = await conn.execute(
+                update(jobs_table)
+                .where(jobs_table.c.id == job_id, jobs_table.c.status == JOB_QUEUED)
+                .values(
+                    status=JOB_RUNNING,
+                    started_at=now,
+                    attempts=jobs_table.c.attempts + 1,
+                    owner=owner,
+                    heartbeat_at=now,
+                )
+            )
+        return result.rowcount == 1
+
+    async def update(self, job_id: str, owner: Optional[str] = None, **values) -> bool:
+        """Update a job, only while owner holds it if given; False if nothing was updated"""
+        condition = jobs_table.c.id == job_id
+        if owner is not None:
+            condition &= (jobs_table.c.owner == owner) & (jobs_table.c.status == JOB_RUNNING)
+        async with self.engine.begin() as conn:
+            result = await conn.execute(update(jobs_table).where(condition).values(**values))
+        return result.rowcount == 1
+
+    async def renew_leases(self, owner: str):
+        """Extend the lease of every job owner is running"""
+        async with self.engine.begin() as conn:
+            await conn.execute(
+                update(jobs_table)
+                .where(jobs_table.c.owner == owner, jobs_table.c.status == JOB_RUNNING)
+                .values(heartbeat_at=datetime.utcnow())
+            )
+
+    async def expire_leases(self) -> List[str]:
+        """Requeue running jobs whose worker stopped renewing their lease and return their ids.
+
+        Jobs of live workers are left alone, so every replica sharing the database can call this.
+        Two replicas may requeue the same job; claim() lets only one of them run it.
+        """
+        now = datetime.utcnow()
+        expired = (jobs_table.c.status == JOB_RUNNING) & or_(
+            jobs_table.c.heartbeat_at.is_(None),
+            jobs_table.c.heartbeat_at < now - timedelta(seconds=JOB_LEASE_SECONDS),
+        )
+        async with self.engine.begin() as conn:
+            await conn.execute(
+                update(jobs_table)
+                .where(expired, jobs_table.c.attempts >= JOB_MAX_ATTEMPTS)
+                .values(
+                    status=JOB_FAILED,
+                    error="Interrupted too many times",
+                    finished_at=now,
+                )
+            )
+            result = await conn.execute(select(jobs_table.c.id).where(expired))
+            job_ids = [row.id for row in result]
+            if job_ids:
+                await conn.execute(
+                    update(jobs_table)
+                    .where(expired, jobs_table.c.id.in_(job_ids))
+                    .values(status=JOB_QUEUED, owner=None, heartbeat_at=None)
+                )
+            return job_ids
+
+    async def recover(self) -> List[str]:
+        """Requeue jobs of dead workers and return the ids of all queued jobs"""
+        await self.expire_leases()
+        async with self.engine.connect() as conn:
+            result = await conn.execute(
+                select(jobs_table.c.id)
+                .where(jobs_table.c.status == JOB_QUEUED)
+                .order_by(jobs_table.c.created_at)
+            )
+            return [row.id for row in result]
+
+
+@dataclass
+class _JobItem:
+    job: Job
+    task: IndexTask
+    stages: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+
+
+class IngestionWorkerPool:
+    """Runs queued index jobs through a pipelined stage scheduler, recording stage progress"""
+
+    def __init__(self, store: JobStore, clients: ServiceClients):
+        self.store = store
+        self.clients = clients
+        self.scheduler = PipelineScheduler(
+            [
+                StageSpec(name, self._stage_runner(name, stage), STAGE_CONCURRENCY[name])
+                for name, stage in INDEX_STAGES
+            ],
+            queue_size=INGEST_QUEUE_SIZE,
+            on_complete=self._succeed,
+            on_error=self._fail,
+            on_cancel=self._abandon,
+        )
+        self.step_limits = {name: asyncio.Semaphore(STAGE_CONCURRENCY[name]) for name in INDEX_STEPS}
+        # Job ids waiting to be claimed; the scheduler's bounded queues cap work in flight
+        self._queue: "asyncio.Queue[str]" = asyncio.Queue()
+        self._feeder: Optional[asyncio.Task] = None
+        self._heartbeat: Optional[asyncio.Task] = None
+        # Owner recorded on claimed jobs, unique per process
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+    async def start(self):
+        removed = await asyncio.to_thread(remove_stale_downloads)
+        if removed:
+            print(f"Removed {removed} downloads left behind by previous runs")
+        for job_id in await self.store.recover():
+            self._queue.put_nowait(job_id)
+        self.scheduler.start()
+        self._feeder = asyncio.create_task(self._feed())
+        self._heartbeat = asyncio.create_task(self._renew_leases())
+
+    async def stop(self):
+        for task in (self._feeder, self._heartbeat):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        await self.scheduler.stop()
+
+    async def submit(self, pdf_ids: List[int]) -> List[Job]:
+        jobs = await self.store.create("index_pdf", pdf_ids)
+        for job in jobs:
+            self._queue.put_nowait(job.id)
+        return jobs
+
+    async def _feed(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                if not await self.store.claim(job_id, self.worker_id):
+                    continue
+            except Exception as e:
+                print(f"Error claiming job {job_id}: {e}")
+                continue
+            try:
+                job = await self.store.get(job_id)
+                task = IndexTask(pdf_id=job.pdf_id, limits=self.step_limits)
+                await self.scheduler.submit(_JobItem(job=job, task=task))
+            except asyncio.CancelledError:
+                # Stopped before the job reached the pipeline, so nothing else releases it
+                await self._release(job_id)
+                raise
+            except Exception as e:
+                print(f"Error scheduling job {job_id}: {e}")
+                await self._release(job_id)
+
+    async def _renew_leases(self):
+        """Keep this worker's jobs leased, and take over jobs of workers that died"""
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+            try:
+                await self.store.renew_leases(self.worker_id)
+                for job_id in await self.store.expire_leases():
+                    self._queue.put_nowait(job_id)
+            except Exception as e:
+                print(f"Error renewing job leases: {e}")
+
+    def _stage_runner(self, name: str, stage: Stage):
+        async def run(item: _JobItem):
+            async def on_stage(stage_name: str, status: str, details: Dict[str, Any]):
+                item.stages[stage_name] = {
+                    "status": status,
+                    "updated_at": datetime.utcnow().isoformat(),
+                    **details,
+                }
+                if not await self.store.update(
+                    item.job.id, owner=self.worker_id, stage=stage_name, stages=dict(item.stages)
+                ):
+                    raise Exception(f"Job {item.job.id} was taken over by another worker after its lease expired")
+
+            await run_stage(self.clients, item.task, name, stage, on_stage)
+
+        return run
+
+    # The pool owns each task's downloaded file: whichever way the job ends, it is removed here
+
+    async def _succeed(self, item: _JobItem):
+        try:
+            await self.store.update(
+                item.job.id, owner=self.worker_id, status=JOB_SUCCEEDED, finished_at=datetime.utcnow()
+            )
+        finally:
+            await item.task.release()
+
+    async def _fail(self, item: _JobItem, error: Exception):
+        print(f"Error indexing PDF {item.job.pdf_id}: {error}")
+        try:
+            await self.store.update(
+                item.job.id,
+                owner=self.worker_id,
+                status=JOB_FAILED,
+                error=str(error),
+                finished_at=datetime.utcnow(),
+            )
+        finally:
+            await item.task.release()
+
+    async def _abandon(self, item: _JobItem):
+        """Stopped mid-pipeline: give up the lease so another worker takes the job over right away"""
+        try:
+            await self._release(item.job.id)
+        finally:
+            await item.task.release()
+
+    async def _release(self, job_id: str):
+        try:
+            await self.store.update(job_id, owner=self.worker_id, heartbeat_at=None)
+        except Exception as e:
+            print(f"Error releasing job {job_id}: {e}")
@@ -1,13 +1,46 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from strawberry.fastapi import GraphQLRouter
 
+from clients import ServiceClients
+from jobs import IngestionWorkerPool, JobStore
+from metrics import setup_tracing
 from schema import schema
 
+setup_tracing()
+
 app = FastAPI()
 
-graphql_app = GraphQLRouter(schema)
+
+@app.on_event("startup")
+async def startup_event():
+    app.state.clients = await ServiceClients.create()
+
+    job_store = JobStore()
+    await job_store.init()
+    app.state.jobs = IngestionWorkerPool(job_store, app.state.clients)
+    await app.state.jobs.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await app.state.jobs.stop()
+    await app.state.jobs.store.close()
+    await app.state.clients.close()
+
+
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+async def get_context():
+    return {"clients": app.state.clients, "jobs": app.state.jobs}
+
+
+graphql_app = GraphQLRouter(schema, context_getter=get_context)
 app.include_router(graphql_app, prefix="/graphql")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8082)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8082)
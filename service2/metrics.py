@@ -0,0 +1,168 @@
+import os
+import time
+from contextlib import contextmanager
+from inspect import isawaitable
+from typing import Dict, Iterator
+
+from prometheus_client import Counter, Gauge, Histogram
+from strawberry.extensions import Extension
+
+try:
+    from opentelemetry import trace
+    from opentelemetry.propagate import inject
+except ImportError:  # Tracing is optional
+    trace = None
+
+# Spans are recorded when OpenTelemetry is installed and an OTLP endpoint is configured
+TRACING_ENABLED = trace is not None and bool(os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT"))
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "service2")
+
+
+STAGE_SECONDS = Histogram(
+    "ingest_stage_seconds",
+    "Time spent in each ingestion pipeline stage per document",
+    ["stage", "status"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+STAGE_ITEMS = Counter(
+    "ingest_stage_items_total",
+    "Items produced by ingestion stages (bytes, pages, chunks)",
+    ["stage"],
+)
+S3_SECONDS = Histogram("s3_request_seconds", "S3 request time", ["operation"])
+SERVICE1_SECONDS = Histogram(
+    "service1_request_seconds", "Time of GraphQL requests to service1", ["operation"]
+)
+PDF_EXTRACTION_SECONDS = Histogram(
+    "pdf_extraction_seconds",
+    "Time to extract the text of a whole PDF",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+PDF_PAGES = Counter("pdf_pages_extracted_total", "Non-empty PDF pages extracted")
+EMBEDDING_BATCH_SECONDS = Histogram(
+    "embedding_batch_seconds", "Time of one embeddings API request", ["model"]
+)
+EMBEDDING_TOKENS = Counter("embedding_tokens_total", "Tokens sent to the embeddings API", ["model"])
+EMBEDDING_CACHE_LOOKUPS = Counter(
+    "embedding_cache_lookups_total", "Embedding cache lookups by outcome", ["result"]
+)
+LLM_SECONDS = Histogram(
+    "llm_request_seconds",
+    "Time of one chat completion; for streamed ones, the request and stream reads up to the last token",
+    ["model", "stage"],
+    buckets=(0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120),
+)
+LLM_TOKENS = Counter("llm_tokens_total", "Chat completion tokens", ["model", "kind"])
+OPENAI_QUEUE_SECONDS = Histogram(
+    "openai_queue_seconds",
+    "Time OpenAI requests wait for rate limit budget and a concurrency slot",
+    ["model", "priority"],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+OPENAI_RETRIES = Counter("openai_retries_total", "Retried OpenAI requests", ["model", "reason"])
+OPENAI_CONCURRENCY_LIMIT = Gauge(
+    "openai_concurrency_limit", "Adaptive limit on OpenAI requests in flight", ["model"]
+)
+VECTOR_STORE_SECONDS = Histogram(
+    "vector_store_request_seconds", "Vector store operation time", ["store", "operation"]
+)
+GRAPHQL_SECONDS = Histogram(
+    "graphql_resolver_seconds", "Time of top-level GraphQL fields", ["field"]
+)
+
+
+def setup_tracing():
+    """Export spans over OTLP when tracing is enabled; the SDK and exporter packages are optional"""
+    if not TRACING_ENABLED:
+        return
+    from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+    provider = TracerProvider(resource=Resource.create({"service.name": SERVICE_NAME}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[None]:
+    if not TRACING_ENABLED:
+        yield
+        return
+    with trace.get_tracer(SERVICE_NAME).start_as_current_span(name, attributes=attributes):
+        yield
+
+
+@contextmanager
+def timed(name: str, histogram: Histogram, *labels: str, **attributes) -> Iterator[None]:
+    """Observe the block's duration in histogram, inside a span when tracing is enabled"""
+    with span(name, **attributes):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            metric = histogram.labels(*labels) if labels else histogram
+            metric.observe(time.perf_counter() - started)
+
+
+class StreamTimer:
+    """Times a streamed response across the yields of an async generator.
+
+    Only the blocks run under measure() count, e.g. the request and the reads of its stream,
+    not the time the consumer spends between items. The span is started without becoming
+    current, so it doesn't leak into the consumer's context.
+    """
+
+    def __init__(self, name: str, histogram: Histogram, *labels: str, **attributes):
+        self.metric = histogram.labels(*labels) if labels else histogram
+        self.elapsed = 0.0
+        self._span = (
+            trace.get_tracer(SERVICE_NAME).start_span(name, attributes=attributes) if TRACING_ENABLED else None
+        )
+
+    @contextmanager
+    def measure(self) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.elapsed += time.perf_counter() - started
+
+    def finish(self):
+        self.metric.observe(self.elapsed)
+        if self._span is not None:
+            self._span.set_attribute("busy_seconds", self.elapsed)
+            self._span.end()
+
+
+def trace_headers() -> Dict[str, str]:
+    """W3C traceparent headers continuing the current span in the called service"""
+    headers: Dict[str, str] = {}
+    if TRACING_ENABLED:
+        inject(headers)
+    return headers
+
+
+class MetricsExtension(Extension):
+    """Times top-level GraphQL fields"""
+
+    def resolve(self, _next, root, info, *args, **kwargs):
+        if info.path.prev is not None:
+            return _next(root, info, *args, **kwargs)
+
+        field = info.field_name
+        started = time.perf_counter()
+        result = _next(root, info, *args, **kwargs)
+        if not isawaitable(result):
+            GRAPHQL_SECONDS.labels(field).observe(time.perf_counter() - started)
+            return result
+
+        async def timed_result():
+            with span(f"graphql.{field}"):
+                try:
+                    return await result
+                finally:
+                    GRAPHQL_SECONDS.labels(field).observe(time.perf_counter() - started)
+
+        return timed_result()
@@ -0,0 +1,427 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+import numpy as np
+
+from ai_utils import PageChunk
+from index_profiles import EMBEDDING_DIMENSION
+from metrics import VECTOR_STORE_SECONDS, timed
+from vector_store import ChunkState, IndexResult, VectorStore, chunk_id
+
+
+# Directory holding the memory-mapped vectors file and store.db with the chunk fields
+VECTOR_STORE_PATH = os.getenv("VECTOR_STORE_PATH", "./vector_store")
+# Rows scored per matrix product, bounding the temporary score buffer
+SEARCH_BLOCK_ROWS = int(os.getenv("VECTOR_STORE_BLOCK_ROWS", "65536"))
+# Best chunks ranked per requested document before falling back to a full sort
+SEARCH_CANDIDATES_PER_DOC = 8
+INITIAL_CAPACITY = 1024
+
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    id TEXT PRIMARY KEY,
+    row INTEGER NOT NULL,
+    pdf_id TEXT NOT NULL,
+    content TEXT NOT NULL,
+    page_number INTEGER NOT NULL,
+    chunk_index INTEGER NOT NULL,
+    page_hash TEXT,
+    metadata TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sources (pdf_id TEXT PRIMARY KEY, source_key TEXT);
+CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+"""
+
+
+class NumpyVectorStore(VectorStore):
+    """In-process store: unit-length float32 vectors in one memory-mapped array, searched exactly.
+
+    Chunk fields live in SQLite, keyed to their vector's row, so a write only touches the chunks
+    it changes. Deleted rows are tombstoned and reclaimed by compaction once they make up half
+    the array. Compaction and growth copy the vectors into a new file that becomes current in the
+    same transaction as the row changes, so a crash leaves either the old or the new state.
+    """
+
+    def __init__(self, path: str = VECTOR_STORE_PATH, dimension: int = EMBEDDING_DIMENSION):
+        super().__init__()
+        self.path = path
+        self.dimension = dimension
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._vectors: Optional[np.memmap] = None
+        # Name of the vectors file within path that the committed rows refer to
+        self._vectors_file: Optional[str] = None
+        # Per-row chunk fields; None marks a deleted row
+        self._rows: List[Optional[Dict[str, Any]]] = []
+        self._live = np.zeros(0, dtype=bool)
+        # Source key of each document's last sync, see VectorStore.get_source_key
+        self._sources: Dict[str, Optional[str]] = {}
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    async def ensure_index(self):
+        await asyncio.to_thread(self._open)
+
+    async def close(self):
+        with self._lock:
+            if self._vectors is not None:
+                self._vectors.flush()
+                self._vectors = None
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _open(self):
+        with self._lock:
+            os.makedirs(self.path, exist_ok=True)
+            self._conn = sqlite3.connect(self._file("store.db"), check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(STORE_SCHEMA)
+            if self._conn.execute("SELECT 1 FROM state WHERE key = 'vectors_file'").fetchone() is None:
+                self._initialize()
+
+            state = dict(self._conn.execute("SELECT key, value FROM state"))
+            if int(state["dimension"]) != self.dimension:
+                raise Exception(
+                    f"{self.path} holds {state['dimension']}-dimensional vectors, "
+                    f"but the store was opened with dimension {self.dimension}"
+                )
+            self._vectors_file = state["vectors_file"]
+            self._vectors = np.load(self._file(self._vectors_file), mmap_mode="r+")
+            self._rows = [None] * int(state["row_count"])
+            columns = ["id", "pdf_id", "content", "page_number", "chunk_index", "page_hash", "metadata", "created_at"]
+            for row, *values in self._conn.execute(f"SELECT row, {', '.join(columns)} FROM chunks"):
+                fields = dict(zip(columns, values))
+                fields["metadata"] = json.loads(fields["metadata"])
+                self._rows[row] = fields
+            self._sources = dict(self._conn.execute("SELECT pdf_id, source_key FROM sources"))
+            self._live = np.array([row is not None for row in self._rows], dtype=bool)
+
+            # Vectors files left behind by a crash around a compaction
+            for name in os.listdir(self.path):
+                if name.startswith("vectors") and name.endswith(".npy") and name != self._vectors_file:
+                    os.remove(self._file(name))
+
+    def _initialize(self):
+        """Create an empty store"""
+        self._rows = []
+        self._sources = {}
+        self._vectors_file = self._new_vectors_file()
+        vectors = self._allocate(INITIAL_CAPACITY, self._vectors_file)
+        vectors.flush()
+        del vectors
+        self._commit([], 0, renumbered=False, doc_ids=[])
+
+    def _new_vectors_file(self) -> str:
+        return f"vectors-{uuid.uuid4().hex[:12]}.npy"
+
+    def _allocate(self, capacity: int, name: str) -> np.memmap:
+        return np.lib.format.open_memmap(
+            self._file(name), mode="w+", dtype=np.float32, shape=(capacity, self.dimension)
+        )
+
+    def _commit(self, deleted_ids: List[str], first_new: int, renumbered: bool, doc_ids: Iterable[str]):
+        """Persist deleted rows, rows from first_new on, and the source keys of doc_ids in one transaction.
+
+        Vectors must be flushed first: the committed rows are what makes them visible.
+        """
+        with self._conn:
+            self._conn.executemany("DELETE FROM chunks WHERE id = ?", [(id,) for id in deleted_ids])
+            if renumbered:
+                self._conn.executemany(
+                    "UPDATE chunks SET row = ? WHERE id = ?",
+                    [(i, row["id"]) for i, row in enumerate(self._rows[:first_new]) if row is not None],
+                )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        row["id"],
+                        i,
+                        row["pdf_id"],
+                        row["content"],
+                        row["page_number"],
+                        row["chunk_index"],
+                        row.get("page_hash"),
+                        json.dumps(row["metadata"]),
+                        row["created_at"],
+                    )
+                    for i, row in enumerate(self._rows[first_new:], start=first_new)
+                    if row is not None
+                ],
+            )
+            for doc_id in doc_ids:
+                if doc_id in self._sources:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO sources VALUES (?, ?)", (doc_id, self._sources[doc_id])
+                    )
+                else:
+                    self._conn.execute("DELETE FROM sources WHERE pdf_id = ?", (doc_id,))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO state VALUES (?, ?)",
+                [
+                    ("vectors_file", self._vectors_file),
+                    ("row_count", str(len(self._rows))),
+                    ("dimension", str(self.dimension)),
+                ],
+            )
+
+    def _tombstone(self, doc_id: str, predicate: Callable[[Dict[str, Any]], bool]) -> List[str]:
+        deleted = []
+        for i, row in enumerate(self._rows):
+            if row is not None and row["pdf_id"] == doc_id and predicate(row):
+                self._rows[i] = None
+                deleted.append(row["id"])
+        if deleted:
+            self._live = np.array([row is not None for row in self._rows], dtype=bool)
+        return deleted
+
+    def _make_room(self, extra: int) -> bool:
+        """Compact or grow into a new vectors file when needed; True if rows were renumbered.
+
+        The new file only becomes current when the caller commits, so the old one stays intact
+        until then.
+        """
+        if len(self._rows) and self._live.sum() * 2 < len(self._rows):
+            keep = np.flatnonzero(self._live)
+            capacity = max(INITIAL_CAPACITY, 2 * len(keep), len(keep) + extra)
+        elif len(self._rows) + extra > len(self._vectors):
+            keep = np.arange(len(self._rows))
+            capacity = max(len(self._rows) + extra, 2 * len(self._vectors))
+        else:
+            return False
+
+        name = self._new_vectors_file()
+        vectors = self._allocate(capacity, name)
+        for start in range(0, len(keep), SEARCH_BLOCK_ROWS):
+            block = keep[start:start + SEARCH_BLOCK_ROWS]
+            vectors[start:start + len(block)] = self._vectors[block]
+        vectors.flush()
+        self._vectors = vectors
+        self._vectors_file = name
+
+        renumbered = len(keep) < len(self._rows)
+        if renumbered:
+            self._rows = [self._rows[i] for i in keep]
+            self._live = np.ones(len(self._rows), dtype=bool)
+        return renumbered
+
+    def _remove_unless_current(self, name: str):
+        if name != self._vectors_file:
+            os.remove(self._file(name))
+
+    def _sync(
+        self,
+        doc_id: str,
+        chunks: List[PageChunk],
+        embeddings: List[List[float]],
+        metadata: Dict[str, Any],
+        source_key: Optional[str],
+        delete_ids: Set[str],
+        partial: bool,
+    ) -> IndexResult:
+        vectors = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dimension)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.where(norms == 0, 1, norms)
+        created_at = datetime.utcnow().isoformat()
+        ids = [chunk_id(doc_id, chunk) for chunk in chunks]
+
+        result = IndexResult()
+        with self._lock:
+            # Upserted chunks replace any row with the same id
+            replaced = set(ids)
+            deleted_ids = self._tombstone(doc_id, lambda row: row["id"] in delete_ids or row["id"] in replaced)
+            result.deleted = sum(id in delete_ids for id in deleted_ids)
+
+            previous_file = self._vectors_file
+            renumbered = self._make_room(len(chunks))
+            start = len(self._rows)
+            # Rows past the committed ones aren't referenced yet, so writing them in place is safe
+            self._vectors[start:start + len(chunks)] = vectors
+            self._vectors.flush()
+            self._rows.extend(
+                {
+                    "id": id,
+                    "pdf_id": doc_id,
+                    "content": chunk.content,
+                    "page_number": chunk.page_num,
+                    "chunk_index": chunk.chunk_index,
+                    "page_hash": chunk.page_hash,
+                    "metadata": metadata,
+                    "created_at": created_at,
+                }
+                for id, chunk in zip(ids, chunks)
+            )
+            self._live = np.concatenate([self._live, np.ones(len(chunks), dtype=bool)])
+            if not partial:
+                self._sources[doc_id] = source_key
+            self._commit(deleted_ids, start, renumbered, [doc_id])
+            self._remove_unless_current(previous_file)
+        result.indexed = len(chunks)
+        return result
+
+    async def get_chunk_state(self, doc_id: str) -> Dict[str, ChunkState]:
+        with self._lock:
+            return {
+                row["id"]: ChunkState(
+                    page_number=row["page_number"],
+                    page_hash=row.get("page_hash"),
+                )
+                for row in self._rows
+                if row is not None and row["pdf_id"] == doc_id
+            }
+
+    async def get_source_key(self, doc_id: str) -> Optional[str]:
+        with self._lock:
+            return self._sources.get(doc_id)
+
+    async def sync_document(
+        self,
+        doc_id: str,
+        chunks: List[PageChunk],
+        embeddings: List[List[float]],
+        metadata: Dict[str, Any],
+        source_key: Optional[str],
+        delete_ids: Iterable[str] = (),
+        refresh: Optional[str] = None,
+        partial: bool = False,
+    ) -> IndexResult:
+        with timed("numpy.write", VECTOR_STORE_SECONDS, "numpy", "write", pdf_id=doc_id):
+            result = await asyncio.to_thread(
+                self._sync, doc_id, chunks, embeddings, metadata, source_key, set(delete_ids), partial
+            )
+        if result.indexed or result.deleted:
+            self._notify_change()
+        return result
+
+    def _matches(self, row: Optional[Dict[str, Any]], filters: Dict[str, Any]) -> bool:
+        if row is None:
+            return False
+        for key, value in filters.items():
+            actual = row["pdf_id"] if key == "pdf_id" else row["metadata"].get(key)
+            if key == "pdf_id":
+                value = str(value)
+            if actual != value:
+                return False
+        return True
+
+    def search_batch(
+        self,
+        query_embeddings: List[List[float]],
+        top_k: int = 5,
+        filters: Optional[Dict[str, Any]] = None,
+    ) -> List[List[Dict[str, Any]]]:
+        """Score all queries against every live row and keep the best chunk of the top_k documents"""
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(-1, self.dimension)
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries /= np.where(norms == 0, 1, norms)
+
+        with self._lock:
+            count = len(self._rows)
+            mask = self._live.copy()
+            if filters:
+                mask &= np.array([self._matches(row, filters) for row in self._rows], dtype=bool)
+            scores = np.full((len(queries), count), -np.inf, dtype=np.float32)
+            for start in range(0, count, SEARCH_BLOCK_ROWS):
+                end = min(start + SEARCH_BLOCK_ROWS, count)
+                scores[:, start:end] = queries @ self._vectors[start:end].T
+            scores[:, ~mask] = -np.inf
+            # Deletes replace rows with None in place
+            rows = list(self._rows)
+
+        results = []
+        for query_scores in scores:
+            # Rank a few candidates per wanted document first, the whole array only if they collapse
+            # into fewer than top_k documents
+            candidates = min(count, top_k * SEARCH_CANDIDATES_PER_DOC)
+            while True:
+                if candidates < count:
+                    order = np.argpartition(-query_scores, candidates - 1)[:candidates]
+                    order = order[np.argsort(-query_scores[order], kind="stable")]
+                else:
+                    order = np.argsort(-query_scores, kind="stable")
+                best = self._best_per_document(order, query_scores, rows, top_k)
+                if len(best) >= top_k or candidates >= count:
+                    break
+                candidates = count
+            results.append(list(best.values()))
+        return results
+
+    def _best_per_document(
+        self, order: np.ndarray, scores: np.ndarray, rows: List[Optional[Dict[str, Any]]], top_k: int
+    ) -> Dict[str, Dict[str, Any]]:
+        best: Dict[str, Dict[str, Any]] = {}
+        for i in order:
+            if not np.isfinite(scores[i]) or len(best) >= top_k:
+                break
+            row = rows[i]
+            if row["pdf_id"] not in best:
+                best[row["pdf_id"]] = {
+                    "id": row["pdf_id"],
+                    "content": row["content"],
+                    "page_number": row["page_number"],
+                    # Same scale as OpenSearch's cosinesimil score
+                    "score": float((1 + scores[i]) / 2),
+                    "metadata": row["metadata"],
+                }
+        return best
+
+    async def search_documents(
+        self,
+        query_embedding: List[float],
+        top_k: int = 5,
+        filters: Optional[Dict[str, Any]] = None,
+    ) -> List[Dict[str, Any]]:
+        with timed("numpy.search", VECTOR_STORE_SECONDS, "numpy", "search"):
+            [results] = await asyncio.to_thread(self.search_batch, [query_embedding], top_k, filters)
+        return results
+
+    async def search_documents_batch(
+        self,
+        query_embeddings: List[List[float]],
+        top_k: int = 5,
+        filters: Optional[Dict[str, Any]] = None,
+    ) -> List[List[Dict[str, Any]]]:
+        """All queries in one pass over the vectors"""
+        if not query_embeddings:
+            return []
+        with timed("numpy.search", VECTOR_STORE_SECONDS, "numpy", "search_batch", queries=len(query_embeddings)):
+            return await asyncio.to_thread(self.search_batch, query_embeddings, top_k, filters)
+
+    def _delete(self, doc_id: str) -> int:
+        with self._lock:
+            deleted_ids = self._tombstone(doc_id, lambda row: True)
+            had_source = doc_id in self._sources
+            self._sources.pop(doc_id, None)
+            if deleted_ids or had_source:
+                previous_file = self._vectors_file
+                renumbered = self._make_room(0)
+                self._commit(deleted_ids, len(self._rows), renumbered, [doc_id])
+                self._remove_unless_current(previous_file)
+        return len(deleted_ids)
+
+    async def delete_document(self, doc_id: str) -> bool:
+        with timed("numpy.delete", VECTOR_STORE_SECONDS, "numpy", "delete", pdf_id=doc_id):
+            deleted = await asyncio.to_thread(self._delete, doc_id)
+        if deleted:
+            self._notify_change()
+        return deleted > 0
+
+    async def get_document(self, doc_id: str) -> Dict[str, Any]:
+        with self._lock:
+            rows = [row for row in self._rows if row is not None and row["pdf_id"] == doc_id]
+        rows.sort(key=lambda row: (row["page_number"], row["chunk_index"]))
+        metadata = rows[0]["metadata"] if rows else {}
+        return {
+            "id": doc_id,
+            "content": "\n\n".join(row["content"] for row in rows),
+            "metadata": metadata,
+        }
@@ -0,0 +1,283 @@
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, Optional, Tuple
+
+import openai
+
+from metrics import OPENAI_CONCURRENCY_LIMIT, OPENAI_QUEUE_SECONDS, OPENAI_RETRIES
+
+
+# Requests per model allowed in flight at once; 429s lower it, successes raise it back
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "32"))
+# Retries of a rate-limited or failed request before its error is raised
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "6"))
+# Exponential backoff bounds in seconds, with full jitter
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", "0.5"))
+OPENAI_BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", "30"))
+
+# Lower values are admitted first when a model's budget is contended
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BULK: "bulk"}
+
+# Statuses worth retrying: timeouts, conflicts, rate limits and server errors
+RETRYABLE_STATUSES = {408, 409, 429}
+
+
+class TokenBucket:
+    """Budget of units per minute refilled continuously, holding at most a minute's worth; 0 is unlimited"""
+
+    def __init__(self, per_minute: int):
+        self.per_minute = per_minute
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if self.per_minute > 0:
+            self.level = min(self.per_minute, self.level + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+
+    def wait_time(self, amount: int, now: float) -> float:
+        """Seconds until amount is available; requests larger than the bucket wait for a full one"""
+        if self.per_minute <= 0:
+            return 0.0
+        self._refill(now)
+        missing = min(amount, self.per_minute) - self.level
+        return max(0.0, missing * 60 / self.per_minute)
+
+    def take(self, amount: int, now: float):
+        self._refill(now)
+        self.level -= amount
+
+    def set_limit(self, per_minute: int, now: float):
+        self._refill(now)
+        self.per_minute = per_minute
+        self.level = min(self.level, per_minute)
+
+    def sync(self, remaining: int, now: float):
+        """Trust the server when it has less budget left than we think, e.g. other processes share the key"""
+        self._refill(now)
+        self.level = min(self.level, remaining)
+
+
+class ModelLimiter:
+    """Admits one model's requests by priority within its request and token budgets and concurrency limit.
+
+    The concurrency limit is additive-increase/multiplicative-decrease: halved on a 429 and
+    raised by one after a limit's worth of successes.
+    """
+
+    def __init__(self, model: str, rpm: int, tpm: int, max_concurrency: int = OPENAI_MAX_CONCURRENCY):
+        self.model = model
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = self.max_concurrency
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self._successes = 0
+        self._last_decrease = 0.0
+        # (priority, arrival, tokens, future); FIFO within a priority
+        self._waiters: List[Tuple[int, int, int, asyncio.Future]] = []
+        self._arrivals = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        OPENAI_CONCURRENCY_LIMIT.labels(model).set(self.limit)
+
+    async def acquire(self, tokens: int, priority: int):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._arrivals), tokens, future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Cancelled right after being admitted: hand the slot back
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    def observe(self, headers: Mapping[str, str]):
+        """Adopt the limits and remaining budget OpenAI reports, on successes and 429s alike"""
+        now = time.monotonic()
+        limit_requests = _int_header(headers, "x-ratelimit-limit-requests")
+        limit_tokens = _int_header(headers, "x-ratelimit-limit-tokens")
+        remaining_requests = _int_header(headers, "x-ratelimit-remaining-requests")
+        remaining_tokens = _int_header(headers, "x-ratelimit-remaining-tokens")
+        if limit_requests:
+            self.requests.set_limit(limit_requests, now)
+        if limit_tokens:
+            self.tokens.set_limit(limit_tokens, now)
+        if remaining_requests is not None:
+            self.requests.sync(remaining_requests, now)
+        if remaining_tokens is not None:
+            self.tokens.sync(remaining_tokens, now)
+
+    def on_success(self):
+        self._successes += 1
+        if self._successes >= self.limit and self.limit < self.max_concurrency:
+            self._successes = 0
+            self._set_limit(self.limit + 1)
+
+    def on_rate_limited(self, started_at: float, pause: float):
+        """Back off after a 429: pause admissions, and halve the limit once per burst of 429s"""
+        now = time.monotonic()
+        self.paused_until = max(self.paused_until, now + pause)
+        # Requests sent before the last decrease saw the old limit, so they don't count again
+        if started_at >= self._last_decrease:
+            self._last_decrease = now
+            self._successes = 0
+            self._set_limit(max(1, self.limit // 2))
+
+    def settle(self, estimated_tokens: int, actual_tokens: int):
+        """Correct the token budget once the response reports the tokens actually used"""
+        if self.tokens.per_minute > 0:
+            self.tokens.level = min(self.tokens.per_minute, self.tokens.level + estimated_tokens - actual_tokens)
+
+    def _set_limit(self, limit: int):
+        self.limit = limit
+        OPENAI_CONCURRENCY_LIMIT.labels(self.model).set(limit)
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        now = time.monotonic()
+        while self._waiters:
+            _, _, tokens, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if self.in_flight >= self.limit:
+                return  # release() dispatches again
+
+            wait = max(
+                self.paused_until - now,
+                self.requests.wait_time(1, now),
+                self.tokens.wait_time(tokens, now),
+            )
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+
+            heapq.heappop(self._waiters)
+            self.requests.take(1, now)
+            self.tokens.take(tokens, now)
+            self.in_flight += 1
+            future.set_result(None)
+
+
+class OpenAIScheduler:
+    """Process-wide gate in front of OpenAI requests: per model budgets, priorities and retries"""
+
+    def __init__(self, max_retries: int = OPENAI_MAX_RETRIES):
+        self.max_retries = max_retries
+        self._limiters: Dict[str, ModelLimiter] = {}
+
+    def configure(self, model: str, rpm: int, tpm: int):
+        """Set a model's starting budgets; the limits OpenAI reports in response headers replace them"""
+        if model not in self._limiters:
+            self._limiters[model] = ModelLimiter(model, rpm, tpm)
+
+    async def call(
+        self,
+        model: str,
+        tokens: int,
+        request: Callable[[], Awaitable[Any]],
+        priority: int = PRIORITY_BULK,
+    ) -> Any:
+        """Send request() once admitted and return its parsed response.
+
+        request must return a raw response (the client's with_raw_response), so the rate
+        limit headers can be read. Rate limits, timeouts and server errors are retried with
+        jittered exponential backoff; other errors are raised at once.
+        """
+        self.configure(model, 0, 0)
+        limiter = self._limiters[model]
+
+        for attempt in range(self.max_retries + 1):
+            queued = time.perf_counter()
+            await limiter.acquire(tokens, priority)
+            OPENAI_QUEUE_SECONDS.labels(model, PRIORITY_NAMES[priority]).observe(time.perf_counter() - queued)
+
+            started_at = time.monotonic()
+            try:
+                raw = await request()
+            except (openai.APIStatusError, openai.APIConnectionError) as e:
+                limiter.release()
+                status = getattr(e, "status_code", None)
+                if attempt >= self.max_retries or not _is_retryable(e):
+                    raise
+
+                retry_after = None
+                if status is not None:
+                    limiter.observe(e.response.headers)
+                    retry_after = _retry_after(e.response.headers)
+                delay = max(retry_after or 0.0, _backoff(attempt))
+                if status == 429:
+                    limiter.on_rate_limited(started_at, retry_after if retry_after is not None else delay)
+                OPENAI_RETRIES.labels(model, "rate_limit" if status == 429 else "error").inc()
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                limiter.release()
+                raise
+
+            limiter.observe(raw.headers)
+            limiter.on_success()
+            limiter.release()
+            response = raw.parse()
+            usage = getattr(response, "usage", None)
+            if usage is not None:
+                limiter.settle(tokens, usage.total_tokens)
+            return response
+
+
+def _is_retryable(error: openai.APIError) -> bool:
+    status = getattr(error, "status_code", None)
+    if status is None:  # The connection failed or timed out
+        return True
+    if error.code == "insufficient_quota":  # A 429 that waiting won't fix
+        return False
+    return status in RETRYABLE_STATUSES or status >= 500
+
+
+def _backoff(attempt: int) -> float:
+    return random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt))
+
+
+def _retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """Seconds the server asked us to wait, from retry-after-ms or retry-after"""
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers["retry-after"])
+    except ValueError:  # e.g. an HTTP date, which OpenAI doesn't send
+        pass
+    return None
+
+
+def _int_header(headers: Mapping[str, str], name: str) -> Optional[int]:
+    try:
+        return int(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+_scheduler: Optional[OpenAIScheduler] = None
+
+
+def get_openai_scheduler() -> OpenAIScheduler:
+    """Return the process-wide scheduler so all callers share one budget per model"""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = OpenAIScheduler()
+    return _scheduler
@@ -1,166 +1,492 @@
+import asyncio
 import os
+import time
 from datetime import datetime
-from typing import List, Dict, Any
-from opensearchpy import OpenSearch
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple, TypeVar
+from opensearchpy import AsyncOpenSearch, NotFoundError
+from opensearchpy.helpers import async_streaming_bulk
 
 from ai_utils import PageChunk
+from index_profiles import IndexProfile, build_index_body, get_index_profile, physical_index_name
+from metrics import VECTOR_STORE_SECONDS, timed
+from vector_store import ChunkState, IndexResult, VectorStore, chunk_id
 
 
-class OpenSearchClient:
-    def __init__(self):
-        self.client = OpenSearch(
+# Upper bounds for a single _bulk request
+BULK_CHUNK_SIZE = int(os.getenv("OPENSEARCH_BULK_CHUNK_SIZE", "500"))
+BULK_MAX_BYTES = int(os.getenv("OPENSEARCH_BULK_MAX_BYTES", str(10 * 1024 * 1024)))
+# "end" refreshes the index once after all chunks are written, "none" leaves it to the refresh interval
+REFRESH_POLICY = os.getenv("OPENSEARCH_REFRESH_POLICY", "end")
+# Connections kept open per OpenSearch node
+POOL_MAXSIZE = int(os.getenv("OPENSEARCH_POOL_MAXSIZE", "25"))
+# Nearest chunks fetched per requested document before collapsing them by pdf_id
+SEARCH_CANDIDATES_PER_DOC = int(os.getenv("OPENSEARCH_SEARCH_CANDIDATES_PER_DOC", "4"))
+# Upper bound on k for a single k-NN query
+SEARCH_MAX_CANDIDATES = int(os.getenv("OPENSEARCH_SEARCH_MAX_CANDIDATES", "1000"))
+# Chunks fetched per page when reading a whole document back
+GET_DOCUMENT_PAGE_SIZE = 500
+# Seconds a process keeps using the index it found behind the alias before looking again;
+# reindex.py waits for this after swapping the alias before retiring the old index
+ALIAS_REFRESH_SECONDS = float(os.getenv("OPENSEARCH_ALIAS_REFRESH_SECONDS", "30"))
+# Seconds between checks on the pdf_id backfill started at startup, and the timeout for starting it
+BACKFILL_POLL_SECONDS = float(os.getenv("OPENSEARCH_BACKFILL_POLL_SECONDS", "10"))
+BACKFILL_REQUEST_TIMEOUT = float(os.getenv("OPENSEARCH_BACKFILL_REQUEST_TIMEOUT", "60"))
+# Bulk item errors meaning reindex.py retired the index the writes were sent to
+RETIRED_INDEX_ERRORS = {"index_not_found_exception", "cluster_block_exception"}
+
+T = TypeVar("T")
+
+
+class OpenSearchClient(VectorStore):
+    def __init__(self, profile: Optional[IndexProfile] = None):
+        super().__init__()
+        self.client = AsyncOpenSearch(
             hosts=[os.getenv("OPENSEARCH_URL", "http://opensearch:9200")],
             http_auth=None,
             use_ssl=False,
             verify_certs=False,
             ssl_show_warn=False,
+            maxsize=POOL_MAXSIZE,
         )
+        # An alias over the physical index, so reindex.py can swap it without downtime
         self.index_name = "pdf_documents"
-        self.ensure_index()
+        # One small record per document with the source key of its last complete sync
+        self.sources_index_name = "pdf_document_sources"
+        self.profile = profile or get_index_profile()
+        # (physical index, its profile) resolved from the alias, see _resolve
+        self._target: Optional[Tuple[str, IndexProfile]] = None
+        self._target_expires = 0.0
+        self._backfill: Optional[asyncio.Task] = None
 
-    def ensure_index(self):
-        index_body = {
-            "mappings": {
-                "properties": {
-                    "content": {"type": "text"},
-                    "page_number": {"type": "integer"},  # Add page number field
-                    "chunk_index": {"type": "integer"},
-                    "embedding": {
-                        "type": "knn_vector",
-                        "dimension": 1536,
-                        "method": {
-                            "name": "hnsw",
-                            "space_type": "cosinesimil",
-                            "engine": "nmslib",
-                        },
+    async def close(self):
+        if self._backfill is not None:
+            # The update_by_query task keeps running in OpenSearch
+            self._backfill.cancel()
+            await asyncio.gather(self._backfill, return_exceptions=True)
+        await self.client.close()
+
+    async def ensure_index(self):
+        """Create the index behind the alias if missing, otherwise adopt its profile"""
+        if not await self.client.indices.exists(self.index_name):
+            if self.profile.requires_training:
+                raise Exception(
+                    f"Index profile {self.profile.name} needs a trained model, create the index with reindex.py"
+                )
+            await self.client.indices.create(
+                index=physical_index_name(self.index_name, self.profile),
+                body={**build_index_body(self.profile), "aliases": {self.index_name: {}}},
+            )
+        else:
+            await self.migrate_mapping()
+        await self._resolve(refresh=True)
+
+        if not await self.client.indices.exists(self.sources_index_name):
+            await self.client.indices.create(
+                index=self.sources_index_name,
+                body={
+                    "mappings": {
+                        "properties": {
+                            "source_key": {"type": "keyword"},
+                            "updated_at": {"type": "date"},
+                        }
                     },
-                    "created_at": {"type": "date"},
-                    "metadata": {"type": "object", "enabled": True},
+                    "settings": {"index": {"number_of_shards": 1}},
+                },
+            )
+
+    async def live_profile(self, index: Optional[str] = None) -> IndexProfile:
+        """Profile the index currently behind the alias, or the given index, was created with"""
+        mappings = await self.client.indices.get_mapping(index=index or self.index_name)
+        [mapping] = mappings.values()
+        # Indexes from before profiles existed use the original nmslib mapping
+        name = mapping["mappings"].get("_meta", {}).get("profile", "nmslib_hnsw")
+        return get_index_profile(name)
+
+    async def _resolve(self, refresh: bool = False) -> Tuple[str, IndexProfile]:
+        """Physical index behind the alias and the profile its vectors are encoded with.
+
+        Searches and writes go to this index rather than through the alias, so vectors are always
+        encoded for the index they meet, even right after reindex.py moves the alias to a profile
+        with another encoding. Writes still landing in the old index are copied over by the final
+        catch-up pass of reindex.py.
+        """
+        if refresh or self._target is None or time.monotonic() >= self._target_expires:
+            if await self.client.indices.exists_alias(name=self.index_name):
+                [index] = (await self.client.indices.get_alias(name=self.index_name)).keys()
+                self._target_expires = time.monotonic() + ALIAS_REFRESH_SECONDS
+            else:
+                # A pre-alias deployment: the name turns into an alias once migrated, so look every time
+                index = self.index_name
+                self._target_expires = 0.0
+            self.profile = await self.live_profile(index)
+            self._target = (index, self.profile)
+        return self._target
+
+    async def _on_live_index(self, operation: Callable[[str, IndexProfile], Awaitable[T]]) -> T:
+        """Run operation(index, profile), following the alias again if the index was retired meanwhile"""
+        index, profile = await self._resolve()
+        try:
+            return await operation(index, profile)
+        except NotFoundError:
+            index, profile = await self._resolve(refresh=True)
+            return await operation(index, profile)
+
+    async def migrate_mapping(self):
+        """Add fields missing from indexes created before they existed, backfilling pdf_id from _id.
+
+        The backfill runs as an OpenSearch task that is only polled in the background, so startup
+        doesn't wait for it on large indexes. Until it finishes, lookups by pdf_id (document
+        reads, deletes, re-indexing diffs) miss the legacy chunks it hasn't reached yet, and
+        searches collapse those chunks into a single result.
+        """
+        await self.client.indices.put_mapping(
+            index=self.index_name,
+            body={
+                "properties": {
+                    "pdf_id": {"type": "keyword"},
+                    "page_hash": {"type": "keyword"},
                 }
             },
-            "settings": {
-                "index": {
-                    "knn": True,
-                    "knn.algo_param.ef_search": 100,
-                    "number_of_shards": 1,
-                    "number_of_replicas": 0,
-                }
+        )
+        missing = {"bool": {"must_not": {"exists": {"field": "pdf_id"}}}}
+        count = await self.client.count(index=self.index_name, body={"query": missing})
+        if not count["count"]:
+            return
+
+        print(f"Backfilling pdf_id on {count['count']} chunks in {self.index_name}")
+        # Chunk ids are "<pdf_id>_<chunk_index>" or "<pdf_id>_<content hash>"
+        response = await self.client.update_by_query(
+            index=self.index_name,
+            body={
+                "query": missing,
+                "script": {
+                    "lang": "painless",
+                    "source": "ctx._source.pdf_id = ctx._id.substring(0, ctx._id.lastIndexOf('_'))",
+                },
             },
-        }
+            conflicts="proceed",
+            refresh=True,
+            wait_for_completion=False,
+            request_timeout=BACKFILL_REQUEST_TIMEOUT,
+        )
+        self._backfill = asyncio.create_task(self._wait_for_backfill(response["task"]))
 
-        if not self.client.indices.exists(self.index_name):
-            self.client.indices.create(index=self.index_name, body=index_body)
+    async def _wait_for_backfill(self, task_id: str):
+        while True:
+            await asyncio.sleep(BACKFILL_POLL_SECONDS)
+            try:
+                task = await self.client.tasks.get(task_id=task_id)
+            except Exception as e:
+                print(f"Error checking pdf_id backfill {task_id}: {str(e)}")
+                continue
+            if task.get("completed"):
+                break
+
+        failures = task.get("error") or task.get("response", {}).get("failures")
+        if failures:
+            # Chunks still missing pdf_id are picked up again on the next startup
+            print(f"pdf_id backfill {task_id} failed: {str(failures)[:500]}")
+        else:
+            print(f"Backfilled pdf_id on {task['response'].get('updated', 0)} chunks")
+            self._notify_change()
+
+    async def get_chunk_state(self, doc_id: str) -> Dict[str, ChunkState]:
+        state = {}
+        search_after = None
+        while True:
+            body = {
+                "query": {"term": {"pdf_id": doc_id}},
+                "sort": [{"page_number": "asc"}, {"chunk_index": "asc"}],
+                "_source": ["page_number", "page_hash"],
+                "size": GET_DOCUMENT_PAGE_SIZE,
+            }
+            if search_after is not None:
+                body["search_after"] = search_after
+            response = await self.client.search(index=self.index_name, body=body)
 
-    async def index_document(
+            hits = response["hits"]["hits"]
+            for hit in hits:
+                state[hit["_id"]] = ChunkState(
+                    page_number=hit["_source"]["page_number"],
+                    page_hash=hit["_source"].get("page_hash"),
+                )
+            if len(hits) < GET_DOCUMENT_PAGE_SIZE:
+                return state
+            search_after = hits[-1]["sort"]
+
+    async def get_source_key(self, doc_id: str) -> Optional[str]:
+        response = await self.client.get(index=self.sources_index_name, id=doc_id, ignore=404)
+        return response["_source"].get("source_key") if response.get("found") else None
+
+    async def sync_document(
         self,
         doc_id: str,
         chunks: List[PageChunk],
-        metadata: Dict[str, Any],
         embeddings: List[List[float]],
-    ):
+        metadata: Dict[str, Any],
+        source_key: Optional[str],
+        delete_ids: Iterable[str] = (),
+        refresh: Optional[str] = None,
+        partial: bool = False,
+    ) -> IndexResult:
+        """Write new chunks and delete stale ones in one bulk stream"""
         try:
-            if len(chunks) != len(embeddings):
-                print(
-                    f"Warning: Number of chunks ({len(chunks)}) doesn't match number of embeddings ({len(embeddings)})"
+            created_at = datetime.utcnow().isoformat()
+            target = await self._resolve()
+            result = await self._bulk(target, doc_id, chunks, embeddings, metadata, delete_ids, created_at)
+            if any(_error_type(item) in RETIRED_INDEX_ERRORS for item in result.errors):
+                # reindex.py moved the alias and retired the index; writes are idempotent, so redo them
+                retarget = await self._resolve(refresh=True)
+                if retarget != target:
+                    target = retarget
+                    result = await self._bulk(target, doc_id, chunks, embeddings, metadata, delete_ids, created_at)
+
+            # Recorded last, so a partly failed sync is never mistaken for a complete one
+            if result.ok and not partial:
+                await self.client.index(
+                    index=self.sources_index_name,
+                    id=doc_id,
+                    body={"source_key": source_key, "updated_at": created_at},
                 )
-                length = min(len(chunks), len(embeddings))
-                chunks = chunks[:length]
-                embeddings = embeddings[:length]
-
-            for i, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
-                document = {
-                    "content": chunk.content,
-                    "page_number": chunk.page_num,
-                    "chunk_index": i,
-                    "embedding": embedding,
-                    "metadata": metadata,
-                    "created_at": datetime.utcnow().isoformat(),
-                }
 
-                response = self.client.index(
-                    index=self.index_name,
-                    id=f"{doc_id}_{i}",
-                    body=document,
-                    refresh=True,
+            if not partial and (refresh or REFRESH_POLICY) == "end":
+                await self.client.indices.refresh(index=target[0])
+
+            if result.indexed or result.deleted:
+                self._notify_change()
+
+            if result.errors:
+                print(
+                    f"Failed {len(result.errors)} chunk operations for document {doc_id}: {result.errors[:3]}"
                 )
 
-            return True
+            return result
 
         except Exception as e:
             print(f"Error indexing document {doc_id}: {str(e)}")
             raise
 
+    async def _bulk(
+        self,
+        target: Tuple[str, IndexProfile],
+        doc_id: str,
+        chunks: List[PageChunk],
+        embeddings: List[List[float]],
+        metadata: Dict[str, Any],
+        delete_ids: Iterable[str],
+        created_at: str,
+    ) -> IndexResult:
+        index, profile = target
+
+        def actions():
+            for chunk, embedding in zip(chunks, embeddings):
+                yield {
+                    "_index": index,
+                    "_id": chunk_id(doc_id, chunk),
+                    "_source": {
+                        "pdf_id": doc_id,
+                        "content": chunk.content,
+                        "page_number": chunk.page_num,
+                        "chunk_index": chunk.chunk_index,
+                        "page_hash": chunk.page_hash,
+                        "embedding": profile.encode(embedding),
+                        "metadata": metadata,
+                        "created_at": created_at,
+                    },
+                }
+            for id in delete_ids:
+                yield {"_op_type": "delete", "_index": index, "_id": id}
+
+        result = IndexResult()
+        with timed("opensearch.bulk", VECTOR_STORE_SECONDS, "opensearch", "write", pdf_id=doc_id):
+            async for ok, item in async_streaming_bulk(
+                self.client,
+                actions(),
+                chunk_size=BULK_CHUNK_SIZE,
+                max_chunk_bytes=BULK_MAX_BYTES,
+                raise_on_error=False,
+            ):
+                [(op_type, info)] = item.items()
+                if op_type == "delete" and info.get("status") == 404 and "error" not in info:
+                    continue
+                if not ok:
+                    result.errors.append(item)
+                elif op_type == "index":
+                    result.indexed += 1
+                elif op_type == "delete":
+                    result.deleted += 1
+        return result
+
     async def search_documents(
-        self, query_embedding: List[float], top_k: int = 5
+        self,
+        query_embedding: List[float],
+        top_k: int = 5,
+        filters: Optional[Dict[str, Any]] = None,
     ) -> List[Dict[str, Any]]:
+        """Return the best matching chunk of each of the top_k closest documents"""
         try:
-            knn_query = {
-                "knn": {"embedding": {"vector": query_embedding, "k": top_k * 2}}
-            }
-
-            response = self.client.search(
-                index=self.index_name,
-                body={
-                    "query": knn_query,
-                    "_source": ["content", "chunk_index", "page_number", "metadata"],
-                    "size": top_k * 2,
-                },
+            k = min(top_k * SEARCH_CANDIDATES_PER_DOC, SEARCH_MAX_CANDIDATES)
+            return await self._on_live_index(
+                lambda index, profile: self._search(index, profile.encode(query_embedding), top_k, filters, k)
             )
+        except Exception as e:
+            print(f"Error searching documents: {str(e)}")
+            raise
 
-            # Group by original document ID and take the highest scoring chunk
-            results_by_doc = {}
-            for hit in response["hits"]["hits"]:
-                doc_id = hit["_id"].split("_")[0]
-                if (
-                    doc_id not in results_by_doc
-                    or hit["_score"] > results_by_doc[doc_id]["score"]
-                ):
-                    results_by_doc[doc_id] = {
-                        "id": doc_id,
-                        "content": hit["_source"]["content"],
-                        "page_number": hit["_source"]["page_number"],
-                        "score": hit["_score"],
-                        "metadata": hit["_source"].get("metadata", {}),
-                    }
-
-            return list(results_by_doc.values())[:top_k]
-
+    async def search_documents_batch(
+        self,
+        query_embeddings: List[List[float]],
+        top_k: int = 5,
+        filters: Optional[Dict[str, Any]] = None,
+    ) -> List[List[Dict[str, Any]]]:
+        """Run all queries in one _msearch round trip"""
+        if not query_embeddings:
+            return []
+        try:
+            return await self._on_live_index(
+                lambda index, profile: self._search_batch(index, profile, query_embeddings, top_k, filters)
+            )
         except Exception as e:
             print(f"Error searching documents: {str(e)}")
             raise
 
+    async def _search_batch(
+        self,
+        index: str,
+        profile: IndexProfile,
+        query_embeddings: List[List[float]],
+        top_k: int,
+        filters: Optional[Dict[str, Any]],
+    ) -> List[List[Dict[str, Any]]]:
+        vectors = [profile.encode(embedding) for embedding in query_embeddings]
+        k = min(top_k * SEARCH_CANDIDATES_PER_DOC, SEARCH_MAX_CANDIDATES)
+        body = []
+        for vector in vectors:
+            body.extend([{}, self._search_body(vector, top_k, filters, k)])
+        with timed(
+            "opensearch.msearch", VECTOR_STORE_SECONDS, "opensearch", "msearch", queries=len(vectors), k=k
+        ):
+            response = await self.client.msearch(index=index, body=body)
+
+        items = response["responses"]
+        for item in items:
+            if "error" in item:
+                if item["error"].get("type") == "index_not_found_exception":
+                    raise NotFoundError(404, "index_not_found_exception", item["error"])
+                raise Exception(f"Search failed: {item['error']}")
+
+        # Rare: a query's candidates collapsed into too few documents, so widen k for it alone
+        widened = [i for i, item in enumerate(items) if self._needs_more_candidates(item, top_k, k)]
+        retried = await asyncio.gather(
+            *(self._search(index, vectors[i], top_k, filters, min(k * 2, SEARCH_MAX_CANDIDATES)) for i in widened)
+        )
+        results = [self._to_results(item["hits"]["hits"]) for item in items]
+        for i, widened_results in zip(widened, retried):
+            results[i] = widened_results
+        return results
+
+    async def _search(
+        self, index: str, vector: List[Any], top_k: int, filters: Optional[Dict[str, Any]], k: int
+    ) -> List[Dict[str, Any]]:
+        while True:
+            with timed("opensearch.knn", VECTOR_STORE_SECONDS, "opensearch", "search", k=k):
+                response = await self.client.search(index=index, body=self._search_body(vector, top_k, filters, k))
+            if not self._needs_more_candidates(response, top_k, k):
+                return self._to_results(response["hits"]["hits"])
+            k = min(k * 2, SEARCH_MAX_CANDIDATES)
+
+    def _search_body(
+        self, vector: List[Any], top_k: int, filters: Optional[Dict[str, Any]], k: int
+    ) -> Dict[str, Any]:
+        return {
+            "query": self._filtered({"knn": {"embedding": {"vector": vector, "k": k}}}, filters),
+            # One hit per document, the highest scoring chunk
+            "collapse": {"field": "pdf_id"},
+            "_source": ["pdf_id", "content", "chunk_index", "page_number", "metadata"],
+            "size": top_k,
+        }
+
+    def _needs_more_candidates(self, response: Dict[str, Any], top_k: int, k: int) -> bool:
+        """Too few distinct documents among the candidates, and widening k could find more"""
+        saturated = response["hits"]["total"]["value"] >= k
+        return len(response["hits"]["hits"]) < top_k and saturated and k < SEARCH_MAX_CANDIDATES
+
+    def _to_results(self, hits: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return [
+            {
+                # Legacy chunks the pdf_id backfill hasn't reached yet only carry it in their id
+                "id": hit["_source"].get("pdf_id") or hit["_id"][: hit["_id"].rfind("_")],
+                "content": hit["_source"]["content"],
+                "page_number": hit["_source"]["page_number"],
+                "score": hit["_score"],
+                "metadata": hit["_source"].get("metadata", {}),
+            }
+            for hit in hits
+        ]
+
+    def _filtered(self, query: Dict[str, Any], filters: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        if not filters:
+            return query
+        terms = []
+        for key, value in filters.items():
+            if key == "pdf_id":
+                terms.append({"term": {"pdf_id": str(value)}})
+            else:
+                # Dynamically mapped metadata strings are text with an exact keyword subfield
+                field = f"metadata.{key}.keyword" if isinstance(value, str) else f"metadata.{key}"
+                terms.append({"term": {field: value}})
+        return {"bool": {"must": [query], "filter": terms}}
+
     async def delete_document(self, doc_id: str) -> bool:
-        """Delete all chunks of a document by its ID prefix"""
+        """Delete all chunks of a document"""
         try:
-            response = self.client.delete_by_query(
-                index=self.index_name,
-                body={"query": {"prefix": {"_id": doc_id}}},
-                refresh=True,
-            )
+            with timed("opensearch.delete", VECTOR_STORE_SECONDS, "opensearch", "delete", pdf_id=doc_id):
+                response = await self.client.delete_by_query(
+                    index=self.index_name,
+                    body={"query": {"term": {"pdf_id": doc_id}}},
+                    refresh=True,
+                )
+            await self.client.delete(index=self.sources_index_name, id=doc_id, ignore=404)
+            if response["deleted"] > 0:
+                self._notify_change()
             return response["deleted"] > 0
         except Exception as e:
             print(f"Error deleting document {doc_id}: {str(e)}")
             return False
 
     async def get_document(self, doc_id: str) -> Dict[str, Any]:
-        """Retrieve all chunks of a document by its ID prefix"""
+        """Retrieve all chunks of a document in order"""
         try:
-            response = self.client.search(
-                index=self.index_name,
-                body={
-                    "query": {"prefix": {"_id": doc_id}},
-                    "sort": [{"chunk_index": "asc"}],
-                },
-            )
-
             chunks = []
             metadata = {}
-            for hit in response["hits"]["hits"]:
-                chunks.append(hit["_source"]["content"])
-                if not metadata and "metadata" in hit["_source"]:
-                    metadata = hit["_source"]["metadata"]
+            search_after = None
+            while True:
+                body = {
+                    "query": {"term": {"pdf_id": doc_id}},
+                    "sort": [{"page_number": "asc"}, {"chunk_index": "asc"}],
+                    "_source": ["content", "metadata"],
+                    "size": GET_DOCUMENT_PAGE_SIZE,
+                }
+                if search_after is not None:
+                    body["search_after"] = search_after
+                response = await self.client.search(index=self.index_name, body=body)
+
+                hits = response["hits"]["hits"]
+                for hit in hits:
+                    chunks.append(hit["_source"]["content"])
+                    if not metadata and "metadata" in hit["_source"]:
+                        metadata = hit["_source"]["metadata"]
+                if len(hits) < GET_DOCUMENT_PAGE_SIZE:
+                    break
+                search_after = hits[-1]["sort"]
 
             return {"id": doc_id, "content": "\n\n".join(chunks), "metadata": metadata}
         except Exception as e:
             print(f"Error retrieving document {doc_id}: {str(e)}")
             return None
+
+
+def _error_type(item: Dict[str, Any]) -> Optional[str]:
+    [info] = item.values()
+    error = info.get("error")
+    return error.get("type") if isinstance(error, dict) else None
@@ -0,0 +1,165 @@
+import asyncio
+import mmap
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, AsyncIterator, Deque, List, Optional, Tuple
+
+from pypdf import PdfReader
+
+
+PDF_EXTRACTION_WORKERS = int(os.getenv("PDF_EXTRACTION_WORKERS", str(os.cpu_count() or 1)))
+# Number of consecutive pages handed to a worker in a single task
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "16"))
+# Page ranges of one document extracted ahead of its consumer, bounding the text held in memory
+PDF_RANGES_AHEAD = int(os.getenv("PDF_RANGES_AHEAD", str(2 * PDF_EXTRACTION_WORKERS)))
+# Per-document limit in seconds; the worker pool is recycled when a document exceeds it
+PDF_EXTRACTION_TIMEOUT = float(os.getenv("PDF_EXTRACTION_TIMEOUT", "300"))
+# Tasks a worker pool runs before it is replaced, releasing memory leaked by pypdf
+PDF_WORKER_MAX_TASKS = int(os.getenv("PDF_WORKER_MAX_TASKS", "500"))
+
+
+def _open_pdf(pdf_path: str) -> PdfReader:
+    # pypdf reads a whole file given by path into memory; a memory map lets the workers share
+    # the page cache instead of each holding its own copy
+    if os.path.getsize(pdf_path) == 0:
+        return PdfReader(pdf_path)
+    with open(pdf_path, "rb") as pdf_file:
+        return PdfReader(mmap.mmap(pdf_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def _count_pages(pdf_path: str) -> int:
+    return len(_open_pdf(pdf_path).pages)
+
+
+def _extract_page_range(pdf_path: str, start: int, end: int) -> List[Tuple[int, str]]:
+    reader = _open_pdf(pdf_path)
+    # Page numbers start at 1
+    return [(index + 1, reader.pages[index].extract_text()) for index in range(start, end)]
+
+
+class PDFExtractor:
+    """Extracts PDF text in a process pool, splitting each document into page ranges"""
+
+    def __init__(
+        self,
+        max_workers: int = PDF_EXTRACTION_WORKERS,
+        pages_per_task: int = PDF_PAGES_PER_TASK,
+        timeout: float = PDF_EXTRACTION_TIMEOUT,
+        max_tasks: int = PDF_WORKER_MAX_TASKS,
+        ranges_ahead: int = PDF_RANGES_AHEAD,
+    ):
+        self.max_workers = max_workers
+        self.pages_per_task = pages_per_task
+        self.ranges_ahead = max(1, ranges_ahead)
+        self.timeout = timeout
+        self.max_tasks = max_tasks
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._tasks_submitted = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None or self._tasks_submitted >= self.max_tasks:
+            self._recycle()
+            # spawn avoids forking the event loop and the threads of the parent process
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._executor
+
+    def _recycle(self, terminate: bool = False):
+        """Replace the worker pool; running tasks finish unless terminate is set"""
+        executor, self._executor = self._executor, None
+        self._tasks_submitted = 0
+        if executor is None:
+            return
+        if terminate:
+            for process in list(getattr(executor, "_processes", {}).values()):
+                process.terminate()
+        executor.shutdown(wait=False, cancel_futures=terminate)
+
+    def _submit(self, fn, *args) -> asyncio.Future:
+        executor = self._get_executor()
+        self._tasks_submitted += 1
+        return asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+    async def iter_pages(self, pdf_path: str) -> AsyncIterator[Tuple[int, str]]:
+        """Yield (page_num, text) pairs in page order, extracting a few page ranges ahead"""
+        # Only time spent waiting for the workers counts against the timeout, not the time the
+        # consumer takes between pages
+        remaining = self.timeout
+        # (future, page range, attempt) of the ranges being extracted, in page order
+        in_flight: Deque[Tuple[asyncio.Future, Tuple[int, int], int]] = deque()
+        try:
+            # Counting pages is not retried on a broken pool, hence attempt 1
+            in_flight.append((self._submit(_count_pages, pdf_path), (0, 0), 1))
+            num_pages, remaining = await self._next_result(in_flight, pdf_path, remaining)
+            page_ranges = (
+                (start, min(start + self.pages_per_task, num_pages))
+                for start in range(0, num_pages, self.pages_per_task)
+            )
+            for page_range in page_ranges:
+                in_flight.append((self._submit(_extract_page_range, pdf_path, *page_range), page_range, 0))
+                if len(in_flight) >= self.ranges_ahead:
+                    pages, remaining = await self._next_result(in_flight, pdf_path, remaining)
+                    for page in pages:
+                        yield page
+            while in_flight:
+                pages, remaining = await self._next_result(in_flight, pdf_path, remaining)
+                for page in pages:
+                    yield page
+        finally:
+            for future, _, _ in in_flight:
+                future.cancel()
+
+    async def _next_result(
+        self,
+        in_flight: Deque[Tuple[asyncio.Future, Tuple[int, int], int]],
+        pdf_path: str,
+        remaining: float,
+    ) -> Tuple[Any, float]:
+        """Wait for the oldest task in flight and remove it; also return the time left to wait"""
+        loop = asyncio.get_running_loop()
+        while True:
+            future, page_range, attempt = in_flight[0]
+            started = loop.time()
+            if not future.done():
+                done = set()
+                if remaining > 0:
+                    done, _ = await asyncio.wait({future}, timeout=remaining)
+                if not done:
+                    self._abort()
+            remaining -= loop.time() - started
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                # The pool was recycled underneath us by another document's timeout
+                if attempt > 0:
+                    raise
+                in_flight[0] = (self._submit(_extract_page_range, pdf_path, *page_range), page_range, 1)
+                continue
+            in_flight.popleft()
+            return result, remaining
+
+    def _abort(self):
+        # A pathological document is hogging the workers, so start over with a fresh pool
+        self._recycle(terminate=True)
+        raise asyncio.TimeoutError(
+            f"PDF extraction did not finish within {self.timeout} seconds"
+        )
+
+    def shutdown(self):
+        self._recycle()
+
+
+_pdf_extractor: Optional[PDFExtractor] = None
+
+
+def get_pdf_extractor() -> PDFExtractor:
+    """Return the process-wide extractor so all requests share one worker pool"""
+    global _pdf_extractor
+    if _pdf_extractor is None:
+        _pdf_extractor = PDFExtractor()
+    return _pdf_extractor
@@ -0,0 +1,263 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set, Tuple, Union
+
+from ai_utils import EMBEDDING_BATCH_SIZE, EMBEDDING_CONCURRENCY, PageChunk, index_cache_key, page_content_hash
+from clients import ServiceClients
+from metrics import STAGE_ITEMS, STAGE_SECONDS, span
+from s3_utils import object_key, remove_download
+from vector_store import ChunkState, IndexResult, chunk_id
+
+
+# New chunks of a document embedded and written at a time, bounding the memory a document holds
+INGEST_BATCH_CHUNKS = int(
+    os.getenv("INGEST_BATCH_CHUNKS", str(EMBEDDING_BATCH_SIZE * EMBEDDING_CONCURRENCY))
+)
+# Steps of the index stage, each with its own concurrency limit shared by all documents:
+# CPU bound text extraction, and network bound embedding and vector store writes
+INDEX_STEPS = ["extract", "embed", "write"]
+
+StageCallback = Callable[[str, str, Dict[str, Any]], Awaitable[None]]
+
+
+@dataclass
+class IndexTask:
+    """State of one document as it moves through the indexing stages"""
+
+    pdf_id: int
+    pdf_data: Optional[Dict[str, Any]] = None
+    # Identifies the PDF content and indexing settings; unchanged means nothing to do
+    source_key: Optional[str] = None
+    indexed: Dict[str, ChunkState] = field(default_factory=dict)
+    skipped: bool = False
+    # Temporary file holding the downloaded PDF until the index stage is done with it
+    pdf_path: Optional[str] = None
+    result: Optional[IndexResult] = None
+    # Semaphores limiting each of INDEX_STEPS across documents; unlimited when missing
+    limits: Dict[str, asyncio.Semaphore] = field(default_factory=dict)
+    # Receives the progress of the steps inside a stage, set by run_stage
+    on_stage: Optional[StageCallback] = None
+
+    async def report(self, stage: str, status: str, details: Dict[str, Any]):
+        if self.on_stage is not None:
+            await self.on_stage(stage, status, details)
+
+    async def release(self):
+        """Remove the downloaded PDF, if any; the task's owner calls this however the task ends"""
+        path, self.pdf_path = self.pdf_path, None
+        if path is not None:
+            await asyncio.to_thread(remove_download, path)
+
+
+async def fetch_metadata_stage(clients: ServiceClients, task: IndexTask) -> Optional[int]:
+    task.pdf_data = await clients.pdf_metadata.load(task.pdf_id)
+    if not task.pdf_data:
+        raise Exception(f"PDF with id {task.pdf_id} not found")
+    return None
+
+
+async def check_stage(clients: ServiceClients, task: IndexTask) -> Optional[int]:
+    """Skip documents whose content and indexing settings haven't changed since the last run"""
+    etag = await clients.s3.etag(object_key(task.pdf_data))
+    task.source_key = index_cache_key(etag)
+    stored_key = await clients.vector_store.get_source_key(str(task.pdf_id))
+    task.skipped = stored_key == task.source_key
+    if task.skipped:
+        return 0
+    if stored_key is not None:
+        # The index stage writes in batches and records the new key with the last one; until then
+        # a stale key must not vouch for a half rewritten document
+        await clients.vector_store.clear_source_key(str(task.pdf_id))
+    task.indexed = await clients.vector_store.get_chunk_state(str(task.pdf_id))
+    return len(task.indexed)
+
+
+async def download_stage(clients: ServiceClients, task: IndexTask) -> Optional[int]:
+    if task.skipped:
+        return None
+    task.pdf_path = await clients.s3.download_to_file(object_key(task.pdf_data))
+    return os.path.getsize(task.pdf_path)
+
+
+class _Step:
+    """One of INDEX_STEPS for one document: its slot, time spent working and items processed"""
+
+    def __init__(self, name: str, task: IndexTask):
+        self.name = name
+        self.task = task
+        self.seconds = 0.0
+        self.items = 0
+        self._started = False
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        limit = self.task.limits.get(self.name)
+        if limit is None:
+            yield
+            return
+        async with limit:
+            yield
+
+    @asynccontextmanager
+    async def busy(self) -> AsyncIterator[None]:
+        """Count the block towards the step's duration, and report the step failed if it raises"""
+        if not self._started:
+            self._started = True
+            await self.task.report(self.name, "running", {})
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.seconds += time.perf_counter() - started
+            await self.finish("failed")
+            raise
+        self.seconds += time.perf_counter() - started
+
+    async def finish(self, status: str = "completed"):
+        STAGE_SECONDS.labels(self.name, status).observe(self.seconds)
+        details: Dict[str, Any] = {"duration_ms": self.seconds * 1000}
+        if status == "completed":
+            details["items"] = self.items
+            if self.items:
+                STAGE_ITEMS.labels(self.name).inc(self.items)
+        await self.task.report(self.name, status, details)
+
+
+async def index_stage(clients: ServiceClients, task: IndexTask) -> Optional[int]:
+    """Extract, split, embed and write the document a batch of chunks at a time.
+
+    Pages stream in from the extraction workers, so the memory a document holds is bounded by
+    the batch size rather than its page count. Extraction runs ahead of embedding and writing
+    by at most one batch, and each of the three steps has its own limit across documents and
+    reports its own duration and item count.
+
+    Only chunks not already indexed are embedded: ids are content-addressed, and the page hash
+    recorded with each chunk covers the embedding model and settings, so a settings change
+    re-embeds chunks under their old ids. Stale chunks are deleted and the source key recorded
+    with the last batch, so an interrupted run is never mistaken for a complete one.
+    """
+    if task.skipped:
+        return None
+    doc_id = str(task.pdf_id)
+    result = task.result = IndexResult()
+    extract, embed, write = (_Step(name, task) for name in INDEX_STEPS)
+    # (chunks, last batch) handed from extraction to embedding, or the error extraction hit
+    batches: "asyncio.Queue[Union[Tuple[List[PageChunk], bool], Exception]]" = asyncio.Queue(maxsize=1)
+    # Diffing by chunk rather than by page also repairs a previous run that failed halfway
+    wanted: Set[str] = set()
+
+    async def extract_pages():
+        try:
+            batch: List[PageChunk] = []
+            async with extract.slot():
+                pages = clients.ai_utils.iter_pdf_pages(task.pdf_path)
+                try:
+                    while True:
+                        async with extract.busy():
+                            try:
+                                page = await pages.__anext__()
+                            except StopAsyncIteration:
+                                break
+                            extract.items += 1
+                            page.page_hash = page_content_hash(page)
+                            for chunk in clients.ai_utils.split_pages([page]):
+                                id = chunk_id(doc_id, chunk)
+                                indexed = task.indexed.get(id)
+                                if id not in wanted and (indexed is None or indexed.page_hash != chunk.page_hash):
+                                    batch.append(chunk)
+                                wanted.add(id)
+                        if len(batch) >= INGEST_BATCH_CHUNKS:
+                            # Waiting for the previous batch to be written isn't extraction time
+                            await batches.put((batch, False))
+                            batch = []
+                finally:
+                    await pages.aclose()
+            await batches.put((batch, True))
+        except Exception as e:
+            await batches.put(e)
+
+    async def embed_and_write(chunks: List[PageChunk], last: bool):
+        async with embed.slot(), embed.busy():
+            embeddings = await clients.ai_utils.embed_texts([chunk.content for chunk in chunks])
+            embed.items += len(chunks)
+
+        async with write.slot(), write.busy():
+            # Only the last write refreshes the index and records the source key
+            written = await clients.vector_store.sync_document(
+                doc_id,
+                chunks,
+                embeddings,
+                {},
+                task.source_key if last else None,
+                delete_ids=[id for id in task.indexed if id not in wanted] if last else (),
+                partial=not last,
+            )
+            result.indexed += written.indexed
+            result.deleted += written.deleted
+            result.errors.extend(written.errors)
+            write.items += written.indexed + written.deleted
+            if not written.ok:
+                raise Exception(f"Failed to index {len(written.errors)} chunks of PDF {task.pdf_id}")
+
+    extraction = asyncio.create_task(extract_pages())
+    try:
+        while True:
+            item = await batches.get()
+            if isinstance(item, Exception):
+                raise item
+            chunks, last = item
+            await embed_and_write(chunks, last)
+            if last:
+                break
+        for step in (extract, embed, write):
+            await step.finish()
+    finally:
+        extraction.cancel()
+        await asyncio.gather(extraction, return_exceptions=True)
+        await task.release()
+        task.indexed = {}
+    return result.indexed
+
+
+# Each stage returns the number of items it produced (bytes, pages, chunks), if meaningful
+Stage = Callable[[ServiceClients, IndexTask], Awaitable[Optional[int]]]
+
+INDEX_STAGES: List[Tuple[str, Stage]] = [
+    ("metadata", fetch_metadata_stage),
+    ("check", check_stage),
+    ("download", download_stage),
+    ("index", index_stage),
+]
+
+async def run_stage(
+    clients: ServiceClients,
+    task: IndexTask,
+    name: str,
+    stage: Stage,
+    on_stage: Optional[StageCallback] = None,
+):
+    """Run one stage, reporting its start and outcome with timings to on_stage"""
+    task.on_stage = on_stage
+    if on_stage:
+        await on_stage(name, "running", {})
+
+    started = time.perf_counter()
+    try:
+        with span(f"ingest.{name}", pdf_id=task.pdf_id):
+            items = await stage(clients, task)
+    except Exception:
+        STAGE_SECONDS.labels(name, "failed").observe(time.perf_counter() - started)
+        if on_stage:
+            await on_stage(name, "failed", {"duration_ms": (time.perf_counter() - started) * 1000})
+        raise
+
+    STAGE_SECONDS.labels(name, "completed").observe(time.perf_counter() - started)
+    if items:
+        STAGE_ITEMS.labels(name).inc(items)
+    if on_stage:
+        await on_stage(
+            name, "completed", {"duration_ms": (time.perf_counter() - started) * 1000, "items": items}
+        )
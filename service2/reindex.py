@@ -0,0 +1,190 @@
+"""Migrate the live pdf_documents index to another index profile without downtime.
+
+    python reindex.py --profile faiss_hnsw_fp16
+
+The documents are copied into a new physical index while the alias keeps serving reads and
+writes. Chunks written during the copy are picked up by catch-up passes before the alias is
+swapped atomically. Deletes made during the copy are not replayed.
+
+Running services keep writing to the old index, encoded for its profile, until they look up
+the alias again (OPENSEARCH_ALIAS_REFRESH_SECONDS). The old index is therefore made read-only
+only after that, and a final catch-up pass copies what they wrote; writes rejected by the
+block are retried against the new index.
+
+A pre-alias deployment has no alias to move: its concrete index is removed in the swap. It
+is made read-only before the last catch-up pass, so ingestion jobs writing between then and
+the swap fail and can be resubmitted instead of being lost. Pause ingestion during the
+migration to avoid those failures.
+"""
+import argparse
+import asyncio
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from index_profiles import EMBEDDING_DIMENSION, IndexProfile, build_index_body, get_index_profile, physical_index_name
+from opensearch_utils import ALIAS_REFRESH_SECONDS, OpenSearchClient
+
+
+# Seconds between task and model status checks
+POLL_INTERVAL = 5
+# Bound on the number of vectors sampled to train IVF/PQ models
+MAX_TRAINING_VECTORS = 100000
+# Wait after the swap for running services to follow the alias, with room for writes in flight
+SWAP_GRACE_SECONDS = 2 * ALIAS_REFRESH_SECONDS
+
+# Rescales each embedding component between profiles, rounding into int8 for byte indexes
+CONVERT_EMBEDDING_SCRIPT = """
+def v = ctx._source.embedding;
+for (int i = 0; i < v.size(); i++) {
+    double x = v[i] * params.factor;
+    if (params.to_byte) {
+        v[i] = (int) Math.max(-128L, Math.min(127L, Math.round(x)));
+    } else {
+        v[i] = x;
+    }
+}
+"""
+
+
+async def wait_for_task(client, task_id: str) -> Dict[str, Any]:
+    while True:
+        task = await client.tasks.get(task_id=task_id)
+        if task.get("completed"):
+            if task.get("error") or task.get("response", {}).get("failures"):
+                raise Exception(f"Task {task_id} failed: {task.get('error') or task['response']['failures'][:3]}")
+            return task["response"]
+        status = task["task"]["status"]
+        print(f"  {status.get('created', 0) + status.get('updated', 0)}/{status.get('total', 0)} chunks copied")
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+async def train_model(client, source: str, source_profile: IndexProfile, profile: IndexProfile) -> str:
+    """Train an IVF/PQ model on the vectors of the source index and return its id"""
+    if source_profile.data_type:
+        raise Exception(f"Cannot train {profile.name} from {source_profile.data_type} vectors")
+
+    model_id = f"{physical_index_name('pdf-documents', profile)}-model"
+    await client.transport.perform_request(
+        "POST",
+        f"/_plugins/_knn/models/{model_id}/_train",
+        body={
+            "training_index": source,
+            "training_field": "embedding",
+            "dimension": EMBEDDING_DIMENSION,
+            "max_training_vector_count": MAX_TRAINING_VECTORS,
+            "description": f"{profile.name} for {source}",
+            "method": profile.method(),
+        },
+    )
+    while True:
+        model = await client.transport.perform_request("GET", f"/_plugins/_knn/models/{model_id}")
+        if model["state"] == "created":
+            return model_id
+        if model["state"] == "failed":
+            raise Exception(f"Training model {model_id} failed: {model.get('error')}")
+        print(f"  training {model_id}...")
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+async def block_writes(client, index: str):
+    await client.indices.put_settings(index=index, body={"index": {"blocks.write": True}})
+
+
+async def copy(
+    client,
+    source: str,
+    dest: str,
+    source_profile: IndexProfile,
+    profile: IndexProfile,
+    since: Optional[datetime] = None,
+) -> Dict[str, Any]:
+    body: Dict[str, Any] = {"source": {"index": source}, "dest": {"index": dest}}
+    if since is not None:
+        body["source"]["query"] = {"range": {"created_at": {"gte": since.isoformat()}}}
+    if source_profile.scale != profile.scale:
+        body["script"] = {
+            "lang": "painless",
+            "source": CONVERT_EMBEDDING_SCRIPT,
+            "params": {
+                "factor": profile.scale / source_profile.scale,
+                "to_byte": profile.data_type == "byte",
+            },
+        }
+
+    response = await client.reindex(body=body, wait_for_completion=False, refresh=True)
+    return await wait_for_task(client, response["task"])
+
+
+async def reindex(profile: IndexProfile, keep_old: bool = False):
+    opensearch = OpenSearchClient(profile)
+    client = opensearch.client
+    alias = opensearch.index_name
+    try:
+        if not await client.indices.exists(alias):
+            raise Exception(f"{alias} does not exist, there is nothing to migrate")
+
+        # A pre-alias deployment has a concrete index named like the alias
+        is_alias = await client.indices.exists_alias(name=alias)
+        [source] = (await client.indices.get_alias(name=alias)).keys() if is_alias else [alias]
+        source_profile = await opensearch.live_profile()
+        print(f"Migrating {source} ({source_profile.name}) to {profile.name}")
+
+        model_id = None
+        if profile.requires_training:
+            model_id = await train_model(client, source, source_profile, profile)
+
+        dest = physical_index_name(alias, profile)
+        await client.indices.create(index=dest, body=build_index_body(profile, model_id))
+        # Bulk copy without refreshes or replica writes, restored once the copy is done
+        await client.indices.put_settings(
+            index=dest, body={"index": {"refresh_interval": "-1", "number_of_replicas": 0}}
+        )
+
+        # Chunks written from here on are copied again by the catch-up pass
+        started = datetime.utcnow() - timedelta(minutes=1)
+        result = await copy(client, source, dest, source_profile, profile)
+        print(f"Copied {result['total']} chunks into {dest}")
+
+        index_settings = build_index_body(profile)["settings"]["index"]
+        await client.indices.put_settings(
+            index=dest,
+            body={"index": {"refresh_interval": None, "number_of_replicas": index_settings["number_of_replicas"]}},
+        )
+
+        if not is_alias:
+            # Nothing can be copied once the swap removes it, so refuse writes from here on
+            await block_writes(client, source)
+        caught_up = datetime.utcnow() - timedelta(minutes=1)
+        result = await copy(client, source, dest, source_profile, profile, since=started)
+        print(f"Caught up {result['total']} chunks written during the copy")
+
+        actions = [{"add": {"index": dest, "alias": alias}}]
+        if is_alias:
+            actions.append({"remove": {"index": source, "alias": alias}})
+        else:
+            # The concrete index must go in the same request for the alias name to be free
+            actions.append({"remove_index": {"index": source}})
+        await client.indices.update_aliases(body={"actions": actions})
+        print(f"{alias} now points to {dest}")
+
+        if is_alias:
+            print(f"Waiting {SWAP_GRACE_SECONDS:.0f}s for services to switch to {dest}")
+            await asyncio.sleep(SWAP_GRACE_SECONDS)
+            await block_writes(client, source)
+            result = await copy(client, source, dest, source_profile, profile, since=caught_up)
+            print(f"Caught up {result['total']} chunks written before services switched")
+            if not keep_old:
+                await client.indices.delete(index=source)
+                print(f"Deleted {source}")
+
+    finally:
+        await opensearch.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--profile", default=None, help="Target index profile, OPENSEARCH_INDEX_PROFILE by default")
+    parser.add_argument("--keep-old", action="store_true", help="Keep the previous index, read-only, after the swap")
+    args = parser.parse_args()
+    profile = get_index_profile(args.profile) if args.profile else get_index_profile()
+    asyncio.run(reindex(profile, keep_old=args.keep_old))
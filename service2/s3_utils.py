@@ -0,0 +1,139 @@
+import asyncio
+import glob
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict
+
+import boto3
+from botocore.client import Config
+
+from metrics import S3_SECONDS, timed
+
+
+BUCKET_NAME = os.getenv("BUCKET_NAME")
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "50"))
+# S3 compatible endpoint (e.g. MinIO or the benchmark stand-in), addressed path style
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+# Downloads are streamed to temporary files in this directory (the system default if unset)
+S3_DOWNLOAD_DIR = os.getenv("S3_DOWNLOAD_DIR")
+S3_DOWNLOAD_CHUNK_SIZE = int(os.getenv("S3_DOWNLOAD_CHUNK_SIZE", str(1024 * 1024)))
+# Downloaded files are named <prefix><pid>-<random>.pdf, so leftovers of dead processes can be found
+DOWNLOAD_PREFIX = "s3-download-"
+
+
+def object_key(pdf_data: Dict[str, Any]) -> str:
+    """Key of a PDF's object, from its s3://bucket/key URL; older uploads were keyed by filename"""
+    s3_url = pdf_data.get("s3Url")
+    return s3_url.split("/", 3)[3] if s3_url else pdf_data["filename"]
+
+
+def remove_download(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def remove_stale_downloads() -> int:
+    """Remove downloads left behind by processes that are no longer running, e.g. after a crash"""
+    removed = 0
+    pattern = os.path.join(S3_DOWNLOAD_DIR or tempfile.gettempdir(), f"{DOWNLOAD_PREFIX}*.pdf")
+    for path in glob.glob(pattern):
+        try:
+            pid = int(os.path.basename(path)[len(DOWNLOAD_PREFIX):].split("-")[0])
+        except ValueError:
+            continue
+        if pid != os.getpid() and not _is_running(pid):
+            remove_download(path)
+            removed += 1
+    return removed
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # Running, under another user
+        pass
+    return True
+
+
+class S3Client:
+    """boto3 S3 client whose blocking calls run on a dedicated thread pool"""
+
+    def __init__(self, bucket_name: str = BUCKET_NAME):
+        self.bucket_name = bucket_name
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=S3_ENDPOINT_URL,
+            aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+            aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+            config=Config(
+                signature_version="s3v4",
+                max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                tcp_keepalive=True,
+                s3={"addressing_style": "path"} if S3_ENDPOINT_URL else None,
+            ),
+        )
+        # One thread per pooled connection, so downloads never wait on each other for a thread
+        self._executor = ThreadPoolExecutor(
+            max_workers=S3_MAX_POOL_CONNECTIONS, thread_name_prefix="s3"
+        )
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _download_to_file(self, file_key: str) -> str:
+        response = self.client.get_object(Bucket=self.bucket_name, Key=file_key)
+        body = response["Body"]
+        fd, path = tempfile.mkstemp(prefix=f"{DOWNLOAD_PREFIX}{os.getpid()}-", suffix=".pdf", dir=S3_DOWNLOAD_DIR)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in body.iter_chunks(S3_DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+        except BaseException:
+            body.close()
+            os.remove(path)
+            raise
+        return path
+
+    async def download_to_file(self, file_key: str) -> str:
+        """Stream an object to a new temporary file and return its path; the caller removes it"""
+        with timed("s3.download", S3_SECONDS, "download", key=file_key):
+            future = asyncio.get_running_loop().run_in_executor(self._executor, self._download_to_file, file_key)
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # The thread carries on writing the file, so remove it once the download is done
+                future.add_done_callback(_remove_finished_download)
+                raise
+
+    @asynccontextmanager
+    async def temporary_download(self, file_key: str) -> AsyncIterator[str]:
+        """Download an object to a temporary file that is removed on exit"""
+        path = await self.download_to_file(file_key)
+        try:
+            yield path
+        finally:
+            await asyncio.to_thread(remove_download, path)
+
+    def _etag(self, file_key: str) -> str:
+        response = self.client.head_object(Bucket=self.bucket_name, Key=file_key)
+        return response["ETag"].strip('"')
+
+    async def etag(self, file_key: str) -> str:
+        """Return the object's ETag, which changes whenever its content does"""
+        with timed("s3.etag", S3_SECONDS, "etag", key=file_key):
+            return await self._run(self._etag, file_key)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.client.close()
+
+
+def _remove_finished_download(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is None:
+        remove_download(future.result())
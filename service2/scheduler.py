@@ -0,0 +1,102 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+
+@dataclass
+class StageSpec:
+    name: str
+    run: Callable[[Any], Awaitable[None]]
+    concurrency: int
+
+
+class PipelineScheduler:
+    """Moves items through stages, each with its own workers and a bounded input queue.
+
+    Different items occupy different stages at the same time, so throughput is bounded by
+    the slowest stage rather than the sum of all stages. A full queue blocks the stage in
+    front of it, which propagates backpressure up to submit().
+
+    Every item ends in exactly one of on_complete, on_error or, for items still queued or
+    in a stage when stop() is called, on_cancel.
+    """
+
+    def __init__(
+        self,
+        stages: List[StageSpec],
+        queue_size: int,
+        on_complete: Callable[[Any], Awaitable[None]],
+        on_error: Callable[[Any, Exception], Awaitable[None]],
+        on_cancel: Optional[Callable[[Any], Awaitable[None]]] = None,
+    ):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.on_complete = on_complete
+        self.on_error = on_error
+        self.on_cancel = on_cancel
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+        # Items taken off a queue by a worker and not yet handed on, by id()
+        self._held: Dict[int, Any] = {}
+
+    def start(self):
+        self._queues = [asyncio.Queue(maxsize=self.queue_size) for _ in self.stages]
+        for index, stage in enumerate(self.stages):
+            self._tasks.extend(
+                asyncio.create_task(self._work(index)) for _ in range(stage.concurrency)
+            )
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        abandoned = list(self._held.values())
+        self._held = {}
+        for queue in self._queues:
+            while not queue.empty():
+                abandoned.append(queue.get_nowait())
+        if self.on_cancel is not None:
+            for item in abandoned:
+                await self._report(self.on_cancel(item))
+
+    async def submit(self, item: Any):
+        """Enqueue an item for the first stage, waiting while that stage is saturated"""
+        await self._queues[0].put(item)
+
+    async def join(self):
+        for queue in self._queues:
+            await queue.join()
+
+    async def _work(self, index: int):
+        stage = self.stages[index]
+        queue = self._queues[index]
+        next_queue: Optional[asyncio.Queue] = (
+            self._queues[index + 1] if index + 1 < len(self._queues) else None
+        )
+
+        while True:
+            item = await queue.get()
+            self._held[id(item)] = item
+            try:
+                await stage.run(item)
+            except Exception as e:
+                await self._report(self.on_error(item, e))
+                del self._held[id(item)]
+                queue.task_done()
+                continue
+
+            # Hand over before marking done so join() can't slip between stages
+            if next_queue is not None:
+                await next_queue.put(item)
+            else:
+                await self._report(self.on_complete(item))
+            del self._held[id(item)]
+            queue.task_done()
+
+    async def _report(self, callback: Awaitable[None]):
+        try:
+            await callback
+        except Exception as e:
+            print(f"Error in pipeline callback: {e}")
@@ -1,12 +1,21 @@
-import strawberry
-from typing import List
-import httpx
 import os
-import boto3
-from botocore.client import Config
+import strawberry
+from strawberry.types import Info
+from datetime import datetime
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+
+from ai_utils import SummaryEvent, summary_cache_key
+from clients import ServiceClients
+from jobs import IngestionWorkerPool, Job
+from metrics import MetricsExtension
+from s3_utils import object_key
+from search_cache import normalize_query
+from service1_api import PDF_SUMMARY_QUERY, fetch_pdf_metadata, store_pdf_summary
+from vector_store import reciprocal_rank_fusion
 
-from opensearch_utils import OpenSearchClient
-from ai_utils import AIUtils
+
+# Upper bound on the queries of one searchPdfsBatch request
+SEARCH_BATCH_MAX_QUERIES = int(os.getenv("SEARCH_BATCH_MAX_QUERIES", "32"))
 
 
 @strawberry.type
@@ -18,149 +27,219 @@ class SearchResult:
 
 
 @strawberry.type
-class Query:
-    @strawberry.field
-    async def search_pdfs(self, query: str, top_k: int = 5) -> List[SearchResult]:
-        ai_utils = AIUtils()
-        opensearch_client = OpenSearchClient()
-
-        # Create embedding for the query - get single embedding vector
-        embeddings, _ = await ai_utils.create_embeddings(query)
-        # Take first embedding and convert to list of floats
-        query_embedding = [float(x) for x in embeddings[0]]
-
-        # Search documents
-        results = await opensearch_client.search_documents(query_embedding, top_k)
-
-        return [
-            SearchResult(
-                id=result["id"],
-                content=result["content"],
-                page_number=result["page_number"],
-                score=result["score"],
-            )
-            for result in results
-        ]
+class QuerySearchResults:
+    query: str
+    results: List[SearchResult]
 
 
 @strawberry.type
-class Mutation:
-    @strawberry.mutation
-    async def index_pdf(self, pdf_id: int) -> bool:
-        try:
-            ai_utils = AIUtils()
-            opensearch_client = OpenSearchClient()
-
-            # 1. Get PDF metadata from Service 1
-            async with httpx.AsyncClient() as client:
-                query = """
-                    query($pdfId: Int!) {
-                        pdf(pdfId: $pdfId) {
-                            id
-                            filename
-                            s3Url
-                        }
-                    }
-                """
-                variables = {"pdfId": pdf_id}
-                response = await client.post(
-                    "http://service1:8081/graphql",
-                    json={"query": query, "variables": variables},
-                )
+class SearchBatchResult:
+    results: List[QuerySearchResults]
+    # Results of all queries merged by reciprocal rank fusion, one per document; only when fuse is set
+    fused: Optional[List[SearchResult]]
 
-                if response.status_code != 200:
-                    print(f"Error fetching PDF metadata: {response.text}")
-                    return False
 
-                data = response.json()
-                if not data.get("data", {}).get("pdf"):
-                    print(f"PDF with id {pdf_id} not found")
-                    return False
+@strawberry.type
+class JobStageType:
+    name: str
+    status: str
+    duration_ms: Optional[float]
+    items: Optional[int]
+
+
+@strawberry.type
+class JobType:
+    id: str
+    pdf_id: int
+    status: str
+    stage: Optional[str]
+    stages: List[JobStageType]
+    error: Optional[str]
+    attempts: int
+    created_at: datetime
+    started_at: Optional[datetime]
+    finished_at: Optional[datetime]
 
-                pdf_data = data["data"]["pdf"]
-                s3_url = pdf_data["s3Url"]
 
-            # 2. Download PDF from S3
-            s3_client = boto3.client(
-                "s3",
-                aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-                aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-                config=Config(signature_version="s3v4"),
+@strawberry.type
+class SummaryEventType:
+    kind: str  # "progress", "token" or "done"
+    stage: str
+    text: str
+    completed: int
+    total: int
+
+
+def convert_search_result_to_strawberry_type(result: Dict[str, Any]) -> SearchResult:
+    return SearchResult(
+        id=result["id"],
+        content=result["content"],
+        page_number=result["page_number"],
+        score=result["score"],
+    )
+
+
+def convert_summary_event_to_strawberry_type(event: SummaryEvent) -> SummaryEventType:
+    return SummaryEventType(
+        kind=event.kind,
+        stage=event.stage,
+        text=event.text,
+        completed=event.completed,
+        total=event.total,
+    )
+
+
+async def get_summary_source(clients: ServiceClients, pdf_id: int) -> Tuple[Dict[str, Any], str]:
+    """Fetch the PDF's metadata and stored summary, and the key a current summary must have"""
+    pdf_data = await fetch_pdf_metadata(clients.http, pdf_id, PDF_SUMMARY_QUERY)
+    if not pdf_data:
+        raise Exception(f"PDF with id {pdf_id} not found")
+
+    # The stored summary is reusable if neither the PDF nor the summarization config changed
+    etag = await clients.s3.etag(object_key(pdf_data))
+    return pdf_data, summary_cache_key(etag)
+
+
+def convert_job_to_strawberry_type(job: Job) -> JobType:
+    return JobType(
+        id=job.id,
+        pdf_id=job.pdf_id,
+        status=job.status,
+        stage=job.stage,
+        stages=[
+            JobStageType(
+                name=name,
+                status=stage["status"],
+                duration_ms=stage.get("duration_ms"),
+                items=stage.get("items"),
             )
+            for name, stage in job.stages.items()
+        ],
+        error=job.error,
+        attempts=job.attempts,
+        created_at=job.created_at,
+        started_at=job.started_at,
+        finished_at=job.finished_at,
+    )
 
-            bucket_name = os.getenv("BUCKET_NAME")
-            file_key = pdf_data["filename"]
 
-            # 3. Download PDF content to memory
-            response = s3_client.get_object(Bucket=bucket_name, Key=file_key)
-            pdf_content = response["Body"].read()
+@strawberry.type
+class Query:
+    @strawberry.field
+    async def job(self, info: Info, id: str) -> Optional[JobType]:
+        jobs: IngestionWorkerPool = info.context["jobs"]
+        job = await jobs.store.get(id)
+        return convert_job_to_strawberry_type(job) if job else None
 
-            # 4. Extract text from PDF with page numbers
-            page_chunks = await ai_utils.extract_text_from_pdf(pdf_content)
+    @strawberry.field
+    async def search_pdfs(self, info: Info, query: str, top_k: int = 5) -> List[SearchResult]:
+        clients: ServiceClients = info.context["clients"]
+        search_cache = clients.search_cache
+        query = normalize_query(query)
 
-            # 5. Create embeddings
-            embeddings, chunks = await ai_utils.create_embeddings(page_chunks)
+        results = search_cache.get_results(query, top_k)
+        if results is None:
+            generation = search_cache.generation
 
-            # 6. Index document in OpenSearch with page numbers
-            await opensearch_client.index_document(str(pdf_id), chunks, {}, embeddings)
+            query_embedding = search_cache.get_embedding(query)
+            if query_embedding is None:
+                # Create embedding for the query - get single embedding vector
+                embeddings, _ = await clients.ai_utils.create_embeddings(query)
+                # Take first embedding and convert to list of floats
+                query_embedding = [float(x) for x in embeddings[0]]
+                search_cache.set_embedding(query, query_embedding)
 
-            return True
+            # Search documents
+            results = await clients.vector_store.search_documents(query_embedding, top_k)
+            search_cache.set_results(query, top_k, results, generation)
 
-        except Exception as e:
-            print(f"Error indexing PDF: {e}")
-            return False
+        return [convert_search_result_to_strawberry_type(result) for result in results]
 
-    @strawberry.mutation
-    async def generate_summary(self, pdf_id: int) -> str:
-        try:
-            ai_utils = AIUtils()
-
-            # 1. Get PDF metadata from Service 1
-            async with httpx.AsyncClient() as client:
-                query = """
-                    query($pdfId: Int!) {
-                        pdf(pdfId: $pdfId) {
-                            id
-                            filename
-                            s3Url
-                        }
-                    }
-                """
-                variables = {"pdfId": pdf_id}
-                response = await client.post(
-                    "http://service1:8081/graphql",
-                    json={"query": query, "variables": variables},
+    @strawberry.field
+    async def search_pdfs_batch(
+        self, info: Info, queries: List[str], top_k: int = 5, fuse: bool = False
+    ) -> SearchBatchResult:
+        """Like searchPdfs for several queries, with one embeddings request and one search round trip"""
+        if len(queries) > SEARCH_BATCH_MAX_QUERIES:
+            raise Exception(f"At most {SEARCH_BATCH_MAX_QUERIES} queries can be searched at once")
+
+        clients: ServiceClients = info.context["clients"]
+        search_cache = clients.search_cache
+        normalized = [normalize_query(query) for query in queries]
+
+        results: Dict[str, List[Dict[str, Any]]] = {}
+        pending = []
+        for query in dict.fromkeys(normalized):
+            cached = search_cache.get_results(query, top_k)
+            if cached is None:
+                pending.append(query)
+            else:
+                results[query] = cached
+
+        if pending:
+            generation = search_cache.generation
+
+            embeddings = {query: search_cache.get_embedding(query) for query in pending}
+            missing = [query for query, embedding in embeddings.items() if embedding is None]
+            if missing:
+                for query, embedding in zip(missing, await clients.ai_utils.create_query_embeddings(missing)):
+                    embeddings[query] = [float(x) for x in embedding]
+                    search_cache.set_embedding(query, embeddings[query])
+
+            found = await clients.vector_store.search_documents_batch(
+                [embeddings[query] for query in pending], top_k
+            )
+            for query, query_results in zip(pending, found):
+                results[query] = query_results
+                search_cache.set_results(query, top_k, query_results, generation)
+
+        per_query = [results[query] for query in normalized]
+        # A repeated query would count twice in the fusion, so each distinct one is fused once
+        fused = reciprocal_rank_fusion(list(results.values()), top_k) if fuse else None
+        return SearchBatchResult(
+            results=[
+                QuerySearchResults(
+                    query=query,
+                    results=[convert_search_result_to_strawberry_type(result) for result in query_results],
                 )
+                for query, query_results in zip(queries, per_query)
+            ],
+            fused=[convert_search_result_to_strawberry_type(result) for result in fused] if fused is not None else None,
+        )
 
-                if response.status_code != 200:
-                    raise Exception(f"Error fetching PDF metadata: {response.text}")
-
-                data = response.json()
-                if not data.get("data", {}).get("pdf"):
-                    raise Exception(f"PDF with id {pdf_id} not found")
 
-                pdf_data = data["data"]["pdf"]
+@strawberry.type
+class Mutation:
+    @strawberry.mutation
+    async def index_pdf(self, info: Info, pdf_id: int) -> str:
+        """Queue the PDF for indexing and return the job id to poll with the job query"""
+        jobs: IngestionWorkerPool = info.context["jobs"]
+        [job] = await jobs.submit([pdf_id])
+        return job.id
 
-            # 2a. Download PDF from S3
-            s3_client = boto3.client(
-                "s3",
-                aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-                aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-                config=Config(signature_version="s3v4"),
-            )
+    @strawberry.mutation
+    async def index_pdfs(self, info: Info, pdf_ids: List[int]) -> List[str]:
+        """Queue several PDFs; their stages overlap in the ingestion pipeline"""
+        jobs: IngestionWorkerPool = info.context["jobs"]
+        return [job.id for job in await jobs.submit(pdf_ids)]
 
-            bucket_name = os.getenv("BUCKET_NAME")
-            file_key = pdf_data["filename"]
+    @strawberry.mutation
+    async def generate_summary(self, info: Info, pdf_id: int) -> str:
+        try:
+            clients: ServiceClients = info.context["clients"]
 
-            # 2b. Download PDF content to memory
-            response = s3_client.get_object(Bucket=bucket_name, Key=file_key)
-            pdf_content = response["Body"].read()
+            # 1. Get PDF metadata, and return the stored summary if it's still current
+            pdf_data, summary_key = await get_summary_source(clients, pdf_id)
+            if pdf_data.get("summary") and pdf_data.get("summaryKey") == summary_key:
+                return pdf_data["summary"]
 
-            # 3. Extract text from PDF with page numbers
-            page_chunks = await ai_utils.extract_text_from_pdf(pdf_content)
+            # 2. Download the PDF to a temporary file and extract its text with page numbers
+            async with clients.s3.temporary_download(object_key(pdf_data)) as pdf_path:
+                page_chunks = await clients.ai_utils.extract_text_from_pdf(pdf_path)
 
-            # 4. Generate and return summary
-            summary = await ai_utils.create_summary(page_chunks)
+            # 3. Generate, store and return summary
+            summary = await clients.ai_utils.create_summary(page_chunks)
+            await store_pdf_summary(clients.http, pdf_id, summary, summary_key)
             return summary
 
         except Exception as e:
@@ -168,4 +247,32 @@ class Mutation:
             raise
 
 
-schema = strawberry.federation.Schema(query=Query, mutation=Mutation)
+@strawberry.type
+class Subscription:
+    @strawberry.subscription
+    async def summary_stream(self, info: Info, pdf_id: int) -> AsyncGenerator[SummaryEventType, None]:
+        """Like generateSummary, but streams map/reduce progress and the summary tokens as they arrive"""
+        try:
+            clients: ServiceClients = info.context["clients"]
+
+            pdf_data, summary_key = await get_summary_source(clients, pdf_id)
+            if pdf_data.get("summary") and pdf_data.get("summaryKey") == summary_key:
+                yield SummaryEventType(kind="done", stage="final", text=pdf_data["summary"], completed=0, total=0)
+                return
+
+            async with clients.s3.temporary_download(object_key(pdf_data)) as pdf_path:
+                page_chunks = await clients.ai_utils.extract_text_from_pdf(pdf_path)
+
+            async for event in clients.ai_utils.stream_summary(page_chunks):
+                if event.kind == "done":
+                    await store_pdf_summary(clients.http, pdf_id, event.text, summary_key)
+                yield convert_summary_event_to_strawberry_type(event)
+
+        except Exception as e:
+            print(f"Error streaming summary: {e}")
+            raise
+
+
+schema = strawberry.federation.Schema(
+    query=Query, mutation=Mutation, subscription=Subscription, extensions=[MetricsExtension]
+)
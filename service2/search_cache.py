@@ -0,0 +1,79 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "10000"))
+QUERY_EMBEDDING_CACHE_TTL = float(os.getenv("QUERY_EMBEDDING_CACHE_TTL", "86400"))
+SEARCH_RESULT_CACHE_SIZE = int(os.getenv("SEARCH_RESULT_CACHE_SIZE", "5000"))
+SEARCH_RESULT_CACHE_TTL = float(os.getenv("SEARCH_RESULT_CACHE_TTL", "300"))
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.split())
+
+
+class TTLCache:
+    """LRU-bounded mapping whose entries also expire after ttl seconds"""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SearchCache:
+    """Two-level search cache: normalized query -> embedding, (query, top_k) -> results"""
+
+    def __init__(self):
+        self.embeddings = TTLCache(QUERY_EMBEDDING_CACHE_SIZE, QUERY_EMBEDDING_CACHE_TTL)
+        self.results = TTLCache(SEARCH_RESULT_CACHE_SIZE, SEARCH_RESULT_CACHE_TTL)
+        # Bumped on every index change so searches that started earlier don't store stale results
+        self.generation = 0
+
+    def get_embedding(self, query: str) -> Optional[List[float]]:
+        return self.embeddings.get(query)
+
+    def set_embedding(self, query: str, embedding: List[float]):
+        self.embeddings.set(query, embedding)
+
+    def get_results(self, query: str, top_k: int) -> Optional[List[Dict[str, Any]]]:
+        return self.results.get((query, top_k))
+
+    def set_results(self, query: str, top_k: int, results: List[Dict[str, Any]], generation: int):
+        if generation == self.generation:
+            self.results.set((query, top_k), results)
+
+    def invalidate(self):
+        """Drop cached results; query embeddings stay valid when the index changes"""
+        self.generation += 1
+        self.results.clear()
@@ -0,0 +1,103 @@
+import os
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from metrics import SERVICE1_SECONDS, timed, trace_headers
+
+
+SERVICE1_GRAPHQL_URL = os.getenv("SERVICE1_GRAPHQL_URL", "http://service1:8081/graphql")
+
+PDF_METADATA_QUERY = """
+    query($pdfId: Int!) {
+        pdf(pdfId: $pdfId) {
+            id
+            filename
+            s3Url
+        }
+    }
+"""
+
+PDFS_BY_IDS_QUERY = """
+    query($pdfIds: [Int!]!) {
+        pdfsByIds(pdfIds: $pdfIds) {
+            id
+            filename
+            s3Url
+        }
+    }
+"""
+
+PDF_SUMMARY_QUERY = """
+    query($pdfId: Int!) {
+        pdf(pdfId: $pdfId) {
+            id
+            filename
+            s3Url
+            summary
+            summaryKey
+        }
+    }
+"""
+
+UPDATE_PDF_SUMMARY_MUTATION = """
+    mutation($pdfId: Int!, $summary: String!, $summaryKey: String) {
+        updatePdfSummary(pdfId: $pdfId, summary: $summary, summaryKey: $summaryKey) {
+            id
+        }
+    }
+"""
+
+
+async def fetch_pdf_metadata(
+    http: httpx.AsyncClient, pdf_id: int, query: str = PDF_METADATA_QUERY
+) -> Optional[Dict[str, Any]]:
+    """Fetch PDF metadata from Service 1, returning None if the PDF does not exist"""
+    with timed("service1.pdf", SERVICE1_SECONDS, "pdf"):
+        response = await http.post(
+            SERVICE1_GRAPHQL_URL,
+            json={"query": query, "variables": {"pdfId": pdf_id}},
+            headers=trace_headers(),
+        )
+
+    if response.status_code != 200:
+        raise Exception(f"Error fetching PDF metadata: {response.text}")
+
+    data = response.json()
+    return data.get("data", {}).get("pdf")
+
+
+async def fetch_pdfs_metadata(
+    http: httpx.AsyncClient, pdf_ids: List[int]
+) -> List[Optional[Dict[str, Any]]]:
+    """Fetch metadata for several PDFs in one request, None for PDFs that don't exist"""
+    with timed("service1.pdfsByIds", SERVICE1_SECONDS, "pdfsByIds", count=len(pdf_ids)):
+        response = await http.post(
+            SERVICE1_GRAPHQL_URL,
+            json={"query": PDFS_BY_IDS_QUERY, "variables": {"pdfIds": pdf_ids}},
+            headers=trace_headers(),
+        )
+
+    if response.status_code != 200:
+        raise Exception(f"Error fetching PDF metadata: {response.text}")
+
+    data = response.json()
+    if data.get("errors"):
+        raise Exception(f"Error fetching PDF metadata: {data['errors']}")
+    return data["data"]["pdfsByIds"]
+
+
+async def store_pdf_summary(http: httpx.AsyncClient, pdf_id: int, summary: str, summary_key: str):
+    """Persist a generated summary in Service 1 so later requests can reuse it"""
+    with timed("service1.updatePdfSummary", SERVICE1_SECONDS, "updatePdfSummary"):
+        response = await http.post(
+            SERVICE1_GRAPHQL_URL,
+            json={
+                "query": UPDATE_PDF_SUMMARY_MUTATION,
+                "variables": {"pdfId": pdf_id, "summary": summary, "summaryKey": summary_key},
+            },
+            headers=trace_headers(),
+        )
+
+    if response.status_code != 200 or response.json().get("errors"):
+        print(f"Error storing summary for PDF {pdf_id}: {response.text}")
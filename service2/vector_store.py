@@ -0,0 +1,193 @@
+import asyncio
+import hashlib
+import os
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from ai_utils import PageChunk
+
+
+# "opensearch" for the cluster, "numpy" for the in-process store
+VECTOR_STORE = os.getenv("VECTOR_STORE", "opensearch")
+# Rank constant of reciprocal rank fusion; larger values flatten the weight of top ranks
+SEARCH_RRF_K = int(os.getenv("SEARCH_RRF_K", "60"))
+
+
+def chunk_id(doc_id: str, chunk: PageChunk) -> str:
+    """Content-addressed chunk id, so unchanged chunks keep their id across re-indexing.
+
+    The id doesn't cover the embedding settings; ChunkState.page_hash does.
+    """
+    digest = hashlib.sha256(
+        f"{chunk.page_num}\0{chunk.chunk_index}\0{chunk.content}".encode("utf-8")
+    ).hexdigest()
+    return f"{doc_id}_{digest[:24]}"
+
+
+@dataclass
+class ChunkState:
+    """What an indexed chunk was derived from, used to skip unchanged work on re-indexing"""
+
+    page_number: int
+    page_hash: Optional[str]
+
+
+@dataclass
+class IndexResult:
+    indexed: int = 0
+    deleted: int = 0
+    errors: List[Dict[str, Any]] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+
+class VectorStore(ABC):
+    """Chunk embeddings of PDFs, searched by nearest neighbour and grouped per document.
+
+    Filters passed to search_documents are exact matches on pdf_id or on a metadata key.
+    """
+
+    def __init__(self):
+        self._change_listeners: List[Callable[[], None]] = []
+
+    def add_change_listener(self, listener: Callable[[], None]):
+        """Register a callback invoked whenever documents are indexed or deleted"""
+        self._change_listeners.append(listener)
+
+    def _notify_change(self):
+        for listener in self._change_listeners:
+            listener()
+
+    @abstractmethod
+    async def ensure_index(self):
+        ...
+
+    @abstractmethod
+    async def close(self):
+        ...
+
+    @abstractmethod
+    async def get_chunk_state(self, doc_id: str) -> Dict[str, ChunkState]:
+        """State of every indexed chunk of a document, keyed by chunk id"""
+
+    @abstractmethod
+    async def get_source_key(self, doc_id: str) -> Optional[str]:
+        """Source key recorded by the last fully successful sync_document of a document"""
+
+    @abstractmethod
+    async def sync_document(
+        self,
+        doc_id: str,
+        chunks: List[PageChunk],
+        embeddings: List[List[float]],
+        metadata: Dict[str, Any],
+        source_key: Optional[str],
+        delete_ids: Iterable[str] = (),
+        refresh: Optional[str] = None,
+        partial: bool = False,
+    ) -> IndexResult:
+        """Upsert new chunks and delete stale ones, then record source_key if nothing failed.
+
+        partial marks one of several writes of a document: the index isn't refreshed and the
+        source key is left alone, until the document's last write.
+        """
+
+    async def clear_source_key(self, doc_id: str):
+        """Forget a document's source key before it is rewritten in several partial writes"""
+        await self.sync_document(doc_id, [], [], {}, source_key=None, refresh="none")
+
+    async def index_document(
+        self,
+        doc_id: str,
+        chunks: List[PageChunk],
+        metadata: Dict[str, Any],
+        embeddings: List[List[float]],
+        refresh: Optional[str] = None,
+    ) -> IndexResult:
+        """Replace all chunks of a document with the given ones"""
+        if len(chunks) != len(embeddings):
+            print(
+                f"Warning: Number of chunks ({len(chunks)}) doesn't match number of embeddings ({len(embeddings)})"
+            )
+            length = min(len(chunks), len(embeddings))
+            chunks = chunks[:length]
+            embeddings = embeddings[:length]
+
+        existing = await self.get_chunk_state(doc_id)
+        new_ids = {chunk_id(doc_id, chunk) for chunk in chunks}
+        return await self.sync_document(
+            doc_id,
+            chunks,
+            embeddings,
+            metadata,
+            source_key=None,
+            delete_ids=[id for id in existing if id not in new_ids],
+            refresh=refresh,
+        )
+
+    @abstractmethod
+    async def search_documents(
+        self,
+        query_embedding: List[float],
+        top_k: int = 5,
+        filters: Optional[Dict[str, Any]] = None,
+    ) -> List[Dict[str, Any]]:
+        ...
+
+    async def search_documents_batch(
+        self,
+        query_embeddings: List[List[float]],
+        top_k: int = 5,
+        filters: Optional[Dict[str, Any]] = None,
+    ) -> List[List[Dict[str, Any]]]:
+        """search_documents for several queries, results in query order; stores override to batch them"""
+        return list(
+            await asyncio.gather(
+                *(self.search_documents(embedding, top_k, filters) for embedding in query_embeddings)
+            )
+        )
+
+    @abstractmethod
+    async def delete_document(self, doc_id: str) -> bool:
+        ...
+
+    @abstractmethod
+    async def get_document(self, doc_id: str) -> Dict[str, Any]:
+        ...
+
+
+def reciprocal_rank_fusion(
+    result_lists: List[List[Dict[str, Any]]], top_k: int, k: int = SEARCH_RRF_K
+) -> List[Dict[str, Any]]:
+    """Merge per-query results into one list of documents ranked by summed 1 / (k + rank).
+
+    Each document keeps the chunk from the query that ranked it highest, with its fused score.
+    """
+    scores: Dict[str, float] = {}
+    best: Dict[str, Dict[str, Any]] = {}
+    best_rank: Dict[str, int] = {}
+    for results in result_lists:
+        for rank, result in enumerate(results, start=1):
+            doc_id = result["id"]
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+            if rank < best_rank.get(doc_id, rank + 1):
+                best_rank[doc_id] = rank
+                best[doc_id] = result
+
+    ranked = sorted(scores, key=lambda doc_id: (-scores[doc_id], best_rank[doc_id]))
+    return [{**best[doc_id], "score": scores[doc_id]} for doc_id in ranked[:top_k]]
+
+
+def create_vector_store(kind: str = VECTOR_STORE) -> VectorStore:
+    if kind == "opensearch":
+        from opensearch_utils import OpenSearchClient
+
+        return OpenSearchClient()
+    if kind == "numpy":
+        from numpy_store import NumpyVectorStore
+
+        return NumpyVectorStore()
+    raise Exception(f"Unknown vector store {kind}, expected opensearch or numpy")